@@ -71,14 +71,47 @@ def insert_metadata(connection, filename, filepath, modality, patient_id):
 #     used_space = usage.used
 #     return (total_space, used_space)
 
-# Function to compress DICOM image using gzip
-def compress_dicom(dicom_path, compressed_path):
+# Writes every chunk it receives to several files, so one compressed stream feeds all tiers
+class TeeWriter:
+    def __init__(self, files):
+        self.files = files
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+        return len(data)
+
+    def flush(self):
+        for f in self.files:
+            f.flush()
+
+# Function to compress DICOM image using gzip.
+# The image is read and compressed once and written to every path in compressed_paths
+# through a temporary file that is renamed into place once it is on disk.
+def compress_dicom(dicom_path, compressed_paths):
+    temp_paths = [compressed_path + '.tmp' for compressed_path in compressed_paths]
+    files = []
     try:
+        for temp_path in temp_paths:
+            files.append(open(temp_path, 'wb'))
         with open(dicom_path, 'rb') as f_in:
-            with gzip.open(compressed_path, 'wb') as f_out:
+            with gzip.GzipFile(fileobj=TeeWriter(files), mode='wb') as f_out:
                 shutil.copyfileobj(f_in, f_out)
+        for f in files:
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        for temp_path, compressed_path in zip(temp_paths, compressed_paths):
+            os.replace(temp_path, compressed_path)
+        return True
     except Exception as e:
         print(f"Error compressing DICOM image: {e}")
+        for f in files:
+            f.close()
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return False
 
 # Function to update image metadata in the database
 def update_metadata(connection, original_path, new_path):
@@ -148,14 +181,11 @@ def main(input_directory, short_term_directory, long_term_directory, local_direc
                             compressed_long_term_path = os.path.join(long_term_directory, f'{filename}.gz')
                             compressed_local_path = os.path.join(local_directory, f'{filename}.gz')
                             
-                            # Compress the DICOM file and move to long-term storage
-                            compress_dicom(dicom_path, compressed_long_term_path)
+                            # Compress the DICOM file once and write it to long-term and local storage
+                            if not compress_dicom(dicom_path, [compressed_long_term_path, compressed_local_path]):
+                                continue
                             update_metadata(connection, dicom_path, compressed_long_term_path)
                             print(f"Image {filename} compressed and moved to long-term storage.")
-                            
-                            # Compress the DICOM file and move to local storage
-                            compress_dicom(dicom_path, compressed_local_path)
-                            update_metadata(connection, dicom_path, compressed_local_path)
                             print(f"Image {filename} compressed and moved to local storage.")
 
                             # Remove the original DICOM file
@@ -0,0 +1,97 @@
+import os
+import io
+import sys
+import gzip
+import time
+import argparse
+import tempfile
+
+from compression import CODECS, codec_available, open_codec_writer, open_codec_reader, train_zstd_dictionary
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Function to load the bundled sample studies, gunzipping archived copies so every codec
+# starts from the same uncompressed bytes
+def load_samples(directories):
+    samples = []
+    for directory in directories:
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path) or name.endswith('.tmp'):
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            if data[:2] == b'\x1f\x8b':
+                data = gzip.decompress(data)
+            samples.append((path, data))
+    return samples
+
+# Function to compress and decompress data with a codec, returning (compressed size, seconds, seconds)
+def run_codec(codec, data, level, dictionary_path):
+    buffer = io.BytesIO()
+    start = time.perf_counter()
+    with open_codec_writer(codec, buffer, level, dictionary_path) as stream:
+        stream.write(data)
+    compress_seconds = time.perf_counter() - start
+
+    compressed = buffer.getvalue()
+    start = time.perf_counter()
+    with open_codec_reader(codec, io.BytesIO(compressed), dictionary_path) as stream:
+        restored = stream.read()
+    decompress_seconds = time.perf_counter() - start
+
+    if restored != data:
+        raise ValueError(f"Codec {codec} did not round-trip the sample data")
+    return len(compressed), compress_seconds, decompress_seconds
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare archive codecs on the bundled sample studies.")
+    parser.add_argument('--directory', action='append',
+                        help="Sample directory (default: input/ and longterm/ next to this script)")
+    parser.add_argument('--codec', action='append', help="Codec to test (default: every available codec)")
+    parser.add_argument('--level', type=int, default=None, help="Compression level (default: codec default)")
+    parser.add_argument('--train-dictionary', metavar='PATH',
+                        help="Train a zstd dictionary on the samples, save it to PATH and benchmark with it")
+    args = parser.parse_args()
+
+    directories = args.directory or [os.path.join(SCRIPT_DIRECTORY, 'input'), os.path.join(SCRIPT_DIRECTORY, 'longterm')]
+    samples = load_samples(directories)
+    if not samples:
+        print("No sample files found.")
+        return 1
+    total_bytes = sum(len(data) for _, data in samples)
+    print(f"{len(samples)} samples, {total_bytes / 1e6:.1f} MB uncompressed")
+
+    dictionary_path = None
+    if args.train_dictionary:
+        with tempfile.TemporaryDirectory() as sample_directory:
+            sample_paths = []
+            for index, (_, data) in enumerate(samples):
+                sample_path = os.path.join(sample_directory, str(index))
+                with open(sample_path, 'wb') as f:
+                    f.write(data)
+                sample_paths.append(sample_path)
+            dictionary_path = train_zstd_dictionary(sample_paths, args.train_dictionary)
+        print(f"Trained zstd dictionary saved to {dictionary_path}")
+
+    codecs = args.codec or list(CODECS)
+    print(f"{'codec':<8}{'ratio':>8}{'compress MB/s':>16}{'decompress MB/s':>18}")
+    for codec in codecs:
+        if not codec_available(codec):
+            print(f"{codec:<8}  not installed")
+            continue
+        compressed_bytes = 0
+        compress_seconds = 0
+        decompress_seconds = 0
+        for _, data in samples:
+            size, seconds_in, seconds_out = run_codec(codec, data, args.level,
+                                                      dictionary_path if codec == 'zstd' else None)
+            compressed_bytes += size
+            compress_seconds += seconds_in
+            decompress_seconds += seconds_out
+        print(f"{codec:<8}{total_bytes / compressed_bytes:>8.2f}"
+              f"{total_bytes / 1e6 / compress_seconds:>16.1f}{total_bytes / 1e6 / decompress_seconds:>18.1f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+import pydicom
+
+from compression import HeaderReader, read_dicom_header
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Function to list the readable DICOM files in the sample directories
+def find_dicom_files(directories):
+    dicom_paths = []
+    for directory in directories:
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path):
+                continue
+            with open(path, 'rb') as f:
+                f.seek(128)
+                if f.read(4) == b'DICM':
+                    dicom_paths.append(path)
+    return dicom_paths
+
+# Function run in a child process so each mode starts with a fresh peak RSS
+def run_mode(mode, dicom_paths, repeat):
+    header_reader = HeaderReader()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for dicom_path in dicom_paths:
+            if mode == 'full':
+                # What ingest used to do: load the whole file, pixel data included
+                pydicom.dcmread(dicom_path).Modality
+            elif mode == 'header':
+                header_reader.read(dicom_path).Modality
+            else:
+                # Header read plus the identifiers and JSONB tag store written at ingest
+                read_dicom_header(dicom_path)
+    elapsed = time.perf_counter() - start
+    files = len(dicom_paths) * repeat
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else float('nan')
+    print(f"{mode:<8}{files / elapsed:>12.0f}{peak_rss_mb:>16.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare full DICOM reads with header-only reads.")
+    parser.add_argument('--directory', action='append',
+                        help="Sample directory (default: input/ and longterm/ next to this script)")
+    parser.add_argument('--repeat', type=int, default=20, help="Times each file is read")
+    parser.add_argument('--mode', choices=['full', 'header', 'indexed'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    directories = args.directory or [os.path.join(SCRIPT_DIRECTORY, 'input'), os.path.join(SCRIPT_DIRECTORY, 'longterm')]
+    dicom_paths = find_dicom_files(directories)
+    if not dicom_paths:
+        print("No DICOM files found.")
+        return 1
+
+    if args.mode:
+        run_mode(args.mode, dicom_paths, args.repeat)
+        return 0
+
+    print(f"{len(dicom_paths)} DICOM files, each read {args.repeat} times")
+    print(f"{'mode':<8}{'files/s':>12}{'peak RSS MB':>16}")
+    sys.stdout.flush()
+    for mode in ('full', 'header', 'indexed'):
+        command = [sys.executable, os.path.abspath(__file__), '--mode', mode, '--repeat', str(args.repeat)]
+        for directory in directories:
+            command += ['--directory', directory]
+        subprocess.run(command, check=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,361 @@
+import os
+import io
+import sys
+import json
+import glob
+import logging
+import time
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import psycopg2
+
+from compression import (ARCHIVE_CODEC, ARCHIVE_LEVEL, ZSTD_DICTIONARY_PATH, CODECS, INDEXED_CODECS, INGEST_WORKERS,
+                         INGEST_WORKER_MEMORY_MB, connect_to_database, create_metadata_tables, codec_available,
+                         read_dicom_header_in_worker, archive_study_worker, read_archive_index, insert_blobs,
+                         add_blob_references, generate_patient_id, limit_worker_memory, configure_logging,
+                         folder_tar_size, render_study_previews, PREVIEW_DIRECTORY_NAME, STUDY_EVENTS_CHANNEL)
+
+logger = logging.getLogger('archiver.bulk_import')
+
+# Studies written to the database per transaction
+IMPORT_BATCH_SIZE = 100
+# Studies queued per worker before the walk waits for some to finish
+IMPORT_QUEUE_PER_WORKER = 2
+# Seconds between progress reports
+PROGRESS_INTERVAL = 10
+# Niceness of the import workers, so live ingest keeps the CPU it needs. Unix only.
+IMPORT_WORKER_NICENESS = 10
+
+STUDY_COLUMNS = ('id', 'patient_id', 'modality', 'folderpath', 'compressed', 'codec', 'codec_dictionary',
+                 'study_instance_uid', 'study_date', 'body_part', 'study_description', 'size_bytes', 'tar_size')
+IMAGE_COLUMNS = ('study_id', 'filename', 'filepath', 'sop_instance_uid', 'series_instance_uid', 'tags', 'sha256',
+                 'archive_offset', 'archive_length')
+PREVIEW_COLUMNS = ('study_id', 'series_instance_uid', 'sop_instance_uid', 'size', 'width', 'height', 'format', 'path')
+# Event recorded for every imported study, which live dashboards pick up. It is not
+# 'ingested', so the web app does not prefetch the priors of a back catalogue.
+IMPORT_EVENT = 'imported'
+
+# Spaces out work so it never runs faster than rate units per second on average
+class RateLimiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_free = time.monotonic()
+
+    def acquire(self, amount):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        start = max(now, self.next_free)
+        self.next_free = start + amount / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+# Counts what has been imported and logs files/s and MB/s, overall and since the last report
+class ProgressReport:
+    def __init__(self):
+        self.start_time = time.monotonic()
+        self.last_time = self.start_time
+        self.studies = 0
+        self.skipped = 0
+        self.failed = 0
+        self.files = 0
+        self.bytes = 0
+        self.last_files = 0
+        self.last_bytes = 0
+
+    def add(self, files, size):
+        self.studies += 1
+        self.files += files
+        self.bytes += size
+
+    def maybe_report(self):
+        if time.monotonic() - self.last_time >= PROGRESS_INTERVAL:
+            self.report()
+
+    def report(self, final=False):
+        now = time.monotonic()
+        interval = max(now - self.last_time, 1e-9)
+        elapsed = max(now - self.start_time, 1e-9)
+        line = (f"{self.studies} studies, {self.files} files, {self.bytes / 1e6:.0f} MB"
+                f" | {self.files / elapsed:.0f} files/s, {self.bytes / 1e6 / elapsed:.1f} MB/s overall")
+        if not final:
+            line += (f" | {(self.files - self.last_files) / interval:.0f} files/s, "
+                     f"{(self.bytes - self.last_bytes) / 1e6 / interval:.1f} MB/s now")
+        if self.skipped or self.failed:
+            line += f" | {self.skipped} already imported, {self.failed} failed"
+        logger.info(line)
+        self.last_time = now
+        self.last_files = self.files
+        self.last_bytes = self.bytes
+
+# Function run when an import worker starts: lowers its priority and caps its memory
+def start_import_worker(niceness, memory_limit_mb):
+    if niceness and hasattr(os, 'nice'):
+        os.nice(niceness)
+    limit_worker_memory(memory_limit_mb)
+
+# Function to walk a source tree with os.scandir, yielding (folder_path, file count, total size)
+# for every folder that directly holds files. Folders are visited in sorted order.
+def find_study_folders(source_root):
+    pending = [source_root]
+    while pending:
+        folder_path = pending.pop()
+        files = 0
+        size = 0
+        subfolders = []
+        try:
+            with os.scandir(folder_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subfolders.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        files += 1
+                        size += entry.stat(follow_symlinks=False).st_size
+        except OSError as error:
+            logger.error(f"Cannot read {folder_path}: {error}")
+            continue
+        if files:
+            yield folder_path, files, size
+        pending.extend(sorted(subfolders, reverse=True))
+
+# Function run in an import worker: reads every header of a study folder, writes its
+# archives straight into the tiers and renders its previews. The source folder is only read.
+# Returns (images, archive result, archive index, tar size, preview rows).
+def import_study_worker(folder_path, study_id, destinations, codec, level, dictionary_path, preview_directory):
+    images = []
+    for dicom_file in sorted(os.listdir(folder_path)):
+        dicom_path = os.path.join(folder_path, dicom_file)
+        if not os.path.isfile(dicom_path):
+            continue
+        header, error = read_dicom_header_in_worker(dicom_path, with_digest=codec == 'blobs')
+        images.append((dicom_file, dicom_path, header, error, os.path.getsize(dicom_path)))
+    # The blob store keys instances by the digests just computed
+    digests = {dicom_file: header['sha256'] for dicom_file, _, header, _, _ in images
+               if header is not None and header.get('sha256')}
+    archive = archive_study_worker(folder_path, destinations, codec, level, dictionary_path, digests)
+    if archive is None:
+        return images, None, None, None, []
+    archive_index = read_archive_index(archive[0]) if codec in INDEXED_CODECS else None
+    tar_size = folder_tar_size(folder_path) if codec in CODECS else None
+    previews = render_study_previews(study_id, folder_path, [{
+        'filename': dicom_file,
+        'sop_instance_uid': header['sop_instance_uid'],
+        'series_instance_uid': header['series_instance_uid'],
+        'tags': header['tags'],
+    } for dicom_file, _, header, _, _ in images if header is not None], preview_directory)
+    return images, archive, archive_index, tar_size, previews
+
+# Function to format a value as a COPY csv field. Text is always quoted so that only
+# None is left as the unquoted empty field COPY reads as NULL.
+def csv_field(value):
+    if value is None:
+        return ''
+    if isinstance(value, (bool, int)):
+        return str(value)
+    return '"' + str(value).replace('"', '""') + '"'
+
+# Function to write rows into a table with COPY, much faster than INSERT for bulk loads
+def copy_rows(cursor, table, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(','.join(csv_field(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+# Function to turn the result of import_study_worker into a studies row and images rows,
+# without study ids yet. Returns (study, images, blobs).
+def build_study_rows(images, archive, archive_index, tar_size, destinations, codec, dictionary_path):
+    headers = [header for _, _, header, _, _ in images if header is not None]
+    first_header = headers[0] if headers else {}
+    patient_id = first_header.get('patient_id') or generate_patient_id()
+    blobs_by_file = {blob['filename']: blob for blob in archive} if codec == 'blobs' else {}
+
+    image_rows = []
+    for dicom_file, dicom_path, header, error, size in images:
+        if header is None:
+            logger.warning(f"Could not read DICOM header of {dicom_path}: {error}")
+            header = {}
+        blob = blobs_by_file.get(dicom_file)
+        offset, length = archive_index.get(dicom_file, (None, None)) if archive_index else (None, None)
+        tags = header.get('tags')
+        image_rows.append([dicom_file, blob['path'] if blob else dicom_path,
+                           header.get('sop_instance_uid'), header.get('series_instance_uid'),
+                           json.dumps(tags) if tags is not None else None,
+                           blob['sha256'] if blob else header.get('sha256'), offset, length])
+
+    # Blob-store studies have no archive of their own; the long-term path only names them
+    folderpath = destinations[0] if codec == 'blobs' else archive[0]
+    study_date = first_header.get('study_date')
+    study_row = [patient_id, first_header.get('modality'), folderpath, True, codec, dictionary_path,
+                 first_header.get('study_instance_uid'), study_date.isoformat() if study_date else None,
+                 first_header.get('body_part'), first_header.get('study_description'),
+                 sum(size for _, _, _, _, size in images), tar_size]
+    return study_row, image_rows, list(blobs_by_file.values())
+
+# Function to reserve the id of a study before it is archived, so its archives can be named
+# after it and its images loaded with COPY. Ids of studies that fail to import are skipped.
+def reserve_study_id(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT nextval(pg_get_serial_sequence('studies', 'id'))")
+    study_id = cursor.fetchone()[0]
+    connection.rollback()
+    return study_id
+
+# Function to write a batch of imported studies, their images, blobs, previews, events and
+# checkpoints in one transaction. batch holds (study_id, study_path, study_row, image_rows,
+# blobs, preview_rows). Returns True on success.
+def write_batch(connection, source_root, batch):
+    if not batch:
+        return True
+    try:
+        cursor = connection.cursor()
+        study_rows = []
+        image_rows = []
+        preview_rows = []
+        checkpoint_rows = []
+        blobs = []
+        references = Counter()
+        for study_id, study_path, study_row, images, study_blobs, previews in batch:
+            study_rows.append([study_id] + study_row)
+            image_rows.extend([study_id] + image for image in images)
+            preview_rows.extend(previews)
+            checkpoint_rows.append([source_root, study_path, study_id])
+            blobs.extend(study_blobs)
+            references.update(blob['sha256'] for blob in study_blobs)
+        insert_blobs(cursor, blobs)
+        copy_rows(cursor, 'studies', STUDY_COLUMNS, study_rows)
+        copy_rows(cursor, 'images', IMAGE_COLUMNS, image_rows)
+        copy_rows(cursor, 'previews', PREVIEW_COLUMNS, preview_rows)
+        add_blob_references(cursor, references)
+        # Announced like the archiver's own events, once the batch commits
+        cursor.execute('''
+            WITH events AS (
+                INSERT INTO study_events (study_id, event)
+                SELECT study_id, %s FROM unnest(%s::integer[]) AS study_id
+                RETURNING id
+            )
+            SELECT pg_notify(%s, id::text) FROM events
+        ''', (IMPORT_EVENT, [study_id for study_id, *_ in batch], STUDY_EVENTS_CHANNEL))
+        copy_rows(cursor, 'bulk_imports', ('source_root', 'study_path', 'study_id'), checkpoint_rows)
+        connection.commit()
+        return True
+    except (Exception, psycopg2.Error) as error:
+        connection.rollback()
+        logger.error(f"Error writing a batch of {len(batch)} studies: {error}")
+        return False
+
+# Function to read which study folders of a source tree an earlier run already imported
+def load_checkpoint(connection, source_root):
+    cursor = connection.cursor()
+    cursor.execute("SELECT study_path FROM bulk_imports WHERE source_root = %s", (source_root,))
+    done = {study_path for (study_path,) in cursor.fetchall()}
+    connection.rollback()
+    return done
+
+def main():
+    parser = argparse.ArgumentParser(description="Import a back catalogue of study folders straight into the archive.")
+    parser.add_argument('source', help="Root of the tree to import; every folder holding files is a study")
+    parser.add_argument('--long-term', required=True, help="Long-term storage directory")
+    parser.add_argument('--local', help="Local storage directory, which gets a copy of every archive too")
+    parser.add_argument('--codec', default=ARCHIVE_CODEC, help=f"Archive codec (default: {ARCHIVE_CODEC})")
+    parser.add_argument('--level', type=int, default=ARCHIVE_LEVEL, help="Compression level (default: codec default)")
+    parser.add_argument('--workers', type=int, default=INGEST_WORKERS, help="Import worker processes")
+    parser.add_argument('--files-per-second', type=float, help="Import at most this many files per second")
+    parser.add_argument('--mb-per-second', type=float, help="Read at most this many MB per second")
+    parser.add_argument('--niceness', type=int, default=IMPORT_WORKER_NICENESS, help="Niceness of the workers")
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE, help="Studies per transaction")
+    args = parser.parse_args()
+    configure_logging()
+
+    if not codec_available(args.codec):
+        logger.error(f"Archive codec {args.codec} is not available. Install its library or choose another codec.")
+        return 1
+    dictionary_path = ZSTD_DICTIONARY_PATH if args.codec == 'zstd' else None
+    tier_directories = [args.long_term] + ([args.local] if args.local else [])
+    for tier_directory in tier_directories:
+        os.makedirs(tier_directory, exist_ok=True)
+    preview_directory = os.path.join(args.long_term, PREVIEW_DIRECTORY_NAME)
+    os.makedirs(preview_directory, exist_ok=True)
+
+    connection = connect_to_database()
+    if not connection:
+        return 1
+    create_metadata_tables(connection)
+    source_root = os.path.abspath(args.source)
+    done = load_checkpoint(connection, source_root)
+    if done:
+        logger.info(f"Resuming: {len(done)} study folders were imported by an earlier run.")
+
+    file_limiter = RateLimiter(args.files_per_second)
+    byte_limiter = RateLimiter(args.mb_per_second * 1e6 if args.mb_per_second else None)
+    progress = ProgressReport()
+    executor = ProcessPoolExecutor(max_workers=args.workers, initializer=start_import_worker,
+                                   initargs=(args.niceness, INGEST_WORKER_MEMORY_MB))
+    # future -> (study_id, study_path, destinations, file count, size)
+    in_flight = {}
+    batch = []
+
+    # Function to collect finished studies into the batch, writing it once it is full
+    def collect(timeout):
+        nonlocal batch
+        finished, _ = wait(list(in_flight), timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in finished:
+            study_id, study_path, destinations, files, size = in_flight.pop(future)
+            try:
+                images, archive, archive_index, tar_size, previews = future.result()
+            except Exception as error:
+                images, archive = None, None
+                logger.error(f"Error importing {study_path}: {error}")
+            if archive is None:
+                progress.failed += 1
+                continue
+            study_row, image_rows, blobs = build_study_rows(images, archive, archive_index, tar_size, destinations,
+                                                            args.codec, dictionary_path)
+            batch.append((study_id, study_path, study_row, image_rows, blobs, previews))
+            progress.add(files, size)
+        if len(batch) >= args.batch_size:
+            if not write_batch(connection, source_root, batch):
+                progress.failed += len(batch)
+            batch = []
+        progress.maybe_report()
+
+    try:
+        for folder_path, files, size in find_study_folders(source_root):
+            study_path = os.path.relpath(folder_path, source_root)
+            if study_path in done:
+                progress.skipped += 1
+                continue
+            file_limiter.acquire(files)
+            byte_limiter.acquire(size)
+            while len(in_flight) >= args.workers * IMPORT_QUEUE_PER_WORKER:
+                collect(timeout=None)
+            # Studies are named after their reserved id, which no other study, source tree or
+            # run can have, and an existing archive is never written over
+            study_id = reserve_study_id(connection)
+            study_name = f"import_{study_id}"
+            destinations = [os.path.join(tier_directory, study_name) for tier_directory in tier_directories]
+            existing = [destination for destination in destinations
+                        if os.path.lexists(destination) or glob.glob(glob.escape(destination) + '.*')]
+            if existing:
+                logger.error(f"Not importing {study_path}: {existing[0]} already exists.")
+                progress.failed += 1
+                continue
+            future = executor.submit(import_study_worker, folder_path, study_id, destinations, args.codec,
+                                     args.level, dictionary_path, preview_directory)
+            in_flight[future] = (study_id, study_path, destinations, files, size)
+            collect(timeout=0)
+        while in_flight:
+            collect(timeout=None)
+        if not write_batch(connection, source_root, batch):
+            progress.failed += len(batch)
+    finally:
+        executor.shutdown()
+        connection.close()
+    progress.report(final=True)
+    return 0 if not progress.failed else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
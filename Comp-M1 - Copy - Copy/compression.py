@@ -1,11 +1,180 @@
 import os
 import shutil
 import time
+import json
+import logging
 import gzip
+import io
+import zlib
+import numpy as np
 import pydicom
+from pydicom.uid import RLELossless, JPEGLSLossless
+from pydicom.dataelem import RawDataElement
+from pydicom.datadict import dictionary_VR
+from pydicom.pixels import get_encoder, pixel_array
 import psycopg2
+from psycopg2.extras import execute_values, Json
 from datetime import datetime
-import random
+import uuid
+import hashlib
+import base64
+from collections import Counter, deque
+import heapq
+import itertools
+import functools
+from contextlib import contextmanager
+import tarfile
+import zipfile
+import struct
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+    INotify = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+logger = logging.getLogger('archiver')
+
+# Seconds a study folder in the input directory must stay unchanged before it is ingested
+INGEST_QUIESCENCE_SECONDS = 2
+# Rescan interval used when inotify is not available
+INGEST_POLL_INTERVAL = 1
+# Seconds before a study whose ingest failed is tried again
+INGEST_RETRY_SECONDS = 60
+# Tiering policy. A study stays in short-term storage for at least TIER_MIN_AGE_SECONDS.
+# After that it is archived once it is older than the maximum age for its modality and
+# has not been opened for TIER_RECENT_ACCESS_SECONDS. While the short-term disk is
+# fuller than TIER_HIGH_WATERMARK, the least recently used studies are archived first,
+# whatever their age, until usage is back under TIER_LOW_WATERMARK.
+TIER_MIN_AGE_SECONDS = 180
+TIER_MAX_AGE_SECONDS = 24 * 60 * 60
+TIER_MODALITY_MAX_AGE_SECONDS = {'CR': 6 * 60 * 60, 'DX': 6 * 60 * 60}
+TIER_RECENT_ACCESS_SECONDS = 4 * 60 * 60
+TIER_HIGH_WATERMARK = 0.80
+TIER_LOW_WATERMARK = 0.70
+# How often the policy is evaluated, and how often disk usage is recorded for the capacity forecast
+TIER_POLICY_INTERVAL = 30
+TIER_SAMPLE_INTERVAL = 10 * 60
+# Days of usage samples the capacity forecast is fitted over
+TIER_FORECAST_DAYS = 7
+# Delay before a study whose archiving failed is tried again
+ARCHIVE_RETRY_SECONDS = 180
+# Number of worker processes compressing studies in parallel
+ARCHIVE_WORKERS = 2
+# Maximum number of studies being archived at once while no study is waiting to be ingested
+ARCHIVE_QUEUE_SIZE = 4
+# Studies being archived at once while studies are waiting to be ingested: none while a
+# STAT study waits, ARCHIVE_BUSY_QUEUE_SIZE while only others do. Jobs already running
+# carry on, at ARCHIVE_WORKER_NICENESS so ingest keeps the CPU it needs (Unix only).
+ARCHIVE_BUSY_QUEUE_SIZE = 1
+ARCHIVE_WORKER_NICENESS = 10
+# How often the main loop checks for finished archive jobs while some are running
+ARCHIVE_POLL_INTERVAL = 0.5
+# Codec used for new archives and its level, None for the codec default. Keys of CODECS
+# write one tarball per study; keys of DICOM_CODECS keep every instance as a DICOM file
+# with its Pixel Data re-encoded losslessly; keys of INDEXED_CODECS write one archive per
+# study whose instances can each be read with a single seek; 'blobs' keeps every distinct
+# instance once per tier in the content-addressed blob store, compressed with BLOB_CODEC.
+# 'blobs' is opt-in: it hashes every instance at ingest to find the ones already stored.
+ARCHIVE_CODEC = 'gzip'
+ARCHIVE_LEVEL = None
+# Codec instances in the blob store are compressed with, and the blob store's folder in each tier
+BLOB_CODEC = 'gzip'
+BLOB_DIRECTORY_NAME = 'blobs'
+# Seconds between passes deleting blobs no image refers to, and how long a blob must have
+# been unreferenced before it is deleted, which covers jobs that found it on disk but have
+# not recorded their reference yet
+BLOB_GC_INTERVAL = 60 * 60
+BLOB_GC_GRACE_SECONDS = 24 * 60 * 60
+# Previews rendered at ingest so studies can be browsed without downloading them: one
+# representative slice per series, downsampled so its longer side fits each size of the
+# pyramid. They are kept in their own folder in long-term storage.
+PREVIEW_SIZES = (64, 256)
+PREVIEW_DIRECTORY_NAME = 'previews'
+# Previews are WebP when Pillow is installed and PNG otherwise
+PREVIEW_FORMAT = 'webp'
+PREVIEW_WEBP_QUALITY = 80
+# Optional dictionary trained with train_zstd_dictionary(), used by the zstd codec
+ZSTD_DICTIONARY_PATH = None
+# PostgreSQL NOTIFY channel study changes are announced on
+STUDY_EVENTS_CHANNEL = 'study_events'
+# Header elements larger than this many bytes are left out of the JSONB tag store
+TAG_STORE_MAX_ELEMENT_BYTES = 1024
+# Value representations the tag store decodes straight from the raw header bytes, the way
+# pydicom would: strings split at backslashes and stripped at the end, text whose values
+# are each stripped, text kept whole, binary numbers and binary data, as well as AE, PN
+# and the numbers written as text (IS, DS). Other elements, and text that is not plain
+# ASCII, are decoded by pydicom.
+TAG_STORE_STRING_VRS = frozenset(('AS', 'CS', 'DA', 'DT', 'TM', 'UI'))
+TAG_STORE_TEXT_VRS = frozenset(('LO', 'SH', 'UC'))
+TAG_STORE_SINGLE_TEXT_VRS = frozenset(('LT', 'ST', 'UT', 'UR'))
+TAG_STORE_BINARY_NUMBER_FORMATS = {'US': 'H', 'SS': 'h', 'UL': 'L', 'SL': 'l', 'FL': 'f', 'FD': 'd',
+                                   'UV': 'Q', 'SV': 'q'}
+TAG_STORE_BINARY_VRS = frozenset(('OB', 'OD', 'OF', 'OL', 'OV', 'OW'))
+TAG_STORE_DECODED_VRS = (TAG_STORE_STRING_VRS | TAG_STORE_TEXT_VRS | TAG_STORE_SINGLE_TEXT_VRS | TAG_STORE_BINARY_VRS
+                         | frozenset(TAG_STORE_BINARY_NUMBER_FORMATS) | frozenset(('AE', 'PN', 'IS', 'DS')))
+# Bytes read from the start of a DICOM file in one go to parse its header
+HEADER_READ_SIZE = 64 * 1024
+# Elements larger than this are not loaded when a header does not fit in HEADER_READ_SIZE
+HEADER_DEFER_SIZE = '64 KB'
+# Priority classes of incoming studies, most urgent first. A study's class comes from the
+# prefix of its folder name in the input directory, else from the Requested Procedure
+# Priority of its first header; studies dated more than PRIORITY_BACKFILL_AGE_DAYS
+# before they arrive are back-catalogue. Ready studies are ingested most urgent class
+# first, in arrival order within a class.
+PRIORITY_CLASSES = ('stat', 'routine', 'backfill')
+PRIORITY_FOLDER_PREFIXES = {'stat_': 'stat', 'backfill_': 'backfill'}
+PRIORITY_TAG_VALUES = {'STAT': 'stat', 'HIGH': 'stat', 'ROUTINE': 'routine', 'MEDIUM': 'routine', 'LOW': 'backfill'}
+PRIORITY_BACKFILL_AGE_DAYS = 365
+# Seconds from arrival to registration each class should stay within; misses are logged and counted
+INGEST_SLO_SECONDS = {'stat': 60, 'routine': 15 * 60, 'backfill': 24 * 60 * 60}
+# Number of worker processes parsing DICOM headers at ingest, and files handed to each at once
+INGEST_WORKERS = 2
+HEADER_CHUNK_SIZE = 32
+# Address space limit of each ingest and archive worker process in MB, None for no limit
+INGEST_WORKER_MEMORY_MB = 1024
+ARCHIVE_WORKER_MEMORY_MB = 2048
+# Level of the archiver's log, and its format: 'text', or 'json' for one object per line
+LOG_LEVEL = 'INFO'
+LOG_FORMAT = 'text'
+# Port the archiver serves Prometheus metrics on at /metrics (needs prometheus_client), None for none
+METRICS_PORT = 9101
+# Histogram buckets, in seconds, of the time spent in each pipeline stage
+STAGE_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# Threads and block size used by the parallel gzip codec
+PGZIP_THREADS = 4
+PGZIP_BLOCK_SIZE = 1024 * 1024
+
+if INotify is not None:
+    INPUT_WATCH_FLAGS = (inotify_flags.CREATE | inotify_flags.MOVED_TO |
+                         inotify_flags.DELETE | inotify_flags.MOVED_FROM)
+    FOLDER_WATCH_FLAGS = (inotify_flags.CREATE | inotify_flags.MOVED_TO |
+                          inotify_flags.MODIFY | inotify_flags.CLOSE_WRITE)
 
 # Function to connect to PostgreSQL database
 def connect_to_database():
@@ -19,7 +188,7 @@ def connect_to_database():
         )
         return connection
     except (Exception, psycopg2.Error) as error:
-        print(f"Error while connecting to PostgreSQL: {error}")
+        logger.error(f"Error while connecting to PostgreSQL: {error}")
         return None
 
 # Function to create tables for storing study and image metadata
@@ -27,11 +196,20 @@ def create_metadata_tables(connection):
     create_studies_table_query = '''
         CREATE TABLE IF NOT EXISTS studies (
             id SERIAL PRIMARY KEY,
-            patient_id VARCHAR(10) NOT NULL,
+            patient_id VARCHAR(64) NOT NULL,
             modality VARCHAR(50),
             folderpath VARCHAR(255) NOT NULL,
             timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            compressed BOOLEAN DEFAULT FALSE
+            compressed BOOLEAN DEFAULT FALSE,
+            codec VARCHAR(16),
+            codec_dictionary VARCHAR(255),
+            study_instance_uid VARCHAR(64),
+            study_date DATE,
+            body_part VARCHAR(64),
+            study_description VARCHAR(255),
+            size_bytes BIGINT,
+            last_accessed TIMESTAMP,
+            tar_size BIGINT
         )
     '''
     create_images_table_query = '''
@@ -39,22 +217,428 @@ def create_metadata_tables(connection):
             id SERIAL PRIMARY KEY,
             study_id INTEGER REFERENCES studies(id),
             filename VARCHAR(255) NOT NULL,
-            filepath VARCHAR(255) NOT NULL
+            filepath VARCHAR(255) NOT NULL,
+            sop_instance_uid VARCHAR(64),
+            series_instance_uid VARCHAR(64),
+            tags JSONB,
+            sha256 VARCHAR(64),
+            archive_offset BIGINT,
+            archive_length BIGINT
+        )
+    '''
+    # Content-addressed store of DICOM instances. Each distinct instance is kept once,
+    # compressed, under its SHA-256; refcount is the number of images rows whose
+    # filepath points at it, and released_at when it last dropped to zero.
+    create_blobs_table_query = '''
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 VARCHAR(64) PRIMARY KEY,
+            path VARCHAR(255) NOT NULL,
+            codec VARCHAR(16) NOT NULL,
+            size BIGINT NOT NULL,
+            stored_size BIGINT NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            released_at TIMESTAMP
+        )
+    '''
+    create_study_events_table_query = '''
+        CREATE TABLE IF NOT EXISTS study_events (
+            id BIGSERIAL PRIMARY KEY,
+            study_id INTEGER REFERENCES studies(id),
+            event VARCHAR(32) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    '''
+    create_storage_usage_table_query = '''
+        CREATE TABLE IF NOT EXISTS storage_usage (
+            id BIGSERIAL PRIMARY KEY,
+            directory VARCHAR(255) NOT NULL,
+            sampled_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            used_bytes BIGINT NOT NULL,
+            total_bytes BIGINT NOT NULL
         )
     '''
+    # Journal of archive jobs. Each stage is committed before the next one starts and can
+    # be repeated safely, so a job interrupted by a crash is resumed from its last stage:
+    #   queued   - the study was picked for archiving; its archives may be partly written
+    #   written  - every archive is complete and fsynced at archive_paths
+    #   recorded - the studies row points at the archive (set in the same transaction)
+    #   done     - the short-term folder has been removed
+    #   failed   - the archives could not be written; retried after ARCHIVE_RETRY_SECONDS
+    create_archive_jobs_table_query = '''
+        CREATE TABLE IF NOT EXISTS archive_jobs (
+            id SERIAL PRIMARY KEY,
+            study_id INTEGER NOT NULL REFERENCES studies(id),
+            source_path VARCHAR(255) NOT NULL,
+            destinations TEXT[] NOT NULL,
+            codec VARCHAR(16),
+            codec_dictionary VARCHAR(255),
+            archive_paths TEXT[],
+            stage VARCHAR(16) NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 1,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    '''
+    # Study folders loaded by bulk_import.py, so an interrupted import resumes where it stopped
+    create_bulk_imports_table_query = '''
+        CREATE TABLE IF NOT EXISTS bulk_imports (
+            source_root VARCHAR(255) NOT NULL,
+            study_path VARCHAR(255) NOT NULL,
+            study_id INTEGER REFERENCES studies(id),
+            imported_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (source_root, study_path)
+        )
+    '''
+    # Downsampled previews of one slice per series, one row per size
+    create_previews_table_query = '''
+        CREATE TABLE IF NOT EXISTS previews (
+            id SERIAL PRIMARY KEY,
+            study_id INTEGER REFERENCES studies(id),
+            series_instance_uid VARCHAR(64),
+            sop_instance_uid VARCHAR(64),
+            size INTEGER NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            format VARCHAR(8) NOT NULL,
+            path VARCHAR(255) NOT NULL
+        )
+    '''
+    # Bring tables created by older versions up to date
+    upgrade_queries = [
+        "ALTER TABLE studies ADD COLUMN IF NOT EXISTS codec VARCHAR(16)",
+        "ALTER TABLE studies ADD COLUMN IF NOT EXISTS codec_dictionary VARCHAR(255)",
+        "UPDATE studies SET codec = 'gzip' WHERE compressed AND codec IS NULL",
+        "ALTER TABLE studies ALTER COLUMN patient_id TYPE VARCHAR(64)",
+        "ALTER TABLE studies ADD COLUMN IF NOT EXISTS study_instance_uid VARCHAR(64)",
+        "ALTER TABLE studies ADD COLUMN IF NOT EXISTS study_date DATE",
+        "ALTER TABLE studies ADD COLUMN IF NOT EXISTS body_part VARCHAR(64)",
+        "ALTER TABLE studies ADD COLUMN IF NOT EXISTS study_description VARCHAR(255)",
+        "ALTER TABLE studies ADD COLUMN IF NOT EXISTS size_bytes BIGINT",
+        "ALTER TABLE studies ADD COLUMN IF NOT EXISTS last_accessed TIMESTAMP",
+        "ALTER TABLE studies ADD COLUMN IF NOT EXISTS tar_size BIGINT",
+        "ALTER TABLE images ADD COLUMN IF NOT EXISTS sop_instance_uid VARCHAR(64)",
+        "ALTER TABLE images ADD COLUMN IF NOT EXISTS series_instance_uid VARCHAR(64)",
+        "ALTER TABLE images ADD COLUMN IF NOT EXISTS tags JSONB",
+        "ALTER TABLE images ADD COLUMN IF NOT EXISTS sha256 VARCHAR(64)",
+        "ALTER TABLE images ADD COLUMN IF NOT EXISTS archive_offset BIGINT",
+        "ALTER TABLE images ADD COLUMN IF NOT EXISTS archive_length BIGINT",
+        "ALTER TABLE blobs ADD COLUMN IF NOT EXISTS released_at TIMESTAMP",
+    ]
+    # Indexes used to look studies and images up by their DICOM identifiers
+    create_index_queries = [
+        "CREATE INDEX IF NOT EXISTS studies_patient_id_idx ON studies (patient_id)",
+        "CREATE INDEX IF NOT EXISTS studies_study_instance_uid_idx ON studies (study_instance_uid)",
+        "CREATE INDEX IF NOT EXISTS studies_study_date_idx ON studies (study_date)",
+        # Used by the paginated, filtered study list in the web app
+        "CREATE INDEX IF NOT EXISTS studies_patient_id_pattern_idx ON studies (patient_id varchar_pattern_ops)",
+        "CREATE INDEX IF NOT EXISTS studies_modality_id_idx ON studies (modality, id DESC)",
+        "CREATE INDEX IF NOT EXISTS studies_compressed_id_idx ON studies (compressed, id DESC)",
+        "CREATE INDEX IF NOT EXISTS studies_timestamp_idx ON studies (timestamp)",
+        # Used by the tiering policy to find studies still in short-term storage
+        "CREATE INDEX IF NOT EXISTS studies_short_term_idx ON studies (timestamp) WHERE NOT compressed",
+        "CREATE INDEX IF NOT EXISTS storage_usage_directory_idx ON storage_usage (directory, sampled_at)",
+        # At most one unfinished archive job per study
+        "CREATE UNIQUE INDEX IF NOT EXISTS archive_jobs_open_idx ON archive_jobs (study_id) WHERE stage <> 'done'",
+        "CREATE INDEX IF NOT EXISTS images_study_id_idx ON images (study_id)",
+        "CREATE INDEX IF NOT EXISTS images_sop_instance_uid_idx ON images (sop_instance_uid)",
+        "CREATE INDEX IF NOT EXISTS images_series_instance_uid_idx ON images (series_instance_uid)",
+        "CREATE INDEX IF NOT EXISTS images_tags_idx ON images USING GIN (tags jsonb_path_ops)",
+        "CREATE INDEX IF NOT EXISTS images_sha256_idx ON images (sha256)",
+        # Used to find the images stored in a blob when downloading
+        "CREATE INDEX IF NOT EXISTS blobs_path_idx ON blobs (path)",
+        # Used by the pass deleting unreferenced blobs
+        "CREATE INDEX IF NOT EXISTS blobs_released_idx ON blobs (released_at) WHERE refcount <= 0",
+        "CREATE INDEX IF NOT EXISTS previews_study_id_idx ON previews (study_id, size)",
+    ]
     try:
         cursor = connection.cursor()
         cursor.execute(create_studies_table_query)
         cursor.execute(create_images_table_query)
+        cursor.execute(create_blobs_table_query)
+        cursor.execute(create_study_events_table_query)
+        cursor.execute(create_storage_usage_table_query)
+        cursor.execute(create_archive_jobs_table_query)
+        cursor.execute(create_bulk_imports_table_query)
+        cursor.execute(create_previews_table_query)
+        for query in upgrade_queries + create_index_queries:
+            cursor.execute(query)
         connection.commit()
-        print("Metadata tables created successfully.")
+        logger.info("Metadata tables created successfully.")
     except (Exception, psycopg2.Error) as error:
-        print(f"Error creating metadata tables: {error}")
+        logger.error(f"Error creating metadata tables: {error}")
+
+# Formats log records as one JSON object per line, for log collectors
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.process,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+# Function to send the log to stderr at the given level, as text or JSON lines
+def configure_logging(level=LOG_LEVEL, log_format=LOG_FORMAT):
+    handler = logging.StreamHandler()
+    if log_format == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    logging.basicConfig(level=level, handlers=[handler], force=True)
+
+# Prometheus metrics of the pipeline: how long each stage takes, counts of what went
+# through it and how deep its queues are. Stages run in worker processes are timed
+# there and reported back with their results. Every method does nothing when
+# prometheus_client is not installed.
+class PipelineMetrics:
+    def __init__(self):
+        self.enabled = prometheus_client is not None
+        if not self.enabled:
+            return
+        self.stage_seconds = prometheus_client.Histogram('archiver_stage_seconds', 'Time spent in each pipeline stage',
+                                                         ['stage'], buckets=STAGE_SECONDS_BUCKETS)
+        self.events = prometheus_client.Counter('archiver_events_total', 'Studies, instances and jobs processed',
+                                                ['event'])
+        self.bytes = prometheus_client.Counter('archiver_bytes_total', 'Bytes ingested and archived', ['stage'])
+        self.queue_depth = prometheus_client.Gauge('archiver_queue_depth', 'Work waiting or in progress',
+                                                   ['queue'])
+        self.ingest_seconds = prometheus_client.Histogram('archiver_ingest_seconds',
+                                                          'Time from arrival to registration by priority class',
+                                                          ['priority'], buckets=STAGE_SECONDS_BUCKETS)
+
+    def observe(self, stage, seconds):
+        if self.enabled:
+            self.stage_seconds.labels(stage).observe(seconds)
+
+    def observe_ingest(self, priority, seconds):
+        if self.enabled:
+            self.ingest_seconds.labels(priority).observe(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start_time)
 
-# Function to generate a random patient ID
+    def count(self, event, amount=1):
+        if self.enabled and amount:
+            self.events.labels(event).inc(amount)
+
+    def count_bytes(self, stage, amount):
+        if self.enabled and amount:
+            self.bytes.labels(stage).inc(amount)
+
+    # Function to report a queue's depth by calling depth() whenever metrics are scraped
+    def track_queue(self, queue, depth):
+        if self.enabled:
+            self.queue_depth.labels(queue).set_function(depth)
+
+    def serve(self, port):
+        if not self.enabled:
+            logger.warning("prometheus_client is not installed, metrics are not served.")
+            return
+        prometheus_client.start_http_server(port)
+        logger.info(f"Serving metrics on port {port}.")
+
+metrics = PipelineMetrics()
+
+# Durations of the stages of the job an archive worker process is running, sent back with its result
+worker_timings = {}
+
+# Function to generate a patient ID for studies whose headers do not carry one
 def generate_patient_id():
-    # Generate a random 4-digit patient ID
-    return str(random.randint(1000, 9999))
+    # Random UUIDs do not collide the way the old random 4-digit IDs did
+    return 'ANON-' + uuid.uuid4().hex[:16].upper()
+
+# Function to convert a DICOM DA value (YYYYMMDD) to a date, or None if it is not a valid date
+def parse_dicom_date(value):
+    try:
+        return datetime.strptime(str(value), '%Y%m%d').date()
+    except ValueError:
+        return None
+
+# Function to get a header element as a plain string, or None if it is missing or empty
+def header_text(dataset, keyword):
+    value = dataset.get(keyword)
+    if value is None:
+        return None
+    return str(value).strip() or None
+
+# Reads DICOM headers with a single read into a buffer that is reused for every file,
+# so parsing a header costs one open and one read and never touches the pixel data.
+# Headers that do not fit in the buffer are read from the file with large elements
+# deferred. Not thread-safe: use one reader per thread or process.
+class HeaderReader:
+    def __init__(self, read_size=HEADER_READ_SIZE):
+        self.buffer = bytearray(read_size)
+
+    def read(self, dicom_path):
+        with open(dicom_path, 'rb', buffering=0) as f:
+            bytes_read = f.readinto(self.buffer)
+        stream = io.BytesIO(memoryview(self.buffer)[:bytes_read])
+        dataset = pydicom.dcmread(stream, stop_before_pixels=True)
+        # Parsing stops early at the pixel data; reaching the end of the buffer means
+        # the header was cut off, unless the buffer already held the whole file
+        if stream.tell() < bytes_read or bytes_read < len(self.buffer):
+            return dataset
+        return pydicom.dcmread(dicom_path, stop_before_pixels=True, defer_size=HEADER_DEFER_SIZE)
+
+header_reader = HeaderReader()
+
+# Function to decode the raw little endian value of a header element to DICOM JSON for
+# the tag store. Returns None when the value is left to pydicom.
+def tag_store_element(vr, value):
+    if vr in TAG_STORE_BINARY_NUMBER_FORMATS:
+        number_format = TAG_STORE_BINARY_NUMBER_FORMATS[vr]
+        count, remainder = divmod(len(value), struct.calcsize('<' + number_format))
+        if remainder:
+            return None
+        return {'vr': vr, 'Value': list(struct.unpack('<' + number_format * count, value))}
+    if vr in TAG_STORE_BINARY_VRS:
+        # Larger values would take more than TAG_STORE_MAX_ELEMENT_BYTES in base64
+        if len(value) > TAG_STORE_MAX_ELEMENT_BYTES // 4 * 3:
+            return None
+        return {'vr': vr, 'InlineBinary': base64.b64encode(value).decode('ascii')}
+    # Other text depends on the character set; ISO 2022 escape sequences are ASCII
+    if not value.isascii() or b'\x1b' in value:
+        return None
+    text = value.decode('ascii')
+    if not text.strip(' \x00'):
+        return {'vr': vr}
+    if vr in TAG_STORE_STRING_VRS:
+        values = text.rstrip(' \x00').split('\\')
+    elif vr in TAG_STORE_TEXT_VRS:
+        values = [v.rstrip(' \x00') for v in text.split('\\')]
+    elif vr in TAG_STORE_SINGLE_TEXT_VRS:
+        values = [text.rstrip(' \x00')]
+    elif vr == 'AE':
+        values = [v.strip() for v in text.split('\\')]
+    elif vr == 'PN':
+        if '=' in text:
+            return None
+        values = [{'Alphabetic': v} for v in text.rstrip(' \x00').split('\\')]
+    else:
+        try:
+            if vr == 'IS':
+                values = [int(v) for v in text.split('\\')]
+            else:
+                values = [float(v) for v in text.strip().split('\\')]
+        except ValueError:
+            return None
+    return {'vr': vr, 'Value': values}
+
+# Function to convert the small elements of a header to DICOM JSON for the tag store.
+# Walks the elements as they were read and decodes the common ones from their raw
+# bytes, so the header is not converted element by element and then to JSON again.
+# Deferred elements are not loaded.
+def build_tag_store(dataset):
+    tags = {}
+    little_endian = dataset.original_encoding[1] is not False
+    for tag, element in dataset.items():
+        length = getattr(element, 'length', 0)
+        if length != 0xFFFFFFFF and length > TAG_STORE_MAX_ELEMENT_BYTES:
+            continue
+        raw = isinstance(element, RawDataElement)
+        if element.VR == 'SQ' and not raw:
+            tags[f'{tag:08X}'] = {'vr': 'SQ', 'Value': [build_tag_store(item) for item in element.value]}
+            continue
+        json_element = None
+        if raw and little_endian:
+            vr = element.VR
+            if vr is None:
+                # Implicit VR: the VR comes from the dictionary, private elements have none
+                try:
+                    vr = dictionary_VR(tag)
+                except KeyError:
+                    vr = None
+            if vr in TAG_STORE_DECODED_VRS:
+                json_element = tag_store_element(vr, element.value) if element.value else {'vr': vr}
+        if json_element is None:
+            try:
+                json_element = dataset[tag].to_json_dict(lambda element: None, TAG_STORE_MAX_ELEMENT_BYTES)
+            except Exception:
+                continue
+            # Large binary values come back with a (missing) bulk data URI
+            if 'BulkDataURI' in json_element:
+                continue
+        tags[f'{tag:08X}'] = json_element
+    return tags
+
+# Function to read the header of a DICOM file without its pixel data.
+# Returns a dict with the indexed identifiers and the JSON form of every other small element.
+def read_dicom_header(dicom_path):
+    return header_from_dataset(header_reader.read(dicom_path))
+
+# Function to get the indexed identifiers and tag store of a dataset that is already parsed
+def header_from_dataset(dataset):
+    tags = build_tag_store(dataset)
+    return {
+        'patient_id': header_text(dataset, 'PatientID'),
+        'modality': header_text(dataset, 'Modality'),
+        'study_instance_uid': header_text(dataset, 'StudyInstanceUID'),
+        'series_instance_uid': header_text(dataset, 'SeriesInstanceUID'),
+        'sop_instance_uid': header_text(dataset, 'SOPInstanceUID'),
+        'study_date': parse_dicom_date(header_text(dataset, 'StudyDate')),
+        'body_part': header_text(dataset, 'BodyPartExamined'),
+        'study_description': header_text(dataset, 'StudyDescription'),
+        'tags': tags,
+    }
+
+# Function run in an ingest worker process: reads one header and returns (header, error)
+def read_dicom_header_in_worker(dicom_path, with_digest=False):
+    try:
+        header = read_dicom_header(dicom_path)
+        if with_digest:
+            # Reads the whole file, unlike the header itself
+            header['sha256'] = hash_file(dicom_path)
+        return header, None
+    except Exception as e:
+        return None, str(e)
+
+# Function to compute the SHA-256 of a file, the key it is kept under in the blob store
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Function run when a worker process starts: caps its address space so a burst of
+# large studies fails those jobs instead of exhausting the host. Unix only.
+def limit_worker_memory(limit_mb):
+    if resource is None or not limit_mb:
+        return
+    limit = limit_mb * 1024 * 1024
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+# Function run when an archive worker process starts: lowers its priority and limits its memory
+def start_archive_worker(niceness, memory_limit_mb):
+    if niceness and hasattr(os, 'nice'):
+        os.nice(niceness)
+    limit_worker_memory(memory_limit_mb)
+
+# Function to record a change to a study and notify listeners (the web app) about it.
+# Runs on the caller's cursor so the event commits or rolls back with the change itself;
+# PostgreSQL only delivers the notification once that transaction commits.
+def record_study_event(cursor, study_id, event):
+    cursor.execute("INSERT INTO study_events (study_id, event) VALUES (%s, %s) RETURNING id", (study_id, event))
+    event_id = cursor.fetchone()[0]
+    cursor.execute("SELECT pg_notify(%s, %s)", (STUDY_EVENTS_CHANNEL, str(event_id)))
+    return event_id
 
 # Function to insert study metadata into PostgreSQL table
 def insert_study_metadata(connection, patient_id, modality, folderpath):
@@ -68,10 +652,10 @@ def insert_study_metadata(connection, patient_id, modality, folderpath):
         cursor.execute(insert_study_query, (patient_id, modality, folderpath))
         study_id = cursor.fetchone()[0]
         connection.commit()
-        print(f"Metadata inserted for study with folderpath {folderpath}.")
+        logger.debug(f"Metadata inserted for study with folderpath {folderpath}.")
         return study_id
     except (Exception, psycopg2.Error) as error:
-        print(f"Error inserting study metadata: {error}")
+        logger.error(f"Error inserting study metadata: {error}")
         return None
 
 # Function to insert image metadata into PostgreSQL table
@@ -84,39 +668,1573 @@ def insert_image_metadata(connection, study_id, filename, filepath):
         cursor = connection.cursor()
         cursor.execute(insert_image_query, (study_id, filename, filepath))
         connection.commit()
-        print(f"Metadata inserted for image {filename}.")
+        logger.debug(f"Metadata inserted for image {filename}.")
     except (Exception, psycopg2.Error) as error:
-        print(f"Error inserting image metadata: {error}")
+        logger.error(f"Error inserting image metadata: {error}")
+
+# Function to build the studies row of a new study from the first readable header of its
+# instances, generating a patient ID if the header has none
+def study_from_header(folder_path, first_header, size_bytes):
+    patient_id = first_header.get('patient_id')
+    if patient_id is None:
+        patient_id = generate_patient_id()
+        logger.warning(f"No PatientID in study {os.path.basename(folder_path)}, generated patient ID: {patient_id}")
+    return {
+        'patient_id': patient_id,
+        'modality': first_header.get('modality'),
+        'folderpath': folder_path,
+        'study_instance_uid': first_header.get('study_instance_uid'),
+        'study_date': first_header.get('study_date'),
+        'body_part': first_header.get('body_part'),
+        'study_description': first_header.get('study_description'),
+        'size_bytes': size_bytes,
+    }
+
+# Function to insert images of a study, adding a reference to the blob of each image with
+# 'deduplicated' set; the caller commits. Returns the new image ids.
+def insert_images(cursor, study_id, images):
+    insert_images_query = '''
+        INSERT INTO images (study_id, filename, filepath, sop_instance_uid, series_instance_uid, tags, sha256)
+        VALUES %s
+        RETURNING id
+    '''
+    rows = [(study_id, image['filename'], image['filepath'], image['sop_instance_uid'],
+             image['series_instance_uid'], Json(image['tags']), image.get('sha256')) for image in images]
+    image_ids = [row[0] for row in execute_values(cursor, insert_images_query, rows, page_size=1000, fetch=True)]
+    add_blob_references(cursor, Counter(image['sha256'] for image in images if image.get('deduplicated')))
+    return image_ids
 
-# Function to compress a folder containing DICOM images using gzip
-def compress_folder(folder_path, compressed_path):
+# Function to insert a study and all of its images in a single transaction.
+# study is a dict with the studies columns (patient_id, modality, folderpath,
+# study_instance_uid, study_date, body_part, study_description, size_bytes) and images a list of
+# dicts with the images columns (filename, filepath, sop_instance_uid,
+# series_instance_uid, tags, sha256). Images with 'deduplicated' set already point at a
+# blob and add a reference to it. Returns (study_id, image_ids), or (None, []) on failure.
+def insert_study_with_images(connection, study, images):
+    insert_study_query = '''
+        INSERT INTO studies (patient_id, modality, folderpath, study_instance_uid,
+                             study_date, body_part, study_description, size_bytes)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        RETURNING id
+    '''
+    folderpath = study['folderpath']
+    start_time = time.perf_counter()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(insert_study_query, (study['patient_id'], study['modality'], folderpath,
+                                            study['study_instance_uid'], study['study_date'],
+                                            study['body_part'], study['study_description'],
+                                            study['size_bytes']))
+        study_id = cursor.fetchone()[0]
+        image_ids = insert_images(cursor, study_id, images)
+        record_study_event(cursor, study_id, 'ingested')
+        connection.commit()
+        elapsed = time.perf_counter() - start_time
+        metrics.observe('db_insert', elapsed)
+        elapsed_ms = elapsed * 1000
+        logger.info(f"Metadata inserted for study with folderpath {folderpath} and {len(image_ids)} images in {elapsed_ms:.1f} ms.")
+        return study_id, image_ids
+    except (Exception, psycopg2.Error) as error:
+        connection.rollback()
+        logger.error(f"Error inserting study and image metadata: {error}")
+        return None, []
+
+# Function to flush a directory's entries to disk (not supported on Windows)
+def sync_directory(path):
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+# Function to flush a written file and its directory entry to disk
+def sync_file(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    sync_directory(os.path.dirname(path) or '.')
+
+# Writes every chunk it receives to several files, so one compressed stream feeds all tiers
+class TeeWriter:
+    def __init__(self, files):
+        self.files = files
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+        return len(data)
+
+    def flush(self):
+        for f in self.files:
+            f.flush()
+
+# Gzip writer that compresses blocks on several threads, like pigz. Every block
+# becomes its own gzip member, so the output is readable by any gzip decoder.
+class ParallelGzipWriter:
+    def __init__(self, fileobj, level=6, threads=PGZIP_THREADS, block_size=PGZIP_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = threads * 2
+        self.pending = []
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def submit(self, block):
+        # zlib releases the GIL, so the blocks really are compressed in parallel
+        self.pending.append(self.executor.submit(gzip.compress, block, self.level))
+        while len(self.pending) >= self.max_pending:
+            self.fileobj.write(self.pending.pop(0).result())
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer or not self.pending:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        for future in self.pending:
+            self.fileobj.write(future.result())
+        self.pending = []
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Function to load the zstd dictionary a codec was configured with
+def load_zstd_dictionary(dictionary_path):
+    if dictionary_path is None:
+        return None
+    with open(dictionary_path, 'rb') as f:
+        return zstandard.ZstdCompressionDict(f.read())
+
+# Function to train a zstd dictionary from sample files and save it to output_path
+def train_zstd_dictionary(sample_paths, output_path, dict_size=112640):
+    samples = []
+    for sample_path in sample_paths:
+        with open(sample_path, 'rb') as f:
+            samples.append(f.read())
+    dictionary = zstandard.train_dictionary(dict_size, samples)
+    with open(output_path, 'wb') as f:
+        f.write(dictionary.as_bytes())
+    return output_path
+
+def gzip_writer(fileobj, level, dictionary_path):
+    return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=level)
+
+def gzip_reader(fileobj, dictionary_path):
+    return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+def pgzip_writer(fileobj, level, dictionary_path):
+    return ParallelGzipWriter(fileobj, level)
+
+def zstd_writer(fileobj, level, dictionary_path):
+    compressor = zstandard.ZstdCompressor(level=level, dict_data=load_zstd_dictionary(dictionary_path))
+    return compressor.stream_writer(fileobj, closefd=False)
+
+def zstd_reader(fileobj, dictionary_path):
+    decompressor = zstandard.ZstdDecompressor(dict_data=load_zstd_dictionary(dictionary_path))
+    return decompressor.stream_reader(fileobj, closefd=False)
+
+def lz4_writer(fileobj, level, dictionary_path):
+    return lz4.frame.LZ4FrameFile(fileobj, mode='wb', compression_level=level)
+
+def lz4_reader(fileobj, dictionary_path):
+    return lz4.frame.LZ4FrameFile(fileobj, mode='rb')
+
+# Codecs available for archives. The codec of every archive is stored in the
+# studies table so it is always read back with the matching decoder.
+CODECS = {
+    'gzip': {'extension': '.tar.gz', 'blob_extension': '.gz', 'default_level': 9,
+             'writer': gzip_writer, 'reader': gzip_reader},
+    'pgzip': {'extension': '.tar.gz', 'blob_extension': '.gz', 'default_level': 6,
+              'writer': pgzip_writer, 'reader': gzip_reader},
+    'zstd': {'extension': '.tar.zst', 'blob_extension': '.zst', 'default_level': 3,
+             'writer': zstd_writer, 'reader': zstd_reader},
+    'lz4': {'extension': '.tar.lz4', 'blob_extension': '.lz4', 'default_level': 0,
+            'writer': lz4_writer, 'reader': lz4_reader},
+}
+
+# Lossless transfer syntaxes the Pixel Data of archived instances can be re-encoded to
+DICOM_CODECS = {
+    'rle': RLELossless,
+    'jpegls': JPEGLSLossless,
+}
+
+# Archive formats with an index of where each instance starts. Every instance is a
+# separately deflated zip member, and the offset and length of its compressed data are
+# stored with its images row, so one instance is read with one seek however large the study.
+INDEXED_CODECS = {
+    'zip': {'extension': '.zip'},
+}
+
+# Function to check whether the libraries a codec needs are installed
+def codec_available(codec):
+    if codec in INDEXED_CODECS:
+        return True
+    if codec == 'blobs':
+        return codec_available(BLOB_CODEC)
+    if codec in DICOM_CODECS:
+        return get_encoder(DICOM_CODECS[codec]).is_available
+    if codec == 'zstd':
+        return zstandard is not None
+    if codec == 'lz4':
+        return lz4 is not None
+    return codec in CODECS
+
+# Function to wrap a binary file object in the compressing writer of a codec
+def open_codec_writer(codec, fileobj, level=None, dictionary_path=None):
+    if not codec_available(codec):
+        raise ValueError(f"Codec {codec} is not available")
+    if level is None:
+        level = CODECS[codec]['default_level']
+    return CODECS[codec]['writer'](fileobj, level, dictionary_path)
+
+# Function to wrap a binary file object in the decompressing reader of a codec
+def open_codec_reader(codec, fileobj, dictionary_path=None):
+    if not codec_available(codec):
+        raise ValueError(f"Codec {codec} is not available")
+    return CODECS[codec]['reader'](fileobj, dictionary_path)
+
+# Function to get the path a blob is stored at: its hash split into two levels of
+# folders, so no folder holds more than a few thousand entries
+def blob_path(blob_directory, digest, codec):
+    return os.path.join(blob_directory, digest[:2], digest[2:4], digest + CODECS[codec]['blob_extension'])
+
+# Function to find a blob on disk whatever codec it was written with, as (path, codec) or (None, None)
+def find_blob(blob_directory, digest):
+    for codec in CODECS:
+        path = blob_path(blob_directory, digest, codec)
+        if os.path.exists(path):
+            return path, codec
+    return None, None
+
+# Function to add every instance of a study folder to the blob store of every tier, one
+# blob directory per tier. Instances a tier already stores are not written there again,
+# and an instance is compressed once for all the tiers missing it. Each new blob is
+# written to a temporary file that is renamed into place once it is on disk. digests maps
+# file names to SHA-256 digests already computed, which are not computed again. Returns a
+# list of dicts (filename, sha256, size, path, codec, stored_size) for the blobs of the
+# first tier, or None on failure.
+def store_study_blobs(folder_path, blob_directories, codec='gzip', level=None, digests=None):
+    stored = []
+    new_blobs = 0
+    files = []
+    temp_paths = []
     try:
-        shutil.make_archive(compressed_path, 'gztar', folder_path)
-        print(f"Folder {folder_path} compressed successfully.")
+        for dicom_file in sorted(os.listdir(folder_path)):
+            dicom_path = os.path.join(folder_path, dicom_file)
+            if not os.path.isfile(dicom_path):
+                continue
+            digest = (digests or {}).get(dicom_file) or hash_file(dicom_path)
+            found = [find_blob(blob_directory, digest) for blob_directory in blob_directories]
+            missing = [blob_path(blob_directory, digest, codec)
+                       for blob_directory, (path, _) in zip(blob_directories, found) if path is None]
+            if missing:
+                # Another worker may be writing the same blob; each uses its own temporary
+                # file, and as the contents are identical the last rename wins harmlessly
+                temp_paths = [f"{path}.{os.getpid()}.tmp" for path in missing]
+                for temp_path in temp_paths:
+                    os.makedirs(os.path.dirname(temp_path), exist_ok=True)
+                    files.append(open(temp_path, 'wb'))
+                with open(dicom_path, 'rb') as source:
+                    with open_codec_writer(codec, TeeWriter(files), level) as stream:
+                        shutil.copyfileobj(source, stream, 1024 * 1024)
+                for f in files:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    f.close()
+                files = []
+                for temp_path, path in zip(temp_paths, missing):
+                    os.replace(temp_path, path)
+                    sync_directory(os.path.dirname(path))
+                temp_paths = []
+                new_blobs += 1
+            path, blob_codec = found[0] if found[0][0] is not None else (blob_path(blob_directories[0], digest, codec),
+                                                                         codec)
+            stored.append({
+                'filename': dicom_file,
+                'sha256': digest,
+                'size': os.path.getsize(dicom_path),
+                'path': path,
+                'codec': blob_codec,
+                'stored_size': os.path.getsize(path),
+            })
+        logger.debug(f"Folder {folder_path} stored as {len(stored)} blobs, {new_blobs} of them new.")
+        return stored
     except Exception as e:
-        print(f"Error compressing folder {folder_path}: {e}")
+        logger.error(f"Error storing folder {folder_path} in the blob store: {e}")
+        for f in files:
+            f.close()
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return None
+
+# Function to look up which of the given hashes are already in the blob store, as {sha256: path}
+def find_stored_blobs(connection, digests):
+    if not digests:
+        return {}
+    try:
+        cursor = connection.cursor()
+        cursor.execute("SELECT sha256, path FROM blobs WHERE sha256 = ANY(%s)", (list(digests),))
+        stored = dict(cursor.fetchall())
+        connection.rollback()
+        return stored
+    except (Exception, psycopg2.Error) as error:
+        connection.rollback()
+        logger.error(f"Error looking up stored blobs: {error}")
+        return {}
+
+# Function to add references to blobs, given a Counter of sha256 -> new references; the caller commits
+def add_blob_references(cursor, references):
+    if references:
+        execute_values(cursor, '''
+            UPDATE blobs SET refcount = blobs.refcount + v.added, released_at = NULL
+            FROM (VALUES %s) AS v (sha256, added)
+            WHERE blobs.sha256 = v.sha256
+        ''', list(references.items()))
+
+# Function to drop references to blobs, given a Counter of blob path -> references dropped.
+# Paths that are not blobs are ignored. The caller commits.
+def release_blob_references(cursor, references):
+    if references:
+        execute_values(cursor, '''
+            UPDATE blobs SET refcount = blobs.refcount - v.released,
+                released_at = CASE WHEN blobs.refcount - v.released <= 0 THEN LOCALTIMESTAMP END
+            FROM (VALUES %s) AS v (path, released)
+            WHERE blobs.path = v.path
+        ''', list(references.items()))
+
+# Function to delete the blobs no image has referred to for BLOB_GC_GRACE_SECONDS, from
+# the blobs table and from the blob store of every tier. Blob paths in the table are in
+# the first tier. Returns the number of blobs deleted.
+def collect_unused_blobs(connection, tier_directories):
+    try:
+        cursor = connection.cursor()
+        cursor.execute('''
+            DELETE FROM blobs
+            WHERE refcount <= 0 AND released_at < LOCALTIMESTAMP - %s * INTERVAL '1 second'
+            RETURNING path
+        ''', (BLOB_GC_GRACE_SECONDS,))
+        paths = [path for (path,) in cursor.fetchall()]
+        connection.commit()
+    except (Exception, psycopg2.Error) as error:
+        connection.rollback()
+        logger.error(f"Error collecting unused blobs: {error}")
+        return 0
+    first_blob_directory = os.path.join(tier_directories[0], BLOB_DIRECTORY_NAME)
+    for path in paths:
+        relative_path = os.path.relpath(path, first_blob_directory)
+        for tier_directory in tier_directories:
+            try:
+                os.remove(os.path.join(tier_directory, BLOB_DIRECTORY_NAME, relative_path))
+            except FileNotFoundError:
+                pass
+    if paths:
+        logger.info(f"Deleted {len(paths)} blobs no image refers to any more.")
+    return len(paths)
+
+# Function to add newly written blobs to the blobs table, with no references yet; the caller commits
+def insert_blobs(cursor, stored_blobs):
+    if stored_blobs:
+        execute_values(cursor, '''
+            INSERT INTO blobs (sha256, path, codec, size, stored_size)
+            VALUES %s
+            ON CONFLICT (sha256) DO NOTHING
+        ''', [(blob['sha256'], blob['path'], blob['codec'], blob['size'], blob['stored_size'])
+              for blob in stored_blobs])
+
+# Function to record the blobs a study was stored as and point its images at them; the
+# caller commits. Images already pointing at their blob are not counted twice, and an
+# image that pointed at another blob drops its reference to it.
+def record_study_blobs(cursor, study_id, stored_blobs):
+    if not stored_blobs:
+        return
+    insert_blobs(cursor, stored_blobs)
+    updated = execute_values(cursor, '''
+        WITH v (study_id, filename, sha256, path) AS (VALUES %s),
+        previous AS (
+            SELECT images.id, images.filepath
+            FROM images JOIN v ON images.study_id = v.study_id AND images.filename = v.filename
+            WHERE images.filepath <> v.path
+            FOR UPDATE OF images
+        )
+        UPDATE images SET filepath = v.path, sha256 = v.sha256
+        FROM v, previous
+        WHERE images.id = previous.id AND images.study_id = v.study_id AND images.filename = v.filename
+        RETURNING images.sha256, previous.filepath
+    ''', [(study_id, blob['filename'], blob['sha256'], blob['path']) for blob in stored_blobs], fetch=True)
+    add_blob_references(cursor, Counter(digest for digest, _ in updated))
+    release_blob_references(cursor, Counter(previous_path for _, previous_path in updated))
+
+# Function to get the Instance Number of an image from its tag store, or None
+def instance_number(image):
+    values = (image['tags'] or {}).get('00200013', {}).get('Value')
+    return values[0] if values else None
+
+# Function to pick the slice each series is previewed with: the middle one by Instance Number.
+# Instances without pixel data (no Rows element) are not previewed.
+def representative_images(images):
+    series = {}
+    for image in images:
+        if image['tags'] is not None and '00280010' in image['tags']:
+            series.setdefault(image['series_instance_uid'], []).append(image)
+    representatives = []
+    for series_images in series.values():
+        series_images.sort(key=lambda image: (instance_number(image) is None, instance_number(image) or 0,
+                                              image['filename']))
+        representatives.append(series_images[len(series_images) // 2])
+    return representatives
+
+# Function to shrink an image by averaging factor x factor blocks of pixels
+def downsample(pixels, factor):
+    if factor <= 1:
+        return pixels
+    height = pixels.shape[0] // factor * factor
+    width = pixels.shape[1] // factor * factor
+    blocks = pixels[:height, :width].reshape((height // factor, factor, width // factor, factor) + pixels.shape[2:])
+    return blocks.mean(axis=(1, 3))
+
+# Function to map stored pixel values to 8-bit display values: the rescale to modality
+# units, then the header's window (or the 1st to 99th percentile when it has none)
+def window_pixels(dataset, pixels):
+    if pixels.ndim == 3:
+        # Colour images are shown as they are, scaled down to 8 bits if stored with more
+        bits = dataset.get('BitsStored', 8)
+        return np.clip(pixels / (2 ** (bits - 8)), 0, 255).astype(np.uint8)
+    pixels = pixels * float(dataset.get('RescaleSlope', 1) or 1) + float(dataset.get('RescaleIntercept', 0) or 0)
+    center = dataset.get('WindowCenter')
+    width = dataset.get('WindowWidth')
+    if center is not None and width is not None:
+        # Multi-valued windows are alternatives; the first is the default
+        center = float(np.ravel(center)[0])
+        width = float(np.ravel(width)[0])
+    else:
+        low, high = np.percentile(pixels, (1, 99))
+        center = (low + high) / 2
+        width = high - low + 1
+    pixels = np.clip((pixels - (center - 0.5)) / max(width - 1, 1) + 0.5, 0, 1)
+    if dataset.get('PhotometricInterpretation') == 'MONOCHROME1':
+        pixels = 1 - pixels
+    return (pixels * 255 + 0.5).astype(np.uint8)
+
+# Function to encode an 8-bit greyscale or RGB image as PNG, needing nothing but zlib
+def encode_png(pixels):
+    height, width = pixels.shape[:2]
+    color_type = 2 if pixels.ndim == 3 else 0
+    # Every row starts with its filter type, 0 for none
+    rows = np.hstack([np.zeros((height, 1), np.uint8), pixels.reshape(height, -1)])
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows.tobytes(), 9)) +
+            chunk(b'IEND', b''))
 
-# Function to update study metadata in the database
-def update_study_metadata(connection, original_path, new_path):
+# Function to encode a preview in the given format, falling back to PNG without Pillow.
+# Returns (data, format).
+def encode_preview(pixels, image_format):
+    if image_format == 'webp' and Image is not None:
+        output = io.BytesIO()
+        Image.fromarray(pixels).save(output, format='WEBP', quality=PREVIEW_WEBP_QUALITY)
+        return output.getvalue(), 'webp'
+    return encode_png(pixels), 'png'
+
+# Function run in an ingest worker process: renders the preview pyramid of one slice,
+# writing output_prefix_<size>.<format> for each size. Only the middle frame of a
+# multi-frame instance is decoded. Returns (previews, error).
+def render_previews_in_worker(dicom_path, output_prefix, sizes=PREVIEW_SIZES, image_format=PREVIEW_FORMAT):
+    try:
+        dataset = header_reader.read(dicom_path)
+        frames = int(dataset.get('NumberOfFrames') or 1)
+        pixels = pixel_array(dicom_path, index=frames // 2 if frames > 1 else None).astype(np.float32)
+
+        previews = []
+        # Each level is made from the next larger one, so the full image is only read once
+        for size in sorted(sizes, reverse=True):
+            pixels = downsample(pixels, -(-max(pixels.shape[:2]) // size))
+            data, preview_format = encode_preview(window_pixels(dataset, pixels), image_format)
+            path = f"{output_prefix}_{size}.{preview_format}"
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            previews.append({'size': size, 'width': pixels.shape[1], 'height': pixels.shape[0],
+                             'format': preview_format, 'path': path})
+        return previews, None
+    except Exception as e:
+        return None, str(e)
+
+# Function to render the previews of a study, using the ingest workers if given. Preview
+# files are named after the instance they show. Returns the rows for the previews table.
+def render_study_previews(study_id, folder_path, images, preview_directory, header_pool=None):
+    representatives = representative_images(images)
+    if not representatives:
+        return []
+    study_preview_directory = os.path.join(preview_directory, str(study_id))
+    os.makedirs(study_preview_directory, exist_ok=True)
+    # Instances already in the blob store are still in the study folder at this point
+    dicom_paths = [os.path.join(folder_path, image['filename']) for image in representatives]
+    output_prefixes = [os.path.join(study_preview_directory, image['sop_instance_uid'] or image['filename'])
+                       for image in representatives]
+    if header_pool is not None:
+        results = header_pool.map(render_previews_in_worker, dicom_paths, output_prefixes)
+    else:
+        results = map(render_previews_in_worker, dicom_paths, output_prefixes)
+
+    rows = []
+    for image, dicom_path, (previews, error) in zip(representatives, dicom_paths, results):
+        if previews is None:
+            logger.warning(f"Could not render a preview of {dicom_path}: {error}")
+            continue
+        rows.extend((study_id, image['series_instance_uid'], image['sop_instance_uid'], preview['size'],
+                     preview['width'], preview['height'], preview['format'], preview['path'])
+                    for preview in previews)
+    return rows
+
+# Function to render and record the previews of a newly registered study, using the
+# ingest workers
+def generate_study_previews(connection, study_id, folder_path, images, preview_directory, header_pool=None):
+    rows = render_study_previews(study_id, folder_path, images, preview_directory, header_pool)
+    if not rows:
+        return
+    try:
+        cursor = connection.cursor()
+        execute_values(cursor, '''
+            INSERT INTO previews (study_id, series_instance_uid, sop_instance_uid, size, width, height, format, path)
+            VALUES %s
+        ''', rows)
+        connection.commit()
+    except (Exception, psycopg2.Error) as error:
+        connection.rollback()
+        logger.error(f"Error recording previews of study {study_id}: {error}")
+
+# Function to make archives written to temporary files durable on every tier and rename
+# them into place. The time it takes is the tier write time of the job.
+def commit_archive_files(files, temp_paths, archive_paths):
+    start_time = time.perf_counter()
+    for f in files:
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+    for temp_path, archive_path in zip(temp_paths, archive_paths):
+        os.replace(temp_path, archive_path)
+        sync_file(archive_path)
+    worker_timings['tier_write'] = time.perf_counter() - start_time
+
+# Function to compress a folder containing DICOM images with the given codec.
+# The folder is read and compressed once and the result is written to every
+# compressed_path plus the codec's extension. Each copy goes to a temporary file
+# that is renamed into place once it is on disk. Returns the archive paths or None.
+def compress_folder(folder_path, compressed_paths, codec='gzip', level=None, dictionary_path=None):
+    archive_paths = [compressed_path + CODECS[codec]['extension'] for compressed_path in compressed_paths]
+    temp_paths = [archive_path + '.tmp' for archive_path in archive_paths]
+    files = []
+    try:
+        for temp_path in temp_paths:
+            files.append(open(temp_path, 'wb'))
+        with open_codec_writer(codec, TeeWriter(files), level, dictionary_path) as stream:
+            with tarfile.open(fileobj=stream, mode='w|') as tar:
+                tar.add(folder_path, arcname='.')
+        commit_archive_files(files, temp_paths, archive_paths)
+        logger.debug(f"Folder {folder_path} compressed successfully.")
+        return archive_paths
+    except Exception as e:
+        logger.error(f"Error compressing folder {folder_path}: {e}")
+        for f in files:
+            f.close()
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return None
+
+# Function to work out the size of the tar compress_folder writes for a folder from the
+# file sizes alone, without reading the files: each member's header and data rounded up
+# to whole blocks, the two empty blocks that end the tar and the padding to a whole record.
+# The web app needs it to answer Range requests on a tarball it decompresses as it sends.
+def folder_tar_size(folder_path):
+    with tarfile.open(fileobj=io.BytesIO(), mode='w|') as tar:
+        size = 0
+        # Members in the order tar.add() writes them
+        pending = [(folder_path, '.')]
+        while pending:
+            path, arcname = pending.pop()
+            tarinfo = tar.gettarinfo(path, arcname)
+            if tarinfo is None:
+                continue
+            size += len(tarinfo.tobuf(tar.format, tar.encoding, tar.errors))
+            if tarinfo.isreg():
+                size += -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            elif tarinfo.isdir():
+                pending.extend((os.path.join(path, name), os.path.join(arcname, name))
+                               for name in sorted(os.listdir(path), reverse=True))
+    size += 2 * tarfile.BLOCKSIZE
+    return size + -size % tarfile.RECORDSIZE
+
+# Function to archive a study as a zip with every instance deflated on its own. The zip
+# is written once and teed to every compressed_path plus '.zip', through temporary files
+# that are renamed into place once on disk. Returns the archive paths or None.
+def compress_study_indexed(folder_path, compressed_paths, level=None):
+    archive_paths = [compressed_path + INDEXED_CODECS['zip']['extension'] for compressed_path in compressed_paths]
+    temp_paths = [archive_path + '.tmp' for archive_path in archive_paths]
+    files = []
+    try:
+        for temp_path in temp_paths:
+            files.append(open(temp_path, 'wb'))
+        with zipfile.ZipFile(TeeWriter(files), 'w', compression=zipfile.ZIP_DEFLATED,
+                             compresslevel=level) as zip_file:
+            for dicom_file in sorted(os.listdir(folder_path)):
+                dicom_path = os.path.join(folder_path, dicom_file)
+                if os.path.isfile(dicom_path):
+                    zip_file.write(dicom_path, arcname=dicom_file)
+        commit_archive_files(files, temp_paths, archive_paths)
+        logger.debug(f"Folder {folder_path} compressed into an indexed archive successfully.")
+        return archive_paths
+    except Exception as e:
+        logger.error(f"Error compressing folder {folder_path}: {e}")
+        for f in files:
+            f.close()
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return None
+
+# Function to read where each member's compressed data lies in an indexed archive, as
+# {filename: (offset, length)}. Reads the central directory and one local header per member.
+def read_archive_index(archive_path):
+    index = {}
+    with open(archive_path, 'rb') as f, zipfile.ZipFile(f) as zip_file:
+        for info in zip_file.infolist():
+            f.seek(info.header_offset)
+            header = f.read(30)
+            # Local file header: signature, ..., file name length and extra field length
+            if header[:4] != b'PK\x03\x04':
+                raise ValueError(f"Bad local header for {info.filename} in {archive_path}")
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            index[info.filename] = (info.header_offset + 30 + name_length + extra_length, info.compress_size)
+    return index
+
+# Function to store where each instance of a study lies in its indexed archive; the caller commits
+def record_archive_index(cursor, study_id, archive_index):
+    if archive_index:
+        execute_values(cursor, '''
+            UPDATE images SET archive_offset = v.archive_offset, archive_length = v.archive_length
+            FROM (VALUES %s) AS v (study_id, filename, archive_offset, archive_length)
+            WHERE images.study_id = v.study_id AND images.filename = v.filename
+        ''', [(study_id, filename, offset, length) for filename, (offset, length) in archive_index.items()])
+
+# Function to re-encode the Pixel Data of a DICOM file into a lossless transfer syntax.
+# The decoded pixels are compared with the originals before the result is accepted.
+# Returns the bytes of the new DICOM file.
+def encode_dicom_lossless(dicom_path, transfer_syntax):
+    dataset = pydicom.dcmread(dicom_path)
+    if 'PixelData' not in dataset or dataset.file_meta.TransferSyntaxUID.is_compressed:
+        # Nothing to re-encode, archive the file as it is
+        with open(dicom_path, 'rb') as f:
+            return f.read()
+
+    original_pixels = dataset.pixel_array
+    dataset.compress(transfer_syntax)
+    buffer = io.BytesIO()
+    dataset.save_as(buffer, enforce_file_format=True)
+    encoded = buffer.getvalue()
+
+    decoded_pixels = pydicom.dcmread(io.BytesIO(encoded)).pixel_array
+    if (decoded_pixels.dtype != original_pixels.dtype or decoded_pixels.shape != original_pixels.shape
+            or not (decoded_pixels == original_pixels).all()):
+        raise ValueError(f"Decoded pixels of {dicom_path} differ from the original")
+    return encoded
+
+# Function to archive a study as DICOM files with losslessly compressed Pixel Data.
+# Every instance is encoded and verified once, then written to a temporary folder per
+# destination that is renamed to compressed_path once complete. Instances that cannot
+# be re-encoded are archived unchanged. Returns the archive folder paths or None.
+def compress_study_dicom(folder_path, compressed_paths, codec='rle'):
+    transfer_syntax = DICOM_CODECS[codec]
+    temp_paths = [compressed_path + '.tmp' for compressed_path in compressed_paths]
+    try:
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                shutil.rmtree(temp_path)
+            os.makedirs(temp_path)
+        for dicom_file in sorted(os.listdir(folder_path)):
+            dicom_path = os.path.join(folder_path, dicom_file)
+            if not os.path.isfile(dicom_path):
+                continue
+            try:
+                encoded = encode_dicom_lossless(dicom_path, transfer_syntax)
+            except Exception as e:
+                logger.warning(f"Could not re-encode {dicom_path} losslessly, archiving it unchanged: {e}")
+                with open(dicom_path, 'rb') as f:
+                    encoded = f.read()
+            for temp_path in temp_paths:
+                with open(os.path.join(temp_path, dicom_file), 'wb') as f:
+                    f.write(encoded)
+                    f.flush()
+                    os.fsync(f.fileno())
+        for temp_path, compressed_path in zip(temp_paths, compressed_paths):
+            sync_directory(temp_path)
+            if os.path.exists(compressed_path):
+                # Left behind by an earlier attempt that failed before updating the database
+                shutil.rmtree(compressed_path)
+            os.replace(temp_path, compressed_path)
+            sync_directory(os.path.dirname(compressed_path) or '.')
+        logger.debug(f"Folder {folder_path} re-encoded as {transfer_syntax.name} successfully.")
+        return list(compressed_paths)
+    except Exception as e:
+        logger.error(f"Error re-encoding folder {folder_path}: {e}")
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                shutil.rmtree(temp_path)
+        return None
+
+# Function to update study metadata in the database. When job_id is given the archive
+# job is marked recorded in the same transaction, as are the blobs of a study stored
+# in the blob store and the instance offsets of an indexed archive. Returns True on success.
+def update_study_metadata(connection, original_path, new_path, codec='gzip', dictionary_path=None, job_id=None,
+                          stored_blobs=None, archive_index=None, tar_size=None):
     update_query = '''
         UPDATE studies
-        SET folderpath = %s, compressed = True
+        SET folderpath = %s, compressed = True, codec = %s, codec_dictionary = %s, tar_size = %s
         WHERE folderpath = %s
+        RETURNING id
+    '''
+    try:
+        cursor = connection.cursor()
+        cursor.execute(update_query, (new_path, codec, dictionary_path, tar_size, original_path))
+        for (study_id,) in cursor.fetchall():
+            record_study_blobs(cursor, study_id, stored_blobs)
+            record_archive_index(cursor, study_id, archive_index)
+            record_study_event(cursor, study_id, 'compressed')
+        if job_id is not None:
+            update_archive_job(cursor, job_id, 'recorded')
+        connection.commit()
+        logger.debug(f"Metadata updated for study with folderpath {original_path}.")
+        return True
+    except (Exception, psycopg2.Error) as error:
+        connection.rollback()
+        logger.error(f"Error updating study metadata: {error}")
+        return False
+
+# Function to journal that a study is about to be archived. A failed job for the same
+# study is reused, counting the attempt. Returns the job id, or None on failure.
+def start_archive_job(connection, study_id, source_path, destinations, codec, dictionary_path):
+    insert_query = '''
+        INSERT INTO archive_jobs (study_id, source_path, destinations, codec, codec_dictionary)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (study_id) WHERE stage <> 'done' DO UPDATE
+        SET stage = 'queued', attempts = archive_jobs.attempts + 1, error = NULL,
+            source_path = EXCLUDED.source_path, destinations = EXCLUDED.destinations,
+            codec = EXCLUDED.codec, codec_dictionary = EXCLUDED.codec_dictionary,
+            archive_paths = NULL, updated_at = CURRENT_TIMESTAMP
+        RETURNING id
     '''
     try:
         cursor = connection.cursor()
-        cursor.execute(update_query, (new_path, original_path))
+        # Waits for the storage SCP to finish adding instances to the study's folder
+        cursor.execute("SELECT 1 FROM studies WHERE id = %s FOR UPDATE", (study_id,))
+        cursor.execute(insert_query, (study_id, source_path, destinations, codec, dictionary_path))
+        job_id = cursor.fetchone()[0]
         connection.commit()
-        print(f"Metadata updated for study with folderpath {original_path}.")
+        return job_id
+    except (Exception, psycopg2.Error) as error:
+        connection.rollback()
+        logger.error(f"Error journaling archive job for study {study_id}: {error}")
+        return None
+
+# Function to move an archive job to another stage; the caller commits
+def update_archive_job(cursor, job_id, stage, archive_paths=None, error=None):
+    cursor.execute('''
+        UPDATE archive_jobs
+        SET stage = %s, archive_paths = COALESCE(%s, archive_paths), error = %s, updated_at = CURRENT_TIMESTAMP
+        WHERE id = %s
+    ''', (stage, archive_paths, error, job_id))
+
+# Function to move an archive job to another stage in its own transaction. Returns True on success.
+def set_archive_job_stage(connection, job_id, stage, archive_paths=None, error=None):
+    try:
+        cursor = connection.cursor()
+        update_archive_job(cursor, job_id, stage, archive_paths, error)
+        connection.commit()
+        return True
+    except (Exception, psycopg2.Error) as db_error:
+        connection.rollback()
+        logger.error(f"Error moving archive job {job_id} to {stage}: {db_error}")
+        return False
+
+# Function to finish an archive job whose archives are written: point the study at the
+# long-term copy, then remove the short-term folder. Safe to call again after a crash.
+def complete_archive_job(connection, job_id, source_path, archive_paths, codec, dictionary_path, stored_blobs=None):
+    # The first tier (long-term storage) is the copy recorded in the database
+    archive_index = None
+    if codec in INDEXED_CODECS:
+        try:
+            archive_index = read_archive_index(archive_paths[0])
+        except Exception as error:
+            logger.error(f"Error reading the index of {archive_paths[0]}: {error}")
+            return False
+    # The short-term folder is still there, so the size of the tarball made from it is known
+    tar_size = None
+    if codec in CODECS:
+        try:
+            tar_size = folder_tar_size(source_path)
+        except OSError as error:
+            logger.warning(f"Could not work out the tar size of {source_path}: {error}")
+    if not update_study_metadata(connection, source_path, archive_paths[0], codec, dictionary_path, job_id,
+                                 stored_blobs, archive_index, tar_size):
+        return False
+    return remove_archived_folder(connection, job_id, source_path)
+
+# Function to remove the short-term folder of a study whose archive is recorded
+def remove_archived_folder(connection, job_id, source_path):
+    if os.path.isdir(source_path):
+        shutil.rmtree(source_path)
+        logger.debug(f"Original study folder {source_path} removed.")
+    return set_archive_job_stage(connection, job_id, 'done')
+
+# Function to bring the file system and the database back in line after a crash, before
+# the archiver starts: removes partly written archives, finishes archive jobs whose
+# archives are complete, and sends short-term folders that were never registered back
+# to the input directory to be ingested again. Returns the unfinished jobs that still
+# have to be archived, as (job_id, study_id, source_path, destinations, codec, dictionary_path).
+def reconcile_archive_jobs(connection, input_directory, short_term_directory, tier_directories):
+    # Archives are written under a .tmp name and renamed once complete, so anything still
+    # carrying it was being written when the archiver stopped
+    for tier_directory in tier_directories:
+        with os.scandir(tier_directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.tmp'):
+                    logger.warning(f"Removing partly written archive {entry.path}.")
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.remove(entry.path)
+        for store_name in (BLOB_DIRECTORY_NAME, PREVIEW_DIRECTORY_NAME):
+            for folder, _, files in os.walk(os.path.join(tier_directory, store_name)):
+                for name in files:
+                    if name.endswith('.tmp'):
+                        logger.warning(f"Removing partly written file {os.path.join(folder, name)}.")
+                        os.remove(os.path.join(folder, name))
+
+    try:
+        cursor = connection.cursor()
+        cursor.execute('''
+            SELECT id, study_id, source_path, destinations, codec, codec_dictionary, archive_paths, stage
+            FROM archive_jobs
+            WHERE stage IN ('queued', 'written', 'recorded')
+            ORDER BY id
+        ''')
+        jobs = cursor.fetchall()
+        cursor.execute("SELECT folderpath FROM studies WHERE NOT compressed")
+        registered_folders = {folderpath for (folderpath,) in cursor.fetchall()}
+        connection.rollback()
+    except (Exception, psycopg2.Error) as error:
+        connection.rollback()
+        logger.error(f"Error reading archive jobs: {error}")
+        return []
+
+    resume = []
+    for job_id, study_id, source_path, destinations, codec, dictionary_path, archive_paths, stage in jobs:
+        if stage == 'written' and codec == 'blobs':
+            # What the blobs were is only known in memory; storing the study again only
+            # hashes it, as every blob it needs is already written
+            stage = 'queued'
+        elif stage == 'written' and not all(os.path.exists(archive_path) for archive_path in archive_paths):
+            logger.warning(f"Archives of job {job_id} are missing, archiving study {study_id} again.")
+            stage = 'queued'
+        if stage == 'queued':
+            if os.path.isdir(source_path):
+                resume.append((job_id, study_id, source_path, destinations, codec, dictionary_path))
+            else:
+                set_archive_job_stage(connection, job_id, 'failed', error=f"Study folder {source_path} is missing")
+                logger.warning(f"Cannot resume archive job {job_id}: study folder {source_path} is missing.")
+        elif stage == 'written':
+            logger.info(f"Resuming archive job {job_id} for study {study_id} after its archives were written.")
+            complete_archive_job(connection, job_id, source_path, archive_paths, codec, dictionary_path)
+        elif stage == 'recorded':
+            logger.info(f"Resuming archive job {job_id} for study {study_id} after it was recorded.")
+            remove_archived_folder(connection, job_id, source_path)
+
+    # A folder moved to short-term storage whose metadata insert never committed. Hidden
+    # folders are the storage SCP's, which recovers them itself.
+    with os.scandir(short_term_directory) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False) and entry.path not in registered_folders:
+                retry_path = os.path.join(input_directory, entry.name)
+                if os.path.exists(retry_path):
+                    logger.warning(f"Study folder {entry.path} is not registered and {retry_path} exists, leaving it.")
+                    continue
+                logger.warning(f"Study folder {entry.path} is not registered, returning it to the input directory.")
+                shutil.move(entry.path, retry_path)
+
+    journaled_folders = {job[2] for job in jobs}
+    for folderpath in registered_folders - journaled_folders:
+        if not os.path.isdir(folderpath):
+            logger.warning(f"Study folder {folderpath} is registered but missing.")
+    return resume
+
+# Function to summarise a study folder as (file count, total size, newest mtime)
+def folder_signature(folder_path):
+    file_count = 0
+    total_size = 0
+    newest_mtime = 0
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                file_count += 1
+                total_size += stat.st_size
+                newest_mtime = max(newest_mtime, stat.st_mtime)
+    return (file_count, total_size, newest_mtime)
+
+# Watches the input directory and reports study folders once they are fully written.
+# Uses inotify where available and a scandir based change detector otherwise.
+class IngestWatcher:
+    def __init__(self, input_directory, quiescence=INGEST_QUIESCENCE_SECONDS, poll_interval=INGEST_POLL_INTERVAL):
+        self.input_directory = input_directory
+        self.quiescence = quiescence
+        self.poll_interval = poll_interval
+        # study_folder -> [signature, last change time, arrival time]
+        self.pending = {}
+        self.inotify = None
+        self.input_watch = None
+        self.folder_watches = {}
+        self.input_mtime = None
+
+        if INotify is not None:
+            try:
+                self.inotify = INotify()
+                self.input_watch = self.inotify.add_watch(input_directory, INPUT_WATCH_FLAGS)
+            except OSError as error:
+                logger.warning(f"inotify unavailable, falling back to polling: {error}")
+                self.inotify = None
+        self.mode = "inotify" if self.inotify is not None else "polling"
+        self.rescan(time.time())
+
+    # Function to pick up folders that appeared or disappeared in the input directory
+    def rescan(self, now):
+        present = set()
+        with os.scandir(self.input_directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    present.add(entry.name)
+                    if entry.name not in self.pending:
+                        self.add_pending(entry.name, now)
+        for study_folder in list(self.pending):
+            if study_folder not in present:
+                self.drop_pending(study_folder)
+
+    def add_pending(self, study_folder, now):
+        folder_path = os.path.join(self.input_directory, study_folder)
+        if self.inotify is not None:
+            try:
+                wd = self.inotify.add_watch(folder_path, FOLDER_WATCH_FLAGS)
+                self.folder_watches[wd] = study_folder
+            except OSError:
+                return
+        try:
+            signature = folder_signature(folder_path)
+        except OSError:
+            return
+        self.pending[study_folder] = [signature, now, now]
+
+    def drop_pending(self, study_folder):
+        self.pending.pop(study_folder, None)
+        for wd, name in list(self.folder_watches.items()):
+            if name == study_folder:
+                del self.folder_watches[wd]
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass
+
+    # Function to refresh the signature of a pending folder, restarting its quiet period on change
+    def check_folder(self, study_folder, now):
+        state = self.pending.get(study_folder)
+        if state is None:
+            return
+        try:
+            signature = folder_signature(os.path.join(self.input_directory, study_folder))
+        except OSError:
+            self.drop_pending(study_folder)
+            return
+        if signature != state[0]:
+            state[0] = signature
+            state[1] = now
+
+    def handle_events(self, events, now):
+        for event in events:
+            if event.mask & inotify_flags.Q_OVERFLOW:
+                self.rescan(now)
+            elif event.wd == self.input_watch:
+                if event.mask & inotify_flags.ISDIR and event.name:
+                    if event.mask & (inotify_flags.CREATE | inotify_flags.MOVED_TO):
+                        if event.name not in self.pending:
+                            self.add_pending(event.name, now)
+                    elif event.mask & (inotify_flags.DELETE | inotify_flags.MOVED_FROM):
+                        self.drop_pending(event.name)
+            elif event.wd in self.folder_watches:
+                state = self.pending.get(self.folder_watches[event.wd])
+                if state is not None:
+                    state[1] = now
+
+    def poll(self, now):
+        try:
+            input_mtime = os.stat(self.input_directory).st_mtime
+        except OSError:
+            return
+        if input_mtime != self.input_mtime:
+            self.input_mtime = input_mtime
+            self.rescan(now)
+        for study_folder in list(self.pending):
+            self.check_folder(study_folder, now)
+
+    # Function to collect folders that have been quiet for the full quiescence period
+    def collect_ready(self, now):
+        ready = []
+        for study_folder, state in list(self.pending.items()):
+            if now - state[1] < self.quiescence:
+                continue
+            if self.inotify is not None:
+                # Confirm with a scan in case an event was missed
+                self.check_folder(study_folder, now)
+                state = self.pending.get(study_folder)
+                if state is None or now - state[1] < self.quiescence:
+                    continue
+            ready.append((study_folder, state[2]))
+            self.drop_pending(study_folder)
+        return ready
+
+    # Function to take in changes to the input directory, waiting up to timeout seconds for some
+    def refresh(self, timeout):
+        if self.inotify is not None:
+            events = self.inotify.read(timeout=max(0, int(timeout * 1000)))
+            self.handle_events(events, time.time())
+        else:
+            time.sleep(max(0, min(self.poll_interval, timeout)))
+            self.poll(time.time())
+
+    # Function to block until study folders are ready or the timeout expires.
+    # Returns a list of (study_folder, arrival_time) tuples.
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        # Changes since the last call are taken in first, so folders that appeared while
+        # the caller was busy are seen even when it does not wait at all
+        self.refresh(0)
+        while True:
+            now = time.time()
+            ready = self.collect_ready(now)
+            if ready or now >= deadline:
+                return ready
+
+            wake_at = deadline
+            for state in self.pending.values():
+                wake_at = min(wake_at, state[1] + self.quiescence)
+            self.refresh(wake_at - now)
+
+    # Function to report a folder in the input directory again once delay seconds have
+    # passed, for a study whose ingest failed
+    def retry(self, study_folder, delay):
+        now = time.time()
+        self.drop_pending(study_folder)
+        self.add_pending(study_folder, now)
+        state = self.pending.get(study_folder)
+        if state is not None:
+            state[1] = now + delay - self.quiescence
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+# Function to pick the priority class of a study folder waiting in the input directory,
+# from its name or else from the header of its first file
+def study_priority(study_path, arrival_time):
+    name = os.path.basename(study_path).lower()
+    for prefix, priority in PRIORITY_FOLDER_PREFIXES.items():
+        if name.startswith(prefix):
+            return priority
+    try:
+        dicom_paths = sorted(entry.path for entry in os.scandir(study_path) if entry.is_file())
+        dataset = header_reader.read(dicom_paths[0])
+    except Exception:
+        # Unreadable studies are found out at ingest
+        return 'routine'
+    requested_priority = (header_text(dataset, 'RequestedProcedurePriority') or '').upper()
+    if requested_priority in PRIORITY_TAG_VALUES:
+        return PRIORITY_TAG_VALUES[requested_priority]
+    study_date = parse_dicom_date(header_text(dataset, 'StudyDate'))
+    if study_date is not None and (datetime.fromtimestamp(arrival_time).date() - study_date).days > PRIORITY_BACKFILL_AGE_DAYS:
+        return 'backfill'
+    return 'routine'
+
+# Study folders that are ready to be ingested, handed out most urgent class first and
+# in arrival order within a class
+class IngestQueue:
+    def __init__(self):
+        # (class rank, arrival time, sequence, study_folder, priority)
+        self.heap = []
+        self.sequence = itertools.count()
+        self.depths = dict.fromkeys(PRIORITY_CLASSES, 0)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, study_folder, arrival_time, priority):
+        heapq.heappush(self.heap, (PRIORITY_CLASSES.index(priority), arrival_time, next(self.sequence),
+                                   study_folder, priority))
+        self.depths[priority] += 1
+
+    # Function to take the most urgent study, as (study_folder, arrival_time, priority)
+    def pop(self):
+        rank, arrival_time, sequence, study_folder, priority = heapq.heappop(self.heap)
+        self.depths[priority] -= 1
+        return study_folder, arrival_time, priority
+
+    def depth(self, priority):
+        return self.depths[priority]
+
+    # Function to get how many studies may be archived at once while this queue waits
+    def archive_job_limit(self):
+        if self.depths['stat']:
+            return 0
+        if self.heap:
+            return ARCHIVE_BUSY_QUEUE_SIZE
+        return ARCHIVE_QUEUE_SIZE
+
+# Function to record how long a study took from arrival to registration against the SLO of its class
+def check_ingest_slo(study_folder, priority, seconds):
+    metrics.observe_ingest(priority, seconds)
+    slo = INGEST_SLO_SECONDS.get(priority)
+    if slo is not None and seconds > slo:
+        metrics.count(f'ingest_slo_missed_{priority}')
+        logger.warning(f"{priority.upper()} study {study_folder} took {seconds:.1f}s to register, over its {slo}s target.")
+
+# Function to move a new study folder to short-term storage and register it in the database
+def ingest_study(connection, study_folder, input_directory, short_term_directory, arrival_time, header_pool=None,
+                 preview_directory=None, priority='routine'):
+    study_path = os.path.join(input_directory, study_folder)
+    folder_path = os.path.join(short_term_directory, study_folder)
+    logger.info(f"Processing new study folder: {study_folder} ({priority})")
+    # From the folder first appearing to it being complete and picked up
+    metrics.observe('detect', time.time() - arrival_time)
+    # Move the folder to the short-term directory
+    shutil.move(study_path, folder_path)
+
+    # Read the header of every DICOM file in the folder on the ingest workers,
+    # leaving the pixel data on disk
+    dicom_files = sorted(os.listdir(folder_path))
+    dicom_paths = [os.path.join(folder_path, dicom_file) for dicom_file in dicom_files]
+    # Instances are hashed too when they are archived to the blob store, so ones already stored are not kept twice
+    read_header = functools.partial(read_dicom_header_in_worker, with_digest=ARCHIVE_CODEC == 'blobs')
+    header_start_time = time.perf_counter()
+    if header_pool is not None:
+        results = header_pool.map(read_header, dicom_paths, chunksize=HEADER_CHUNK_SIZE)
+    else:
+        results = map(read_header, dicom_paths)
+
+    images = []
+    headers = []
+    for dicom_file, dicom_path, (header, error) in zip(dicom_files, dicom_paths, results):
+        if header is not None:
+            headers.append(header)
+        else:
+            logger.warning(f"Could not read DICOM header of {dicom_path}: {error}")
+            header = {'sop_instance_uid': None, 'series_instance_uid': None, 'tags': None, 'sha256': None}
+        images.append({
+            'filename': dicom_file,
+            'filepath': dicom_path,
+            'sop_instance_uid': header['sop_instance_uid'],
+            'series_instance_uid': header['series_instance_uid'],
+            'tags': header['tags'],
+            'sha256': header.get('sha256'),
+        })
+
+    metrics.observe('header_parse', time.perf_counter() - header_start_time)
+
+    # Instances the blob store already holds point straight at their blob
+    stored_blobs = find_stored_blobs(connection, {image['sha256'] for image in images if image['sha256']})
+    duplicate_paths = set()
+    for image in images:
+        if image['sha256'] in stored_blobs:
+            duplicate_paths.add(image['filepath'])
+            image['filepath'] = stored_blobs[image['sha256']]
+            image['deduplicated'] = True
+
+    # Study level fields come from the first readable header
+    size_bytes = sum(os.path.getsize(dicom_path) for dicom_path in dicom_paths if dicom_path not in duplicate_paths)
+    study = study_from_header(folder_path, headers[0] if headers else {}, size_bytes)
+    logger.info(f"Study {study_folder}: patient {study['patient_id']}, modality {study['modality']}, "
+                f"{len(images)} images.")
+
+    # Insert metadata for the moved folder and every DICOM file in it in one transaction
+    study_id, image_ids = insert_study_with_images(connection, study, images)
+    logger.info(f"Study {study_folder} registered {time.time() - arrival_time:.2f}s after arrival.")
+    if study_id is not None:
+        metrics.observe('register', time.time() - arrival_time)
+        check_ingest_slo(study_folder, priority, time.time() - arrival_time)
+        metrics.count('studies_ingested')
+        metrics.count('instances_ingested', len(images))
+        metrics.count('instances_deduplicated', len(duplicate_paths))
+        metrics.count_bytes('ingest', study['size_bytes'])
+
+    if study_id is not None and preview_directory is not None:
+        with metrics.time('preview'):
+            generate_study_previews(connection, study_id, folder_path, images, preview_directory, header_pool)
+    if study_id is not None and duplicate_paths:
+        for duplicate_path in duplicate_paths:
+            os.remove(duplicate_path)
+        logger.info(f"{len(duplicate_paths)} instances of study {study_folder} were already stored and are not kept again.")
+    return study_id
+
+# Function to put a study folder whose ingest failed back in the input directory, unless
+# it was registered before the failure. Returns True if the folder is in the input
+# directory to be ingested again.
+def return_failed_study(connection, study_folder, input_directory, short_term_directory):
+    study_path = os.path.join(input_directory, study_folder)
+    folder_path = os.path.join(short_term_directory, study_folder)
+    if os.path.isdir(study_path):
+        return True
+    if not os.path.isdir(folder_path):
+        return False
+    try:
+        connection.rollback()
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1 FROM studies WHERE folderpath = %s", (folder_path,))
+        registered = cursor.fetchone() is not None
+        connection.rollback()
     except (Exception, psycopg2.Error) as error:
-        print(f"Error updating study metadata: {error}")
+        # Left in short-term storage, where the next start returns it if it is not registered
+        logger.error(f"Error looking up study {study_folder}: {error}")
+        return False
+    if registered:
+        return False
+    try:
+        shutil.move(folder_path, study_path)
+    except OSError as error:
+        logger.error(f"Could not return study folder {folder_path} to the input directory: {error}")
+        return False
+    return True
+
+# Function run in an archive worker process: compresses a study once for every destination.
+# digests optionally maps file names to the SHA-256 digests the blob store keys them by.
+# Returns the archive paths, or None if they could not be written.
+def archive_study_worker(folder_path, destinations, codec, level, dictionary_path, digests=None):
+    if codec == 'blobs':
+        # One blob store per tier directory; the study's own path there is only a name
+        blob_directories = [os.path.join(os.path.dirname(destination), BLOB_DIRECTORY_NAME)
+                            for destination in destinations]
+        return store_study_blobs(folder_path, blob_directories, BLOB_CODEC, level, digests)
+    if codec in INDEXED_CODECS:
+        return compress_study_indexed(folder_path, destinations, level)
+    if codec in DICOM_CODECS:
+        return compress_study_dicom(folder_path, destinations, codec)
+    return compress_folder(folder_path, destinations, codec, level, dictionary_path)
+
+# Function run in an archive worker process: archives a study and returns the result of
+# archive_study_worker together with the durations of the job's stages
+def run_archive_job(folder_path, destinations, codec, level, dictionary_path):
+    worker_timings.clear()
+    start_time = time.perf_counter()
+    archive_paths = archive_study_worker(folder_path, destinations, codec, level, dictionary_path)
+    # Codecs that write as they go have no separate tier write stage
+    worker_timings['compress'] = time.perf_counter() - start_time - worker_timings.get('tier_write', 0)
+    return archive_paths, dict(worker_timings)
+
+# Archives several studies at once in a process pool of low priority workers. Submitted
+# studies wait in the pool until dispatch() hands them to the workers, which it does
+# while fewer than its limit (at most queue_size) are running, so the caller decides
+# how much archiving may go on next to ingest.
+class ArchivePool:
+    def __init__(self, workers=ARCHIVE_WORKERS, queue_size=ARCHIVE_QUEUE_SIZE, memory_limit_mb=ARCHIVE_WORKER_MEMORY_MB,
+                 niceness=ARCHIVE_WORKER_NICENESS):
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=start_archive_worker,
+                                            initargs=(niceness, memory_limit_mb))
+        self.queue_size = queue_size
+        # (study_folder, job arguments, completion callback, time queued), oldest first
+        self.waiting = deque()
+        # future -> (study_folder, completion callback, time queued)
+        self.in_flight = {}
+
+    def submit(self, study_folder, folder_path, destinations, callback,
+               codec=ARCHIVE_CODEC, level=ARCHIVE_LEVEL, dictionary_path=ZSTD_DICTIONARY_PATH):
+        self.waiting.append((study_folder, (folder_path, destinations, codec, level, dictionary_path), callback,
+                             time.perf_counter()))
+
+    # Function to hand waiting studies to the workers until limit of them are being archived
+    def dispatch(self, limit=None):
+        limit = self.queue_size if limit is None else min(limit, self.queue_size)
+        while self.waiting and len(self.in_flight) < limit:
+            study_folder, job, callback, queued_time = self.waiting.popleft()
+            future = self.executor.submit(run_archive_job, *job)
+            self.in_flight[future] = (study_folder, callback, queued_time)
+
+    # Function to run the completion callback of every finished job, waiting up to timeout for one
+    def run_callbacks(self, timeout=0):
+        if not self.in_flight:
+            return
+        done, _ = wait(list(self.in_flight), timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            study_folder, callback, queued_time = self.in_flight.pop(future)
+            error = None
+            try:
+                archive_paths, timings = future.result()
+                for stage, seconds in timings.items():
+                    metrics.observe(stage, seconds)
+                # Whatever the job did not spend working, it spent waiting for a worker
+                metrics.observe('archive_wait', time.perf_counter() - queued_time - sum(timings.values()))
+            except Exception as e:
+                logger.error(f"Error archiving study {study_folder}: {e}")
+                archive_paths = None
+                error = str(e)
+            callback(archive_paths, error)
+
+    def shutdown(self):
+        while self.waiting or self.in_flight:
+            self.dispatch()
+            self.run_callbacks(timeout=None)
+        self.executor.shutdown()
+
+# Decides which studies leave short-term storage, from disk usage watermarks, study age,
+# last access and modality. Everything it decides from lives in the database (ingest
+# time, size and last access of each study, and disk usage samples), so a restart picks
+# up where it left off instead of restarting every study's clock. It also records disk
+# usage over time to forecast how long each tier has before it fills up.
+class TieringPolicy:
+    def __init__(self, connection, short_term_directory, tier_directories):
+        self.connection = connection
+        self.short_term_directory = short_term_directory
+        self.tier_directories = tier_directories
+        # Ids of studies queued or being archived
+        self.archiving = set()
+        self.next_evaluation = 0
+        self.next_sample = 0
+
+    def seconds_until_next_evaluation(self):
+        return max(0, self.next_evaluation - time.time())
+
+    # Function to pick the studies to archive now, as (study_id, folderpath, reason), coldest first
+    def due_studies(self):
+        self.next_evaluation = time.time() + TIER_POLICY_INTERVAL
+        select_query = '''
+            SELECT id, folderpath, modality, size_bytes,
+                   EXTRACT(EPOCH FROM LOCALTIMESTAMP - timestamp),
+                   EXTRACT(EPOCH FROM LOCALTIMESTAMP - COALESCE(last_accessed, timestamp))
+            FROM studies
+            WHERE NOT compressed AND timestamp <= LOCALTIMESTAMP - %s * INTERVAL '1 second'
+              AND NOT EXISTS (
+                  SELECT 1 FROM archive_jobs
+                  WHERE archive_jobs.study_id = studies.id AND archive_jobs.stage = 'failed'
+                    AND archive_jobs.updated_at > LOCALTIMESTAMP - %s * INTERVAL '1 second'
+              )
+            ORDER BY COALESCE(last_accessed, timestamp)
+        '''
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute(select_query, (TIER_MIN_AGE_SECONDS, ARCHIVE_RETRY_SECONDS))
+            rows = cursor.fetchall()
+            self.connection.rollback()
+        except (Exception, psycopg2.Error) as error:
+            self.connection.rollback()
+            logger.error(f"Error evaluating tiering policy: {error}")
+            return []
+
+        usage = shutil.disk_usage(self.short_term_directory)
+        used = usage.used
+        high_watermark = usage.total * TIER_HIGH_WATERMARK
+        low_watermark = usage.total * TIER_LOW_WATERMARK
+        under_pressure = used > high_watermark
+        due = []
+        sizes = []
+        for study_id, folderpath, modality, size_bytes, age, idle in rows:
+            if not os.path.isdir(folderpath):
+                continue
+            if size_bytes is None:
+                # Studies ingested before sizes were recorded
+                size_bytes = folder_signature(folderpath)[1]
+                sizes.append((size_bytes, study_id))
+            if study_id in self.archiving:
+                # Its space is about to be freed already
+                used -= size_bytes
+                continue
+            max_age = TIER_MODALITY_MAX_AGE_SECONDS.get(modality, TIER_MAX_AGE_SECONDS)
+            if under_pressure and used > low_watermark:
+                reason = 'capacity'
+            elif age > max_age and idle > TIER_RECENT_ACCESS_SECONDS:
+                reason = 'age'
+            else:
+                continue
+            used -= size_bytes
+            due.append((study_id, folderpath, reason))
+
+        if sizes:
+            try:
+                cursor = self.connection.cursor()
+                cursor.executemany("UPDATE studies SET size_bytes = %s WHERE id = %s", sizes)
+                self.connection.commit()
+            except (Exception, psycopg2.Error) as error:
+                self.connection.rollback()
+                logger.error(f"Error recording study sizes: {error}")
+        if under_pressure:
+            logger.warning(f"Short-term storage at {usage.used / usage.total:.0%}, above the "
+                           f"{TIER_HIGH_WATERMARK:.0%} watermark; archiving the least recently used studies.")
+        return due
+
+    def directories(self):
+        return [self.short_term_directory] + self.tier_directories
+
+    # Function to record the disk usage of every tier, at most once per TIER_SAMPLE_INTERVAL.
+    # Returns True when a sample was taken.
+    def record_usage(self):
+        if time.time() < self.next_sample:
+            return False
+        self.next_sample = time.time() + TIER_SAMPLE_INTERVAL
+        try:
+            cursor = self.connection.cursor()
+            for directory in self.directories():
+                usage = shutil.disk_usage(directory)
+                cursor.execute("INSERT INTO storage_usage (directory, used_bytes, total_bytes) VALUES (%s, %s, %s)",
+                               (directory, usage.used, usage.total))
+            self.connection.commit()
+            return True
+        except (Exception, psycopg2.Error) as error:
+            self.connection.rollback()
+            logger.error(f"Error recording storage usage: {error}")
+            return False
+
+    # Function to project how long each tier has before it fills, from the growth of its
+    # disk usage over the last TIER_FORECAST_DAYS. Short-term storage counts as full at
+    # the high watermark, where the policy starts archiving early.
+    def capacity_report(self):
+        forecast_query = '''
+            SELECT regr_slope(used_bytes, EXTRACT(EPOCH FROM sampled_at)), COUNT(*)
+            FROM storage_usage
+            WHERE directory = %s AND sampled_at > LOCALTIMESTAMP - %s * INTERVAL '1 day'
+        '''
+        report = []
+        try:
+            cursor = self.connection.cursor()
+            for directory in self.directories():
+                usage = shutil.disk_usage(directory)
+                limit = TIER_HIGH_WATERMARK if directory == self.short_term_directory else 1.0
+                headroom = max(0, usage.total * limit - usage.used)
+                cursor.execute(forecast_query, (directory, TIER_FORECAST_DAYS))
+                slope, samples = cursor.fetchone()
+                growth_per_day = float(slope) * 86400 if slope is not None else None
+                if growth_per_day and growth_per_day > 0:
+                    days_left = headroom / growth_per_day
+                else:
+                    days_left = None
+                report.append({
+                    'directory': directory,
+                    'used_bytes': usage.used,
+                    'total_bytes': usage.total,
+                    'headroom_bytes': headroom,
+                    'growth_bytes_per_day': growth_per_day,
+                    'days_until_full': days_left,
+                    'samples': samples,
+                })
+            self.connection.rollback()
+        except (Exception, psycopg2.Error) as error:
+            self.connection.rollback()
+            logger.error(f"Error forecasting storage capacity: {error}")
+        return report
+
+    def print_capacity_report(self):
+        for tier in self.capacity_report():
+            line = (f"{tier['directory']}: {tier['used_bytes'] / tier['total_bytes']:.0%} used, "
+                    f"{tier['headroom_bytes'] / 1e9:.1f} GB headroom")
+            if tier['days_until_full'] is not None:
+                line += (f", full in about {tier['days_until_full']:.1f} days at "
+                         f"{tier['growth_bytes_per_day'] / 1e9:.2f} GB/day")
+            else:
+                line += ", not growing"
+            logger.info(line)
+
+# Function to get the size of an archive, which is a folder for the DICOM codecs
+def archive_size(archive_path):
+    if os.path.isdir(archive_path):
+        return sum(entry.stat().st_size for entry in os.scandir(archive_path))
+    return os.path.getsize(archive_path)
+
+# Function to journal and queue the archiving of a study. job_id is given when resuming a journaled job.
+def submit_archive_job(connection, archive_pool, policy, study_id, folder_path, destinations,
+                       codec, dictionary_path, job_id=None):
+    if job_id is None:
+        job_id = start_archive_job(connection, study_id, folder_path, destinations, codec, dictionary_path)
+        if job_id is None:
+            return
+    study_folder = os.path.basename(folder_path)
+    policy.archiving.add(study_id)
+    callback = functools.partial(finish_archive, connection, policy, job_id, study_id, study_folder, folder_path,
+                                 destinations, codec, dictionary_path)
+    archive_pool.submit(study_folder, folder_path, destinations, callback, codec, ARCHIVE_LEVEL, dictionary_path)
+
+# Function called once a study's archives are durably written, or could not be
+def finish_archive(connection, policy, job_id, study_id, study_folder, folder_path, destinations, codec,
+                   dictionary_path, archive_paths, error=None):
+    policy.archiving.discard(study_id)
+    if archive_paths is None:
+        # Leave the study in short-term storage and try again later
+        logger.warning(f"Archiving study {study_folder} failed, will retry.")
+        metrics.count('archive_jobs_failed')
+        set_archive_job_stage(connection, job_id, 'failed', error=error or "Archives could not be written")
+        return
+
+    if codec == 'blobs':
+        # The blobs are recorded together with the study; if the archiver stops before
+        # that, the study is stored again, which only hashes it
+        for destination in destinations:
+            logger.info(f"Study {study_folder} stored in the blob store of {os.path.dirname(destination)}.")
+        metrics.count_bytes('archive', sum(blob['stored_size'] for blob in archive_paths))
+        with metrics.time('archive_record'):
+            if set_archive_job_stage(connection, job_id, 'written', destinations):
+                if complete_archive_job(connection, job_id, folder_path, destinations, codec, None, archive_paths):
+                    metrics.count('archive_jobs_done')
+        return
+
+    for archive_path in archive_paths:
+        logger.info(f"Study {study_folder} compressed and moved to {os.path.dirname(archive_path)}.")
+    metrics.count_bytes('archive', sum(archive_size(archive_path) for archive_path in archive_paths))
+    # If this fails the job stays queued and is archived again on the next start
+    with metrics.time('archive_record'):
+        if set_archive_job_stage(connection, job_id, 'written', archive_paths):
+            if complete_archive_job(connection, job_id, folder_path, archive_paths, codec, dictionary_path):
+                metrics.count('archive_jobs_done')
 
 # Example usage
 def main(input_directory, short_term_directory, long_term_directory, local_directory):
+    configure_logging()
+    if not codec_available(ARCHIVE_CODEC):
+        logger.error(f"Archive codec {ARCHIVE_CODEC} is not available. Install its library or choose another codec.")
+        return
+
     os.makedirs(input_directory, exist_ok=True)
     os.makedirs(short_term_directory, exist_ok=True)
     os.makedirs(long_term_directory, exist_ok=True)
     os.makedirs(local_directory, exist_ok=True)
+    preview_directory = os.path.join(long_term_directory, PREVIEW_DIRECTORY_NAME)
+    os.makedirs(preview_directory, exist_ok=True)
+
+    # Archive tiers every study is written to, long-term storage first
+    tier_directories = [long_term_directory, local_directory]
 
     # Connect to PostgreSQL database
     connection = connect_to_database()
@@ -124,72 +2242,81 @@ def main(input_directory, short_term_directory, long_term_directory, local_direc
         # Create metadata tables if not exists
         create_metadata_tables(connection)
 
-        # Initialize folder timers for existing folders in short-term directory
-        folder_timers = {}
-        for study_folder in os.listdir(short_term_directory):
-            folder_path = os.path.join(short_term_directory, study_folder)
-            if os.path.isdir(folder_path):
-                folder_timers[study_folder] = time.time()
+        # Studies already in short-term storage are picked up from the database
+        policy = TieringPolicy(connection, short_term_directory, tier_directories)
+
+        # Clean up after an earlier run that stopped part way, before watching the input
+        # directory so folders sent back for ingest are seen
+        resume_jobs = reconcile_archive_jobs(connection, input_directory, short_term_directory, tier_directories)
 
+        watcher = IngestWatcher(input_directory)
+        logger.info(f"Watching {input_directory} for new studies ({watcher.mode}).")
+        archive_pool = ArchivePool()
+        for job_id, study_id, folder_path, destinations, codec, dictionary_path in resume_jobs:
+            logger.info(f"Resuming archive job {job_id} for {folder_path}.")
+            submit_archive_job(connection, archive_pool, policy, study_id, folder_path, destinations,
+                               codec, dictionary_path, job_id)
+        header_pool = ProcessPoolExecutor(max_workers=INGEST_WORKERS, initializer=limit_worker_memory,
+                                          initargs=(INGEST_WORKER_MEMORY_MB,))
+
+        ingest_queue = IngestQueue()
+        metrics.track_queue('ingest', lambda: len(watcher.pending))
+        for priority in PRIORITY_CLASSES:
+            metrics.track_queue(f'ingest_{priority}', functools.partial(ingest_queue.depth, priority))
+        metrics.track_queue('archive', lambda: len(archive_pool.in_flight))
+        metrics.track_queue('archive_waiting', lambda: len(archive_pool.waiting))
+        if METRICS_PORT is not None:
+            metrics.serve(METRICS_PORT)
+
+        next_blob_collection = time.time()
         while True:
-            # Move new study folders from input directory to short-term directory
-            for study_folder in os.listdir(input_directory):
-                study_path = os.path.join(input_directory, study_folder)
-                if os.path.isdir(study_path):
-                    print(f"Processing new study folder: {study_folder}")
-                    # Move the folder to the short-term directory
-                    shutil.move(study_path, os.path.join(short_term_directory, study_folder))
-                    
-                    # Start timer for the new folder
-                    folder_timers[study_folder] = time.time()
-                    
-                    # Extract modality information from the first DICOM file in the folder
-                    first_dicom_path = os.path.join(short_term_directory, study_folder, os.listdir(os.path.join(short_term_directory, study_folder))[0])
-                    dataset = pydicom.dcmread(first_dicom_path)
-                    modality = dataset.Modality
-                    print(f"Modality extracted: {modality}")
-
-                    # Generate a unique patient ID for each study
-                    patient_id = generate_patient_id()
-                    print(f"Generated patient ID: {patient_id}")
-
-                    # Insert metadata for the moved folder with modality information
-                    study_id = insert_study_metadata(connection, patient_id, modality, os.path.join(short_term_directory, study_folder))
-
-                    # Insert metadata for each DICOM file in the study folder
-                    for dicom_file in os.listdir(os.path.join(short_term_directory, study_folder)):
-                        dicom_path = os.path.join(short_term_directory, study_folder, dicom_file)
-                        insert_image_metadata(connection, study_id, dicom_file, dicom_path)
-
-            # Check for folders in the short-term directory
-            current_time = time.time()
-            for study_folder in os.listdir(short_term_directory):
-                folder_path = os.path.join(short_term_directory, study_folder)
-                if os.path.isdir(folder_path):
-                    if study_folder in folder_timers:
-                        folder_age = current_time - folder_timers[study_folder]
-                        if folder_age > 180:  # Delay of 3 minutes (180 seconds)
-                            compressed_long_term_path = os.path.join(long_term_directory, study_folder)
-                            compressed_local_path = os.path.join(local_directory, study_folder)
-                            
-                            # Compress the study folder and move to long-term storage
-                            compress_folder(folder_path, compressed_long_term_path)
-                            update_study_metadata(connection, folder_path, compressed_long_term_path + '.tar.gz')
-                            print(f"Study {study_folder} compressed and moved to long-term storage.")
-                            
-                            # Compress the study folder and move to local storage
-                            compress_folder(folder_path, compressed_local_path)
-                            update_study_metadata(connection, folder_path, compressed_local_path + '.tar.gz')
-                            print(f"Study {study_folder} compressed and moved to local storage.")
-
-                            # Remove the original study folder
-                            shutil.rmtree(folder_path)
-                            print(f"Original study folder {folder_path} removed.")
-
-                            del folder_timers[study_folder]
-
-            # Sleep for a certain interval before checking again
-            time.sleep(5)  # Check every 5 seconds (adjust as needed)
+            # Wait for new study folders, waking up early when the tiering policy is due.
+            # While studies are queued for ingest, only the ones already complete are picked up.
+            timeout = policy.seconds_until_next_evaluation()
+            if archive_pool.in_flight:
+                timeout = min(timeout, ARCHIVE_POLL_INTERVAL)
+            if ingest_queue:
+                timeout = 0
+            for study_folder, arrival_time in watcher.wait(timeout):
+                priority = study_priority(os.path.join(input_directory, study_folder), arrival_time)
+                ingest_queue.add(study_folder, arrival_time, priority)
+
+            # One study at a time, so a STAT study that arrives meanwhile is ingested next
+            if ingest_queue:
+                study_folder, arrival_time, priority = ingest_queue.pop()
+                try:
+                    ingest_study(connection, study_folder, input_directory, short_term_directory, arrival_time,
+                                 header_pool, preview_directory, priority)
+                except Exception as error:
+                    # A corrupt file or a database error must not stop the archiver: the
+                    # study goes back to the input directory and is ingested again later
+                    logger.error(f"Error ingesting study {study_folder}, retrying in {INGEST_RETRY_SECONDS}s: {error}")
+                    metrics.count('ingest_failed')
+                    if return_failed_study(connection, study_folder, input_directory, short_term_directory):
+                        watcher.retry(study_folder, INGEST_RETRY_SECONDS)
+
+            # Update metadata for studies whose archives have been written, and start
+            # archiving as many more as ingest leaves room for
+            archive_pool.run_callbacks()
+            archive_pool.dispatch(ingest_queue.archive_job_limit())
+
+            if policy.record_usage():
+                policy.print_capacity_report()
+
+            # Queue the studies the tiering policy wants out of short-term storage
+            if policy.seconds_until_next_evaluation() == 0:
+                for study_id, folder_path, reason in policy.due_studies():
+                    study_folder = os.path.basename(folder_path)
+                    logger.info(f"Archiving study {study_folder} ({reason}).")
+                    destinations = [os.path.join(tier_directory, study_folder) for tier_directory in tier_directories]
+                    submit_archive_job(connection, archive_pool, policy, study_id, folder_path, destinations,
+                                       ARCHIVE_CODEC, ZSTD_DICTIONARY_PATH)
+
+            # Unreferenced blobs are only deleted while no study is being archived, as an
+            # archive job may have found a blob on disk without having recorded it yet
+            if time.time() >= next_blob_collection and not archive_pool.in_flight and not archive_pool.waiting:
+                collect_unused_blobs(connection, tier_directories)
+                next_blob_collection = time.time() + BLOB_GC_INTERVAL
 
     # Close database connection
     if connection:
@@ -0,0 +1,503 @@
+import os
+import io
+import re
+import sys
+import time
+import uuid
+import queue
+import shutil
+import hashlib
+import logging
+import argparse
+import threading
+
+import psycopg2
+import pydicom
+
+try:
+    from pynetdicom import AE, evt, StoragePresentationContexts, ALL_TRANSFER_SYNTAXES
+    from pynetdicom.sop_class import Verification
+except ImportError:
+    AE = None
+
+from compression import (ARCHIVE_CODEC, PREVIEW_DIRECTORY_NAME, connect_to_database, create_metadata_tables,
+                         configure_logging, header_from_dataset, read_dicom_header, hash_file, find_stored_blobs,
+                         study_from_header, insert_study_with_images, insert_images, record_study_event,
+                         generate_study_previews, metrics)
+
+logger = logging.getLogger('archiver.storescp')
+
+# AE title and port the storage SCP listens on, and the most associations it serves at once
+SCP_AE_TITLE = 'ARCHIVER'
+SCP_PORT = 11112
+SCP_MAX_ASSOCIATIONS = 16
+# Port the storage SCP serves Prometheus metrics on (needs prometheus_client), None for none
+SCP_METRICS_PORT = 9102
+# Flush every instance to disk before acknowledging its C-STORE
+SCP_FSYNC = True
+# Hidden folder in short-term storage that associations receive into until their studies are registered
+INCOMING_DIRECTORY_NAME = '.incoming'
+# A study is registered once no instance of it has arrived for SCP_STUDY_QUIESCENCE_SECONDS,
+# even while its association stays open, checked every SCP_FLUSH_INTERVAL seconds
+SCP_STUDY_QUIESCENCE_SECONDS = 10
+SCP_FLUSH_INTERVAL = 1
+# C-STORE statuses: success, and Out of Resources for an instance that could not be stored
+STATUS_SUCCESS = 0x0000
+STATUS_OUT_OF_RESOURCES = 0xA700
+
+# Function to turn a Study Instance UID into a folder name
+def study_folder_name(study_instance_uid):
+    return re.sub(r'[^0-9A-Za-z._-]', '_', study_instance_uid or 'unknown')
+
+# DICOM Storage SCP that writes received instances straight into short-term storage.
+# Each association receives into its own folder under INCOMING_DIRECTORY_NAME, writing
+# the bytes as they came off the network and parsing the header from the same bytes in
+# memory. A study is registered once it has been quiet for the quiescence period or its
+# association ends, whichever comes first: a new study's folder is renamed into place,
+# and instances of a study still in short-term storage are renamed into its folder, with
+# the study row locked so the archiver cannot start on it meanwhile. Associations run on
+# their own threads and share one database connection for registration; previews are
+# rendered afterwards on a thread and connection of their own.
+class StorageReceiver:
+    def __init__(self, connection, short_term_directory, preview_directory=None,
+                 quiescence=SCP_STUDY_QUIESCENCE_SECONDS, flush_interval=SCP_FLUSH_INTERVAL):
+        self.connection = connection
+        self.short_term_directory = short_term_directory
+        self.preview_directory = preview_directory
+        self.quiescence = quiescence
+        self.flush_interval = flush_interval
+        self.incoming_directory = os.path.join(short_term_directory, INCOMING_DIRECTORY_NAME)
+        os.makedirs(self.incoming_directory, exist_ok=True)
+        # Serialises registration, and with it use of the database connection
+        self.lock = threading.Lock()
+        # association -> what it has received so far
+        self.associations = {}
+        # (study_id, folder_path, images) of registered studies waiting for previews
+        self.previews = queue.Queue()
+        metrics.track_queue('associations', lambda: len(self.associations))
+        metrics.track_queue('previews', self.previews.qsize)
+        threading.Thread(target=self.flush_quiet_studies, daemon=True).start()
+        if preview_directory is not None:
+            threading.Thread(target=self.render_previews, daemon=True).start()
+
+    # Function to list the event handlers the SCP serves associations with
+    def event_handlers(self):
+        return [
+            (evt.EVT_ACCEPTED, self.handle_accepted),
+            (evt.EVT_C_STORE, self.handle_store),
+            (evt.EVT_CONN_CLOSE, self.handle_closed),
+        ]
+
+    def handle_accepted(self, event):
+        staging_folder = os.path.join(self.incoming_directory, uuid.uuid4().hex)
+        os.makedirs(staging_folder)
+        requestor = event.assoc.requestor
+        self.associations[event.assoc] = {
+            'peer': f"{requestor.ae_title}@{requestor.address}:{requestor.port}",
+            'staging_folder': staging_folder,
+            'start_time': time.perf_counter(),
+            'instances': 0,
+            'bytes': 0,
+            # Guards studies between the association's thread and the flusher
+            'lock': threading.Lock(),
+            # study folder name -> {'path': folder it is received into,
+            #                       'headers': {filename: header}, 'last_received': time}
+            'studies': {},
+        }
+
+    def handle_store(self, event):
+        state = self.associations[event.assoc]
+        start_time = time.perf_counter()
+        try:
+            # The dataset as it was received, with file meta information; it is never decoded
+            data = event.encoded_dataset()
+            header = header_from_dataset(pydicom.dcmread(io.BytesIO(data), stop_before_pixels=True))
+            if ARCHIVE_CODEC == 'blobs':
+                header['sha256'] = hashlib.sha256(data).hexdigest()
+            study_folder = study_folder_name(header['study_instance_uid'])
+            filename = study_folder_name(header['sop_instance_uid'] or uuid.uuid4().hex) + '.dcm'
+            with state['lock']:
+                study = state['studies'].get(study_folder)
+                if study is None:
+                    # Each batch of a study gets a folder of its own, so instances arriving
+                    # after a batch was taken for registration do not land in it
+                    study = state['studies'][study_folder] = {
+                        'path': os.path.join(state['staging_folder'], uuid.uuid4().hex, study_folder),
+                        'headers': {},
+                    }
+                    os.makedirs(study['path'])
+                with open(os.path.join(study['path'], filename), 'wb') as f:
+                    f.write(data)
+                    if SCP_FSYNC:
+                        f.flush()
+                        os.fsync(f.fileno())
+                # An instance sent twice replaces the first copy
+                study['headers'][filename] = header
+                study['last_received'] = time.monotonic()
+        except Exception as error:
+            logger.error(f"Could not store an instance from {state['peer']}: {error}")
+            return STATUS_OUT_OF_RESOURCES
+        state['instances'] += 1
+        state['bytes'] += len(data)
+        metrics.observe('store', time.perf_counter() - start_time)
+        metrics.count('instances_received')
+        metrics.count_bytes('receive', len(data))
+        return STATUS_SUCCESS
+
+    # Function called when an association's connection closes, however it ended
+    def handle_closed(self, event):
+        state = self.associations.pop(event.assoc, None)
+        if state is None:
+            return
+        elapsed = max(time.perf_counter() - state['start_time'], 1e-9)
+        logger.info(f"Association from {state['peer']}: {state['instances']} instances, "
+                    f"{state['bytes'] / 1e6:.1f} MB in {elapsed:.2f}s "
+                    f"({state['instances'] / elapsed:.0f} instances/s, {state['bytes'] / 1e6 / elapsed:.1f} MB/s).")
+        metrics.observe('association', elapsed)
+        for study in self.take_studies(state):
+            self.register_received_study(study['path'], study['headers'])
+        try:
+            os.rmdir(state['staging_folder'])
+        except OSError:
+            # Studies that could not be registered, or one the flusher is registering
+            pass
+
+    # Function to take the studies of an association that are ready for registration:
+    # those received before cutoff, or all of them when cutoff is None
+    def take_studies(self, state, cutoff=None):
+        with state['lock']:
+            ready = [study_folder for study_folder, study in state['studies'].items()
+                     if cutoff is None or study['last_received'] <= cutoff]
+            return [state['studies'].pop(study_folder) for study_folder in ready]
+
+    # Function run on its own thread: registers the studies of open associations that
+    # have been quiet for the quiescence period
+    def flush_quiet_studies(self):
+        while True:
+            time.sleep(self.flush_interval)
+            cutoff = time.monotonic() - self.quiescence
+            for state in list(self.associations.values()):
+                for study in self.take_studies(state, cutoff):
+                    self.register_received_study(study['path'], study['headers'])
+
+    # Function to register a received study, remove the folder it was received into and
+    # queue its previews. A study that could not be registered stays there until the SCP
+    # next starts. Returns whether it was registered.
+    def register_received_study(self, staged_path, headers):
+        registered = None
+        if headers:
+            with self.lock:
+                try:
+                    registered = self.register_study(staged_path, headers)
+                except (Exception, psycopg2.Error) as error:
+                    self.connection.rollback()
+                    logger.error(f"Error registering received study {os.path.basename(staged_path)}: {error}")
+                    logger.warning(f"Its instances are kept in {staged_path} until the SCP restarts.")
+                    return False
+        # Anything left over was already in the blob store
+        shutil.rmtree(os.path.dirname(staged_path), ignore_errors=True)
+        if registered is not None and registered[2] and self.preview_directory is not None:
+            self.previews.put(registered)
+        return True
+
+    # Function to register the instances of one study received by an association.
+    # headers maps each received file in staged_path to its header. Returns
+    # (study_id, folder_path, images kept in the study folder), or None if the insert failed.
+    def register_study(self, staged_path, headers):
+        start_time = time.perf_counter()
+        images = [{
+            'filename': filename,
+            'filepath': None,
+            'sop_instance_uid': header['sop_instance_uid'],
+            'series_instance_uid': header['series_instance_uid'],
+            'tags': header['tags'],
+            'sha256': header.get('sha256'),
+        } for filename, header in sorted(headers.items())]
+        first_header = headers[images[0]['filename']]
+
+        # Instances the blob store already holds point straight at their blob
+        stored_blobs = find_stored_blobs(self.connection, {image['sha256'] for image in images if image['sha256']})
+        for image in images:
+            if image['sha256'] in stored_blobs:
+                image['filepath'] = stored_blobs[image['sha256']]
+                image['deduplicated'] = True
+        kept = [image for image in images if not image.get('deduplicated')]
+        size_bytes = sum(os.path.getsize(os.path.join(staged_path, image['filename'])) for image in kept)
+
+        existing_study = self.add_to_existing_study(staged_path, first_header['study_instance_uid'], images, kept)
+        if existing_study is not None:
+            study_id, folder_path = existing_study
+        else:
+            study_id, folder_path = self.register_new_study(staged_path, first_header, images, kept, size_bytes)
+        if study_id is None:
+            return None
+        metrics.observe('register', time.perf_counter() - start_time)
+        metrics.count('instances_ingested', len(images))
+        metrics.count('instances_deduplicated', len(images) - len(kept))
+        metrics.count_bytes('ingest', size_bytes)
+
+        # Instances in the blob store are not kept in the study folder
+        for image in images:
+            if image.get('deduplicated') and os.path.exists(os.path.join(folder_path, image['filename'])):
+                os.remove(os.path.join(folder_path, image['filename']))
+        return study_id, folder_path, kept
+
+    # Function to add received instances to a study that is still in short-term storage and
+    # not being archived. The study row stays locked until the files are in its folder, which
+    # keeps the archiver from starting on it. Returns (study_id, folder_path), or None if
+    # there is no such study.
+    def add_to_existing_study(self, staged_path, study_instance_uid, images, kept):
+        if study_instance_uid is None:
+            return None
+        cursor = self.connection.cursor()
+        cursor.execute('''
+            SELECT id, folderpath FROM studies
+            WHERE study_instance_uid = %s AND NOT compressed
+            ORDER BY id DESC
+            LIMIT 1
+            FOR UPDATE
+        ''', (study_instance_uid,))
+        row = cursor.fetchone()
+        if row is not None:
+            # Checked once the lock is held, so a job started meanwhile is seen
+            cursor.execute('''
+                SELECT 1 FROM archive_jobs
+                WHERE study_id = %s AND stage IN ('queued', 'written', 'recorded')
+            ''', (row[0],))
+            if cursor.fetchone() is not None or not os.path.isdir(row[1]):
+                row = None
+        if row is None:
+            self.connection.rollback()
+            return None
+
+        study_id, folder_path = row
+        cursor.execute("SELECT filename FROM images WHERE study_id = %s AND filename = ANY(%s)",
+                       (study_id, [image['filename'] for image in images]))
+        existing = {filename for (filename,) in cursor.fetchall()}
+        for image in kept:
+            image['filepath'] = os.path.join(folder_path, image['filename'])
+        new_images = [image for image in images if image['filename'] not in existing]
+        insert_images(cursor, study_id, new_images)
+        cursor.execute("UPDATE studies SET size_bytes = COALESCE(size_bytes, 0) + %s WHERE id = %s",
+                       (sum(os.path.getsize(os.path.join(staged_path, image['filename']))
+                            for image in new_images if not image.get('deduplicated')), study_id))
+        record_study_event(cursor, study_id, 'instances_added')
+        for image in kept:
+            os.replace(os.path.join(staged_path, image['filename']), image['filepath'])
+        self.connection.commit()
+        logger.info(f"Added {len(new_images)} instances to study {os.path.basename(folder_path)}.")
+        return study_id, folder_path
+
+    # Function to move a received study into short-term storage under a folder name of its
+    # own and register it. Returns (study_id, folder_path), with study_id None if the
+    # insert failed.
+    def register_new_study(self, staged_path, first_header, images, kept, size_bytes):
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT count(*) FROM studies WHERE study_instance_uid = %s",
+                       (first_header['study_instance_uid'],))
+        earlier_studies = cursor.fetchone()[0]
+        self.connection.rollback()
+
+        # Archives are named after the folder, so a study sent again after it was
+        # archived gets a folder (and archive) name of its own
+        base_name = os.path.basename(staged_path)
+        study_folder = base_name if not earlier_studies else f"{base_name}_{earlier_studies}"
+        while os.path.exists(os.path.join(self.short_term_directory, study_folder)):
+            earlier_studies += 1
+            study_folder = f"{base_name}_{earlier_studies}"
+        folder_path = os.path.join(self.short_term_directory, study_folder)
+        os.rename(staged_path, folder_path)
+
+        for image in kept:
+            image['filepath'] = os.path.join(folder_path, image['filename'])
+        study = study_from_header(folder_path, first_header, size_bytes)
+        logger.info(f"Study {study_folder}: patient {study['patient_id']}, modality {study['modality']}, "
+                    f"{len(images)} images received.")
+        # If this fails the folder is unregistered, and the archiver returns it to the input
+        # directory for ingest when it next starts
+        study_id, _ = insert_study_with_images(self.connection, study, images)
+        if study_id is not None:
+            metrics.count('studies_ingested')
+        return study_id, folder_path
+
+    # Function run on its own thread: renders the previews of registered studies on a
+    # connection of its own, so registration does not wait for them
+    def render_previews(self):
+        connection = None
+        while True:
+            study_id, folder_path, images = self.previews.get()
+            if connection is None or connection.closed:
+                connection = connect_to_database()
+                if connection is None:
+                    logger.error(f"No previews for study {study_id}: cannot connect to the database.")
+                    continue
+            with metrics.time('preview'):
+                generate_study_previews(connection, study_id, folder_path,
+                                        self.series_without_previews(connection, study_id, images),
+                                        self.preview_directory)
+
+    # Function to pick out the images of series that have no previews yet
+    def series_without_previews(self, connection, study_id, images):
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT DISTINCT series_instance_uid FROM previews WHERE study_id = %s", (study_id,))
+            previewed = {series_instance_uid for (series_instance_uid,) in cursor.fetchall()}
+            connection.rollback()
+        except (Exception, psycopg2.Error) as error:
+            connection.rollback()
+            logger.error(f"Error looking up previews of study {study_id}: {error}")
+            return []
+        return [image for image in images if image['series_instance_uid'] not in previewed]
+
+    # Function to register what associations had received when the SCP last stopped. Their
+    # instances were acknowledged, so they are kept; the headers are read from the files.
+    def recover_incoming(self):
+        with os.scandir(self.incoming_directory) as entries:
+            staging_folders = [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+        for staging_folder in staging_folders:
+            studies = []
+            for batch in sorted(os.listdir(staging_folder)):
+                for study_folder in sorted(os.listdir(os.path.join(staging_folder, batch))):
+                    staged_path = os.path.join(staging_folder, batch, study_folder)
+                    studies.append((staged_path, self.read_staged_headers(staged_path)))
+            logger.info(f"Registering {len(studies)} studies received before the SCP last stopped.")
+            for staged_path, headers in studies:
+                self.register_received_study(staged_path, headers)
+            try:
+                os.rmdir(staging_folder)
+            except OSError:
+                pass
+
+    # Function to read the headers of the files received into a study folder
+    def read_staged_headers(self, staged_path):
+        headers = {}
+        for filename in sorted(os.listdir(staged_path)):
+            dicom_path = os.path.join(staged_path, filename)
+            try:
+                headers[filename] = read_dicom_header(dicom_path)
+            except Exception as error:
+                logger.warning(f"Could not read DICOM header of {dicom_path}: {error}")
+                continue
+            if ARCHIVE_CODEC == 'blobs':
+                headers[filename]['sha256'] = hash_file(dicom_path)
+        return headers
+
+# Function to set up the application entity of the storage SCP
+def storage_ae(ae_title, max_associations):
+    ae = AE(ae_title=ae_title)
+    ae.maximum_associations = max_associations
+    # Instances are stored as they were sent, so any transfer syntax will do
+    for context in StoragePresentationContexts:
+        ae.add_supported_context(context.abstract_syntax, ALL_TRANSFER_SYNTAXES)
+    ae.add_supported_context(Verification)
+    return ae
+
+# Function to serve C-STORE (and C-ECHO) requests until interrupted
+def serve(args):
+    connection = connect_to_database()
+    if not connection:
+        return 1
+    create_metadata_tables(connection)
+    preview_directory = os.path.join(args.long_term, PREVIEW_DIRECTORY_NAME) if args.long_term else None
+    if preview_directory is not None:
+        os.makedirs(preview_directory, exist_ok=True)
+    receiver = StorageReceiver(connection, args.short_term, preview_directory)
+    receiver.recover_incoming()
+
+    ae = storage_ae(args.ae_title, args.max_associations)
+    if SCP_METRICS_PORT is not None:
+        metrics.serve(SCP_METRICS_PORT)
+    logger.info(f"Storage SCP {args.ae_title} listening on port {args.port}, storing into {args.short_term}.")
+    try:
+        ae.start_server((args.host, args.port), block=True, evt_handlers=receiver.event_handlers())
+    finally:
+        connection.close()
+    return 0
+
+# Function to send every DICOM file in a folder to a storage SCP over several
+# concurrent associations, reporting instances/s for each, to test an SCP
+def send(args):
+    dicom_paths = []
+    for folder, _, files in os.walk(args.folder):
+        dicom_paths.extend(os.path.join(folder, name) for name in sorted(files))
+    # One presentation context per SOP class and transfer syntax in the folder
+    contexts = set()
+    for dicom_path in list(dicom_paths):
+        try:
+            dataset = pydicom.dcmread(dicom_path, stop_before_pixels=True)
+            contexts.add((dataset.SOPClassUID, dataset.file_meta.TransferSyntaxUID))
+        except Exception as error:
+            logger.warning(f"Not sending {dicom_path}: {error}")
+            dicom_paths.remove(dicom_path)
+    if len(contexts) > 128:
+        logger.error(f"{len(contexts)} presentation contexts are needed, more than an association can have.")
+        return 1
+
+    ae = AE(ae_title='STORESCU')
+    for sop_class, transfer_syntax in sorted(contexts):
+        ae.add_requested_context(sop_class, transfer_syntax)
+    results = []
+
+    def send_share(number, share):
+        assoc = ae.associate(args.host, args.port, ae_title=args.ae_title)
+        if not assoc.is_established:
+            logger.error(f"Association {number} was not established.")
+            return
+        start_time = time.perf_counter()
+        sent = 0
+        size = 0
+        for dicom_path in share:
+            # Sent from the file as it is, without decoding it
+            status = assoc.send_c_store(dicom_path)
+            if status and status.Status == STATUS_SUCCESS:
+                sent += 1
+                size += os.path.getsize(dicom_path)
+            else:
+                logger.warning(f"Storing {dicom_path} failed: {status.Status if status else 'no response'}.")
+        assoc.release()
+        elapsed = max(time.perf_counter() - start_time, 1e-9)
+        logger.info(f"Association {number}: {sent} instances, {size / 1e6:.1f} MB in {elapsed:.2f}s "
+                    f"({sent / elapsed:.0f} instances/s).")
+        results.append(sent)
+
+    start_time = time.perf_counter()
+    threads = [threading.Thread(target=send_share, args=(number, dicom_paths[number::args.associations]))
+               for number in range(args.associations)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    logger.info(f"Sent {sum(results)} of {len(dicom_paths)} instances over {args.associations} associations "
+                f"in {elapsed:.2f}s ({sum(results) / elapsed:.0f} instances/s).")
+    return 0 if sum(results) == len(dicom_paths) else 1
+
+def main():
+    parser = argparse.ArgumentParser(description="DICOM Storage SCP that receives studies into short-term storage.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help="Receive instances")
+    serve_parser.add_argument('--short-term', required=True, help="Short-term storage directory")
+    serve_parser.add_argument('--long-term', help="Long-term storage directory, where previews are written")
+    serve_parser.add_argument('--host', default='', help="Address to listen on (default: all)")
+    serve_parser.add_argument('--port', type=int, default=SCP_PORT, help=f"Port to listen on (default: {SCP_PORT})")
+    serve_parser.add_argument('--ae-title', default=SCP_AE_TITLE, help=f"AE title (default: {SCP_AE_TITLE})")
+    serve_parser.add_argument('--max-associations', type=int, default=SCP_MAX_ASSOCIATIONS,
+                              help="Associations served at once")
+    send_parser = subparsers.add_parser('send', help="Send a folder of DICOM files to an SCP, for testing")
+    send_parser.add_argument('folder', help="Folder of DICOM files")
+    send_parser.add_argument('--host', default='127.0.0.1', help="SCP address (default: 127.0.0.1)")
+    send_parser.add_argument('--port', type=int, default=SCP_PORT, help=f"SCP port (default: {SCP_PORT})")
+    send_parser.add_argument('--ae-title', default=SCP_AE_TITLE, help=f"SCP AE title (default: {SCP_AE_TITLE})")
+    send_parser.add_argument('--associations', type=int, default=4, help="Concurrent associations")
+    args = parser.parse_args()
+
+    configure_logging()
+    # pynetdicom logs every association and message at INFO
+    logging.getLogger('pynetdicom').setLevel(logging.WARNING)
+    if AE is None:
+        logger.error("pynetdicom is not installed.")
+        return 1
+    return serve(args) if args.command == 'serve' else send(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
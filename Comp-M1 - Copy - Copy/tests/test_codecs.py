@@ -0,0 +1,139 @@
+import os
+import sys
+import tarfile
+import zlib
+
+import numpy as np
+import pytest
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compression
+
+
+# Function to fill a study folder with a few files of different sizes
+def make_folder(folder):
+    os.makedirs(folder)
+    contents = {}
+    for number, size in enumerate((0, 1, 511, 512, 70000)):
+        data = os.urandom(size // 2) + bytes(size - size // 2)
+        with open(os.path.join(folder, f'IM{number:04d}'), 'wb') as f:
+            f.write(data)
+        contents[f'IM{number:04d}'] = data
+    return contents
+
+
+# Function to read back the regular files of a tar archive written with a codec
+def read_archive(codec, archive_path):
+    with open(archive_path, 'rb') as f:
+        with compression.open_codec_reader(codec, f) as stream:
+            with tarfile.open(fileobj=stream, mode='r|') as tar:
+                return {os.path.basename(member.name): tar.extractfile(member).read()
+                        for member in tar if member.isreg()}
+
+
+@pytest.mark.parametrize('codec', sorted(compression.CODECS))
+def test_codec_round_trip_to_every_tier(codec, tmp_path):
+    if not compression.codec_available(codec):
+        pytest.skip(f"{codec} is not installed")
+    contents = make_folder(str(tmp_path / 'study'))
+    destinations = [str(tmp_path / 'long_term' / 'study'), str(tmp_path / 'local' / 'study')]
+    for destination in destinations:
+        os.makedirs(os.path.dirname(destination))
+    archive_paths = compression.compress_folder(str(tmp_path / 'study'), destinations, codec)
+    assert archive_paths == [destination + compression.CODECS[codec]['extension'] for destination in destinations]
+    with open(archive_paths[0], 'rb') as first, open(archive_paths[1], 'rb') as second:
+        assert first.read() == second.read()
+    assert read_archive(codec, archive_paths[0]) == contents
+    assert not [name for name in os.listdir(tmp_path / 'long_term') if name.endswith('.tmp')]
+
+
+def test_unavailable_codec_is_refused(tmp_path, monkeypatch):
+    monkeypatch.setattr(compression, 'zstandard', None)
+    assert not compression.codec_available('zstd')
+    make_folder(str(tmp_path / 'study'))
+    assert compression.compress_folder(str(tmp_path / 'study'), [str(tmp_path / 'study_archive')], 'zstd') is None
+    assert os.listdir(tmp_path) == ['study']
+
+
+def test_folder_tar_size_matches_the_archived_tar(tmp_path):
+    folder = str(tmp_path / 'study')
+    make_folder(folder)
+    # Nested series folders and a long name that needs an extended header
+    make_folder(os.path.join(folder, 'series_1'))
+    with open(os.path.join(folder, 'series_1', 'N' * 120), 'wb') as f:
+        f.write(b'x' * 10241)
+    archive_path, = compression.compress_folder(folder, [str(tmp_path / 'study_archive')], 'gzip')
+    with open(archive_path, 'rb') as f:
+        with compression.open_codec_reader('gzip', f) as stream:
+            tar_size = sum(len(chunk) for chunk in iter(lambda: stream.read(65536), b''))
+    assert compression.folder_tar_size(folder) == tar_size
+
+
+@pytest.mark.parametrize('level', [None, 0])
+def test_indexed_archive_members_are_read_at_their_offsets(level, tmp_path):
+    contents = make_folder(str(tmp_path / 'study'))
+    archive_paths = compression.compress_study_indexed(
+        str(tmp_path / 'study'), [str(tmp_path / 'short_term'), str(tmp_path / 'long_term')], level)
+    indexes = [compression.read_archive_index(archive_path) for archive_path in archive_paths]
+    assert indexes[0] == indexes[1]
+    assert sorted(indexes[0]) == sorted(contents)
+    with open(archive_paths[1], 'rb') as f:
+        for filename, (offset, length) in indexes[0].items():
+            f.seek(offset)
+            # Each member is a raw deflate stream of its own
+            assert zlib.decompress(f.read(length), -zlib.MAX_WBITS) == contents[filename]
+
+
+def test_bad_index_is_refused(tmp_path):
+    make_folder(str(tmp_path / 'study'))
+    archive_path, = compression.compress_study_indexed(str(tmp_path / 'study'), [str(tmp_path / 'study_archive')])
+    offset = compression.read_archive_index(archive_path)['IM0001'][0]
+    with open(archive_path, 'r+b') as f:
+        f.seek(offset - 30 - len('IM0001'))
+        f.write(b'XXXX')
+    with pytest.raises(ValueError):
+        compression.read_archive_index(archive_path)
+
+
+# Function to write a small CT instance with uncompressed pixel data
+def make_instance(path, pixels):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.2'
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dataset = Dataset()
+    dataset.file_meta = file_meta
+    dataset.SOPClassUID = file_meta.MediaStorageSOPClassUID
+    dataset.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    dataset.Rows, dataset.Columns = pixels.shape
+    dataset.BitsAllocated = 16
+    dataset.BitsStored = 12
+    dataset.HighBit = 11
+    dataset.SamplesPerPixel = 1
+    dataset.PixelRepresentation = 0
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.PixelData = pixels.tobytes()
+    dataset.save_as(path, enforce_file_format=True)
+
+
+@pytest.mark.parametrize('codec', sorted(compression.DICOM_CODECS))
+def test_dicom_codec_round_trip(codec, tmp_path):
+    if not compression.codec_available(codec):
+        pytest.skip(f"no encoder for {codec} is installed")
+    pixels = (np.arange(64 * 48, dtype=np.uint16).reshape(64, 48) * 7) % 4096
+    os.makedirs(tmp_path / 'study')
+    make_instance(str(tmp_path / 'study' / 'IM0001'), pixels)
+    with open(tmp_path / 'study' / 'NOTES', 'wb') as f:
+        f.write(b'not a DICOM file')
+    archive_paths = compression.compress_study_dicom(str(tmp_path / 'study'), [str(tmp_path / 'archive')], codec)
+    assert archive_paths == [str(tmp_path / 'archive')]
+    dataset = pydicom.dcmread(str(tmp_path / 'archive' / 'IM0001'))
+    assert dataset.file_meta.TransferSyntaxUID == compression.DICOM_CODECS[codec]
+    assert (dataset.pixel_array == pixels).all()
+    # Files that cannot be re-encoded are archived as they are
+    with open(tmp_path / 'archive' / 'NOTES', 'rb') as f:
+        assert f.read() == b'not a DICOM file'
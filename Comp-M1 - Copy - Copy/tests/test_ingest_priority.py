@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compression
+
+# Quiet period of the watcher under test, and how long each simulated ingest takes
+QUIESCENCE = 0.2
+INGEST_SECONDS = 0.05
+
+
+# Function to drop a study folder into the input directory. Its file is not DICOM, so
+# the study's class comes from the folder name alone.
+def make_study(input_directory, study_folder):
+    os.makedirs(os.path.join(input_directory, study_folder))
+    with open(os.path.join(input_directory, study_folder, 'IM0001'), 'wb') as f:
+        f.write(b'not a DICOM file')
+
+
+# Function to queue the study folders the watcher reports ready, as the archiver's main loop does
+def queue_ready(watcher, ingest_queue, timeout):
+    for study_folder, arrival_time in watcher.wait(timeout):
+        priority = compression.study_priority(os.path.join(watcher.input_directory, study_folder), arrival_time)
+        ingest_queue.add(study_folder, arrival_time, priority)
+
+
+@pytest.fixture(params=['inotify', 'polling'])
+def watcher(request, tmp_path, monkeypatch):
+    if request.param == 'polling':
+        monkeypatch.setattr(compression, 'INotify', None)
+    elif compression.INotify is None:
+        pytest.skip("inotify_simple is not installed")
+    watcher = compression.IngestWatcher(str(tmp_path), quiescence=QUIESCENCE, poll_interval=0.01)
+    yield watcher
+    watcher.close()
+
+
+def test_study_priority_from_folder_name(tmp_path):
+    for study_folder, priority in (('STAT_1', 'stat'), ('backfill_1', 'backfill'), ('study_1', 'routine')):
+        make_study(tmp_path, study_folder)
+        assert compression.study_priority(str(tmp_path / study_folder), time.time()) == priority
+
+
+def test_ingest_queue_order():
+    ingest_queue = compression.IngestQueue()
+    ingest_queue.add('backfill_1', 1.0, 'backfill')
+    ingest_queue.add('routine_2', 3.0, 'routine')
+    ingest_queue.add('routine_1', 2.0, 'routine')
+    ingest_queue.add('stat_1', 4.0, 'stat')
+    assert ingest_queue.archive_job_limit() == 0
+    assert [ingest_queue.pop()[0] for _ in range(4)] == ['stat_1', 'routine_1', 'routine_2', 'backfill_1']
+    assert ingest_queue.archive_job_limit() == compression.ARCHIVE_QUEUE_SIZE
+
+
+def test_stat_study_arriving_during_backlog_is_ingested_next(watcher, tmp_path):
+    routine_folders = [f'routine_{number}' for number in range(20)]
+    for study_folder in routine_folders:
+        make_study(tmp_path, study_folder)
+    ingest_queue = compression.IngestQueue()
+    deadline = time.time() + 5
+    while len(ingest_queue) < len(routine_folders) and time.time() < deadline:
+        queue_ready(watcher, ingest_queue, QUIESCENCE)
+    assert len(ingest_queue) == len(routine_folders)
+
+    # A STAT study arrives while the routine backlog is being ingested. With studies
+    # queued the main loop does not wait, so the watcher is asked with no timeout.
+    popped = [ingest_queue.pop()]
+    make_study(tmp_path, 'stat_1')
+    while ingest_queue:
+        time.sleep(INGEST_SECONDS)
+        queue_ready(watcher, ingest_queue, 0)
+        stat_waiting = ingest_queue.depth('stat')
+        popped.append(ingest_queue.pop())
+        if stat_waiting:
+            assert popped[-1][0] == 'stat_1'
+
+    study_folders = [study_folder for study_folder, arrival_time, priority in popped]
+    assert 'stat_1' in study_folders
+    # It was found while routine studies were still waiting, not after the backlog drained
+    assert study_folders.index('stat_1') < len(study_folders) - 1
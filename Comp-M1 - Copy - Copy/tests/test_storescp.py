@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+import argparse
+import threading
+
+import pytest
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storescp
+
+if storescp.AE is None:
+    pytest.skip("pynetdicom is not installed", allow_module_level=True)
+
+# Quiet period after which the receiver under test registers a study
+QUIESCENCE = 0.3
+CT_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.2'
+
+
+# Function to write a small CT instance of the given study and return its path
+def make_instance(folder, study_instance_uid, number):
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    dataset = Dataset()
+    dataset.file_meta = file_meta
+    dataset.SOPClassUID = CT_IMAGE_STORAGE
+    dataset.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    dataset.StudyInstanceUID = study_instance_uid
+    dataset.SeriesInstanceUID = generate_uid()
+    dataset.PatientID = 'P1'
+    dataset.Modality = 'CT'
+    dataset.InstanceNumber = number
+    dataset.Rows = dataset.Columns = 4
+    dataset.BitsAllocated = dataset.BitsStored = 16
+    dataset.HighBit = 15
+    dataset.SamplesPerPixel = 1
+    dataset.PixelRepresentation = 0
+    dataset.PhotometricInterpretation = 'MONOCHROME2'
+    dataset.PixelData = bytes(32)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f'{number}.dcm')
+    dataset.save_as(path, enforce_file_format=True)
+    return path
+
+
+@pytest.fixture
+def receiver(tmp_path):
+    receiver = storescp.StorageReceiver(None, str(tmp_path / 'short_term'), quiescence=QUIESCENCE,
+                                        flush_interval=0.05)
+    # Registration needs the database; record what would be registered instead
+    receiver.registered = []
+
+    def register_study(staged_path, headers):
+        receiver.registered.append((os.path.basename(staged_path), sorted(os.listdir(staged_path)),
+                                    {header['study_instance_uid'] for header in headers.values()}))
+        return None
+
+    receiver.register_study = register_study
+    ae = storescp.storage_ae('ARCHIVER', 4)
+    server = ae.start_server(('127.0.0.1', 0), block=False, evt_handlers=receiver.event_handlers())
+    receiver.port = server.server_address[1]
+    yield receiver
+    server.shutdown()
+
+
+# Function to wait until the receiver has registered the given number of studies
+def wait_for_registered(receiver, count, timeout=10):
+    deadline = time.monotonic() + timeout
+    while len(receiver.registered) < count and time.monotonic() < deadline:
+        time.sleep(0.02)
+    return receiver.registered
+
+
+def test_send_registers_every_study(receiver, tmp_path):
+    study_uids = [generate_uid(), generate_uid()]
+    for study_uid in study_uids:
+        for number in range(1, 4):
+            make_instance(tmp_path / 'send' / study_uid, study_uid, number)
+    args = argparse.Namespace(folder=str(tmp_path / 'send'), host='127.0.0.1', port=receiver.port,
+                              ae_title='ARCHIVER', associations=2)
+    assert storescp.send(args) == 0
+
+    # Each association registers its own part of each study
+    deadline = time.monotonic() + 10
+    while sum(len(filenames) for _, filenames, _ in receiver.registered) < 6 and time.monotonic() < deadline:
+        time.sleep(0.02)
+    received = {}
+    for study_folder, filenames, study_uids_seen in receiver.registered:
+        assert study_uids_seen == {study_uid for study_uid in study_uids
+                                   if storescp.study_folder_name(study_uid) == study_folder}
+        received.setdefault(study_folder, []).extend(filenames)
+    assert {study_folder: len(filenames) for study_folder, filenames in received.items()} == {
+        storescp.study_folder_name(study_uid): 3 for study_uid in study_uids}
+    # Nothing is left in the incoming folder once the associations have closed
+    deadline = time.monotonic() + 5
+    while os.listdir(receiver.incoming_directory) and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert os.listdir(receiver.incoming_directory) == []
+
+
+def test_quiet_study_is_registered_while_the_association_is_open(receiver, tmp_path):
+    first_study, second_study = generate_uid(), generate_uid()
+    first_path = make_instance(tmp_path / 'send', first_study, 1)
+    second_path = make_instance(tmp_path / 'send', second_study, 2)
+
+    ae = storescp.AE(ae_title='STORESCU')
+    ae.add_requested_context(CT_IMAGE_STORAGE, ExplicitVRLittleEndian)
+    assoc = ae.associate('127.0.0.1', receiver.port, ae_title='ARCHIVER')
+    assert assoc.is_established
+    try:
+        assert assoc.send_c_store(first_path).Status == storescp.STATUS_SUCCESS
+        registered = wait_for_registered(receiver, 1)
+        assert assoc.is_established
+        assert [study_folder for study_folder, _, _ in registered] == [storescp.study_folder_name(first_study)]
+
+        # A study still arriving waits for the quiet period
+        assert assoc.send_c_store(second_path).Status == storescp.STATUS_SUCCESS
+        assert len(receiver.registered) == 1
+    finally:
+        assoc.release()
+    registered = wait_for_registered(receiver, 2)
+    assert registered[1][0] == storescp.study_folder_name(second_study)
@@ -0,0 +1,49 @@
+import os
+import sys
+
+import pytest
+import pydicom
+from pydicom.data import get_testdata_file
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import compression
+
+# Sample headers bundled with pydicom: explicit and implicit VR, big endian, sequences
+SAMPLE_FILES = ['CT_small.dcm', 'MR_small_implicit.dcm', 'MR_small_bigendian.dcm', 'rtplan.dcm', 'waveform_ecg.dcm']
+
+
+# Function to build the tag store the way pydicom converts each element to DICOM JSON
+def pydicom_tag_store(dataset):
+    tags = {}
+    for tag in dataset.keys():
+        element = dataset.get_item(tag)
+        length = getattr(element, 'length', 0)
+        if length != 0xFFFFFFFF and length > compression.TAG_STORE_MAX_ELEMENT_BYTES:
+            continue
+        element = dataset[tag]
+        if element.VR == 'SQ':
+            tags[f'{tag:08X}'] = {'vr': 'SQ', 'Value': [pydicom_tag_store(item) for item in element.value]}
+            continue
+        json_element = element.to_json_dict(lambda element: None, compression.TAG_STORE_MAX_ELEMENT_BYTES)
+        if 'BulkDataURI' not in json_element:
+            tags[f'{tag:08X}'] = json_element
+    return tags
+
+
+@pytest.mark.parametrize('name', SAMPLE_FILES)
+def test_tag_store_matches_pydicom(name):
+    path = get_testdata_file(name)
+    tags = compression.build_tag_store(pydicom.dcmread(path, stop_before_pixels=True))
+    assert tags == pydicom_tag_store(pydicom.dcmread(path, stop_before_pixels=True))
+
+
+def test_tag_store_leaves_out_large_elements(tmp_path):
+    dataset = pydicom.Dataset()
+    dataset.PatientID = 'P1'
+    dataset.ImageComments = 'x' * (compression.TAG_STORE_MAX_ELEMENT_BYTES + 2)
+    dataset.add_new(0x00091010, 'OB', bytes(compression.TAG_STORE_MAX_ELEMENT_BYTES))
+    path = str(tmp_path / 'large.dcm')
+    dataset.save_as(path, implicit_vr=False, little_endian=True)
+    tags = compression.build_tag_store(pydicom.dcmread(path, force=True))
+    assert tags == {'00100020': {'vr': 'LO', 'Value': ['P1']}}
@@ -1,18 +1,127 @@
-from flask import Flask, render_template, send_file, request, redirect, url_for, session
+from flask import Flask, render_template, send_file, request, redirect, url_for, session, jsonify, Response, stream_with_context
 from flask_socketio import SocketIO
 from flask_bcrypt import Bcrypt
 import psycopg2
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 import os
 import gzip
 from psycopg2 import IntegrityError
 import re
+import tarfile
+import zipfile
+import zlib
+import io
+import threading
+import time
+import select
+import queue
+import functools
+import hmac
+import json
+import uuid
 import shutil
+import tempfile
+import urllib.parse
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import pydicom
+from pydicom.encaps import generate_frames
+from pydicom.pixels import pixel_array
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'qwerty12345{}'
 socketio = SocketIO(app)
 bcrypt = Bcrypt(app)
 
+# Level of the app's log
+LOG_LEVEL = 'INFO'
+app.logger.setLevel(LOG_LEVEL)
+
+# Histogram buckets, in seconds, of the time spent in each request stage
+STAGE_SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Prometheus metrics of the web app, served on /metrics: how long downloads and
+# decompression take, what was downloaded, and how busy the connection pool, the hot
+# cache and the study feed are. Every method does nothing when prometheus_client is
+# not installed.
+class AppMetrics:
+    def __init__(self):
+        self.enabled = prometheus_client is not None
+        if not self.enabled:
+            return
+        self.stage_seconds = prometheus_client.Histogram('webapp_stage_seconds', 'Time spent in each request stage',
+                                                         ['stage'], buckets=STAGE_SECONDS_BUCKETS)
+        self.events = prometheus_client.Counter('webapp_events_total', 'Downloads by representation', ['event'])
+        self.in_progress = prometheus_client.Gauge('webapp_in_progress', 'Requests being served', ['stage'])
+        self.queue_depth = prometheus_client.Gauge('webapp_queue_depth', 'Work waiting or in progress', ['queue'])
+        self.cache = prometheus_client.Gauge('webapp_study_cache', 'Hot study cache statistics', ['stat'])
+
+    def observe(self, stage, seconds):
+        if self.enabled:
+            self.stage_seconds.labels(stage).observe(seconds)
+
+    def count(self, event):
+        if self.enabled:
+            self.events.labels(event).inc()
+
+    # Function to report a value by calling value() whenever metrics are scraped
+    def track(self, gauge, label, value):
+        if self.enabled:
+            getattr(self, gauge).labels(label).set_function(value)
+
+    # Function to wrap a route so the time until its response has been sent, not just
+    # built, is recorded as a stage, and the requests it is serving are counted
+    def timed_route(self, stage):
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return view(*args, **kwargs)
+                start_time = time.perf_counter()
+                self.in_progress.labels(stage).inc()
+                try:
+                    response = app.make_response(view(*args, **kwargs))
+                except Exception:
+                    self.in_progress.labels(stage).dec()
+                    raise
+
+                def finished():
+                    self.in_progress.labels(stage).dec()
+                    self.observe(stage, time.perf_counter() - start_time)
+
+                if response.direct_passthrough:
+                    # Files are handed to the server as they are, which may send them with
+                    # sendfile, so only the time until then is known
+                    finished()
+                else:
+                    response.call_on_close(finished)
+                return response
+            return wrapper
+        return decorator
+
+metrics = AppMetrics()
+
+# Token a Prometheus scraper sends as "Authorization: Bearer <token>" to read /metrics,
+# /pool-stats and /cache-stats without logging in. None leaves them to logged-in users.
+METRICS_TOKEN = None
+
 # Database connection settings
 DB_NAME = "image"
 DB_USER = "postgres"
@@ -20,15 +129,218 @@ DB_PASSWORD = "SQLfatima@31"
 DB_HOST = "localhost"
 DB_PORT = "5432"
 
+# Connections kept open, the most that may be checked out at once, and how long a
+# request waits for a free connection before giving up
+DB_POOL_MIN = 2
+DB_POOL_MAX = 20
+DB_POOL_TIMEOUT = 10
+
+# Thread-safe connection pool. Unlike ThreadedConnectionPool on its own, a checkout
+# waits up to DB_POOL_TIMEOUT for a free connection instead of failing as soon as the
+# pool is exhausted, and the pool keeps counters showing how saturated it is.
+class DatabasePool:
+    def __init__(self, minconn, maxconn, timeout=DB_POOL_TIMEOUT, **connect_kwargs):
+        self.pool = ThreadedConnectionPool(minconn, maxconn, **connect_kwargs)
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.available = threading.BoundedSemaphore(maxconn)
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+
+    def getconn(self):
+        start_time = time.perf_counter()
+        if not self.available.acquire(blocking=False):
+            with self.lock:
+                self.waits += 1
+            if not self.available.acquire(timeout=self.timeout):
+                with self.lock:
+                    self.timeouts += 1
+                raise PoolError("Timed out waiting for a database connection")
+        try:
+            connection = self.pool.getconn()
+        except Exception:
+            self.available.release()
+            raise
+        with self.lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+            self.wait_seconds += time.perf_counter() - start_time
+        return connection
+
+    def putconn(self, connection, close=False):
+        try:
+            self.pool.putconn(connection, close=close)
+        finally:
+            with self.lock:
+                self.in_use -= 1
+            self.available.release()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'max_connections': self.maxconn,
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'saturation': self.in_use / self.maxconn,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'wait_seconds_total': self.wait_seconds,
+            }
+
 # Connect to PostgreSQL database
-conn = psycopg2.connect(
+db_pool = DatabasePool(
+    DB_POOL_MIN,
+    DB_POOL_MAX,
     dbname=DB_NAME,
     user=DB_USER,
     password=DB_PASSWORD,
     host=DB_HOST,
     port=DB_PORT
 )
-cursor = conn.cursor()
+
+# Function to check a connection out of the pool for one request or event and get a cursor.
+# The transaction is committed if commit is True and the block succeeds, and rolled back
+# otherwise, so a failed query never leaves an aborted transaction on a pooled connection.
+@contextmanager
+def db_cursor(commit=False):
+    connection = db_pool.getconn()
+    try:
+        with connection.cursor() as cursor:
+            yield cursor
+        if commit:
+            connection.commit()
+        else:
+            connection.rollback()
+    except Exception:
+        if not connection.closed:
+            connection.rollback()
+        raise
+    finally:
+        # Broken connections are closed instead of being handed to the next request
+        db_pool.putconn(connection, close=bool(connection.closed))
+
+# Number of studies listed per page, and the most a client may ask for at once
+STUDIES_PAGE_SIZE = 50
+MAX_STUDIES_PAGE_SIZE = 500
+
+# Channel the archiver announces study changes on, how long the live feed gathers
+# notifications before pushing them out, and the most events read per push
+FEED_CHANNEL = 'study_events'
+FEED_THROTTLE_SECONDS = 1.0
+FEED_MAX_EVENTS = 500
+# How often the feed's background tasks look for notifications and pending changes.
+# They run on the Socket.IO async mode, so they poll and yield with socketio.sleep
+# rather than blocking in select or on a threading.Event
+FEED_POLL_SECONDS = 0.25
+
+# Archive extensions written by the archiver for each codec
+ARCHIVE_EXTENSIONS = {
+    'gzip': '.tar.gz',
+    'pgzip': '.tar.gz',
+    'zstd': '.tar.zst',
+    'lz4': '.tar.lz4',
+}
+
+# Codecs that store a study as a folder of DICOM files with losslessly compressed Pixel Data
+DICOM_CODECS = ('rle', 'jpegls')
+
+# Codec of studies whose instances are kept in the archiver's content-addressed blob store
+BLOB_STORE_CODEC = 'blobs'
+
+# Codecs that store a study as a zip whose members' offsets are kept in the images table
+INDEXED_CODECS = ('zip',)
+
+# Storage tiers downloads may be served from
+LONG_TERM_DIRECTORY = r'C:\Users\Eiman Zulfiqar\OneDrive\Desktop\Comp-M1 - Copy\longterm'
+SHORT_TERM_DIRECTORY = r'C:\Users\Eiman Zulfiqar\OneDrive\Desktop\Comp-M1 - Copy\shortterm'
+
+# Previews the archiver renders at ingest: the size the study list shows, and how long
+# browsers may keep one (a preview never changes once written)
+PREVIEW_LIST_SIZE = 64
+PREVIEW_MAX_AGE = 365 * 24 * 60 * 60
+PREVIEW_MIMETYPES = {'webp': 'image/webp', 'png': 'image/png'}
+
+# Most results a QIDO-RS search returns when the client does not ask for fewer, and at all
+QIDO_DEFAULT_LIMIT = 100
+QIDO_MAX_LIMIT = 1000
+
+# Attributes QIDO-RS returns for each instance unless every attribute is asked for
+QIDO_INSTANCE_TAGS = ('00080016', '00080018', '00080060', '0020000D', '0020000E', '00200013',
+                      '00280008', '00280010', '00280011', '00280100')
+
+# Media types of the compressed transfer syntaxes, for sending frames as they are stored
+FRAME_MEDIA_TYPES = {
+    '1.2.840.10008.1.2.5': 'image/dicom-rle',
+    '1.2.840.10008.1.2.4.80': 'image/jls',
+    '1.2.840.10008.1.2.4.81': 'image/jls',
+    '1.2.840.10008.1.2.4.50': 'image/jpeg',
+    '1.2.840.10008.1.2.4.51': 'image/jpeg',
+    '1.2.840.10008.1.2.4.57': 'image/jpeg',
+    '1.2.840.10008.1.2.4.70': 'image/jpeg',
+    '1.2.840.10008.1.2.4.90': 'image/jp2',
+    '1.2.840.10008.1.2.4.91': 'image/jp2',
+}
+# Transfer syntax of uncompressed frames
+EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1'
+
+# Size of the chunks study downloads are read, decompressed and sent in
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Hot tier for retrieved studies: decompressed archives are kept here (point it at a
+# tmpfs such as /dev/shm for RAM-speed reads) up to HOT_CACHE_MAX_BYTES in total
+HOT_CACHE_DIRECTORY = os.path.join(tempfile.gettempdir(), 'study_cache')
+HOT_CACHE_MAX_BYTES = 20 * 1024 * 1024 * 1024
+
+# Prefetching of a patient's priors into the hot cache: when a study is opened or
+# ingested, up to PREFETCH_PRIORS of the patient's earlier archived studies from the
+# PREFETCH_MAX_AGE_DAYS before it are decompressed in the background, those of the same
+# modality first. Prefetching waits while a request is decompressing a study and keeps
+# to PREFETCH_CPU_SHARE of a core and PREFETCH_MAX_BYTES_PER_SECOND of writes.
+PREFETCH_PRIORS = 3
+PREFETCH_MAX_AGE_DAYS = 5 * 365
+PREFETCH_CPU_SHARE = 0.25
+PREFETCH_MAX_BYTES_PER_SECOND = 50 * 1024 * 1024
+PREFETCH_IDLE_POLL_SECONDS = 1.0
+# Opened studies waiting for their priors beyond this many are not prefetched for, and a
+# study opened again within PREFETCH_REPEAT_SECONDS is not looked at again
+PREFETCH_QUEUE_MAX = 256
+PREFETCH_REPEAT_SECONDS = 15 * 60
+
+# Lets the web server in front of the app send stored files itself, so the worker is free
+# once the headers are out: None sends them from the app (with os.sendfile where the WSGI
+# server supports it), 'x-sendfile' hands them to Apache or lighttpd and
+# 'x-accel-redirect' to nginx, through the internal locations the tiers are exposed under
+SENDFILE_OFFLOAD = None
+SENDFILE_LOCATIONS = {
+    LONG_TERM_DIRECTORY: '/protected/longterm/',
+    SHORT_TERM_DIRECTORY: '/protected/shortterm/',
+    HOT_CACHE_DIRECTORY: '/protected/cache/',
+}
+
+# Codecs whose files are single gzip streams, sent as they are with Content-Encoding: gzip
+# to clients that accept it (pgzip writes many gzip members, which not every client decodes)
+GZIP_PASSTHROUGH_CODECS = (None, 'gzip')
+
+# Function to open a study archive with the decoder matching the codec it was written with
+def open_archive(path, codec, dictionary_path=None):
+    if codec in (None, 'gzip', 'pgzip'):
+        return gzip.open(path, 'rb')
+    if codec == 'zstd' and zstandard is not None:
+        dict_data = None
+        if dictionary_path:
+            with open(dictionary_path, 'rb') as f:
+                dict_data = zstandard.ZstdCompressionDict(f.read())
+        return zstandard.ZstdDecompressor(dict_data=dict_data).stream_reader(open(path, 'rb'), closefd=True)
+    if codec == 'lz4' and lz4 is not None:
+        return lz4.frame.open(path, 'rb')
+    raise ValueError(f"No decoder available for codec {codec}")
 
 # Function to validate email format
 def validate_email(email):
@@ -71,8 +383,8 @@ def register():
             hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
 
             # Insert user data into the database
-            cursor.execute("INSERT INTO users (username, email, password, confirmed_password) VALUES (%s, %s, %s, %s)", (username, email, hashed_password, hashed_password))
-            conn.commit()
+            with db_cursor(commit=True) as cursor:
+                cursor.execute("INSERT INTO users (username, email, password, confirmed_password) VALUES (%s, %s, %s, %s)", (username, email, hashed_password, hashed_password))
 
             # Set success message
             success_msg = 'Successfully registered!'
@@ -85,8 +397,9 @@ def register():
 
 def is_email_registered(email):
     # Query the database to check if the email is already registered
-    cursor.execute("SELECT COUNT(*) FROM users WHERE email = %s", (email,))
-    return cursor.fetchone()[0] > 0
+    with db_cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM users WHERE email = %s", (email,))
+        return cursor.fetchone()[0] > 0
 
 # Route for user login
 @app.route('/login', methods=['GET', 'POST'])
@@ -96,8 +409,9 @@ def login():
         password = request.form['password']
 
         # Fetch user data from the database
-        cursor.execute("SELECT id, username, email, password FROM users WHERE email = %s", (email,))
-        user = cursor.fetchone()
+        with db_cursor() as cursor:
+            cursor.execute("SELECT id, username, email, password FROM users WHERE email = %s", (email,))
+            user = cursor.fetchone()
 
         if user:
             # Check if passwords match
@@ -123,14 +437,83 @@ def logout():
     return redirect(url_for('login'))
 
 
-# Route for displaying image metadata
+# Function to parse a YYYY-MM-DD query parameter, returning None if it is missing or invalid
+def parse_date_arg(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+# Function to read the study list filters from the query string
+def study_filters_from_request(args):
+    return {
+        'patient_id': args.get('patient_id', '').strip(),
+        'modality': args.get('modality', '').strip(),
+        'date_from': args.get('date_from', '').strip(),
+        'date_to': args.get('date_to', '').strip(),
+        'compressed': args.get('compressed', '').strip(),
+    }
+
+# Function to fetch one page of studies, newest first. Pages are keyed on the study id:
+# before_id is the last id of the previous page, so every page is a single index range
+# scan no matter how deep the client has paged. Returns (rows, next_before_id).
+def fetch_studies_page(filters, before_id=None, limit=STUDIES_PAGE_SIZE):
+    conditions = []
+    params = []
+    if filters['patient_id']:
+        # Prefix match, served by the varchar_pattern_ops index on patient_id
+        escaped = filters['patient_id'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conditions.append("patient_id LIKE %s")
+        params.append(escaped + '%')
+    if filters['modality']:
+        conditions.append("modality = %s")
+        params.append(filters['modality'].upper())
+    date_from = parse_date_arg(filters['date_from'])
+    if date_from:
+        conditions.append("timestamp >= %s")
+        params.append(date_from)
+    date_to = parse_date_arg(filters['date_to'])
+    if date_to:
+        conditions.append("timestamp < %s")
+        params.append(date_to + timedelta(days=1))
+    if filters['compressed'] in ('yes', 'no'):
+        conditions.append("compressed = %s")
+        params.append(filters['compressed'] == 'yes')
+    if before_id is not None:
+        conditions.append("id < %s")
+        params.append(before_id)
+
+    query = "SELECT id, patient_id, modality, folderpath, timestamp, compressed FROM studies"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    # Fetch one extra row to find out whether there is a next page
+    query += " ORDER BY id DESC LIMIT %s"
+    params.append(limit + 1)
+
+    with db_cursor() as cursor:
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+    next_before_id = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_before_id = rows[-1][0]
+    return rows, next_before_id
+
+# Function to read the page size and position of a study list request
+def page_args_from_request(args):
+    before_id = args.get('before', type=int)
+    limit = args.get('limit', default=STUDIES_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_STUDIES_PAGE_SIZE))
+    return before_id, limit
+
 # Route for displaying image metadata
 @app.route('/')
 def display_metadata():
     if 'user_id' in session:
-        # Fetch data only from the studies table
-        cursor.execute("SELECT id, patient_id, modality, folderpath, timestamp, compressed FROM studies")
-        data = cursor.fetchall()
+        # Fetch one filtered page from the studies table
+        filters = study_filters_from_request(request.args)
+        before_id, limit = page_args_from_request(request.args)
+        data, next_before_id = fetch_studies_page(filters, before_id, limit)
         username = session['username']
         
         # Pre-process data to extract folder names
@@ -141,72 +524,1653 @@ def display_metadata():
             data_with_folder_info.append((study_id, patient_id, modality, folder_name, folderpath, timestamp, compressed))
         
         # Pass pre-processed data to the template for rendering
-        return render_template('index.html', studies=data_with_folder_info, username=username)
+        # New studies are only added live to the unfiltered first page
+        live_insert = before_id is None and not any(filters.values())
+        return render_template('index.html', studies=data_with_folder_info, username=username,
+                               filters=filters, next_before_id=next_before_id, limit=limit,
+                               feed_cursor=study_feed.latest_event_id(), live_insert=live_insert,
+                               preview_size=PREVIEW_LIST_SIZE)
     else:
         return redirect(url_for('login'))
 
+# Function to convert a (id, patient_id, modality, folderpath, timestamp, compressed) row to JSON
+def study_to_json(row):
+    study_id, patient_id, modality, folderpath, timestamp, compressed = row
+    return {
+        'id': study_id,
+        'patient_id': patient_id,
+        'modality': modality,
+        'folder_name': os.path.basename(folderpath),
+        'timestamp': timestamp.isoformat() if timestamp else None,
+        'compressed': compressed,
+    }
+
+# JSON endpoint the study table pages through
+@app.route('/api/studies')
+def list_studies():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    filters = study_filters_from_request(request.args)
+    before_id, limit = page_args_from_request(request.args)
+    data, next_before_id = fetch_studies_page(filters, before_id, limit)
+    studies = []
+    for row in data:
+        study = study_to_json(row)
+        study['download_url'] = url_for('download_study', study_id=study['id'])
+        study['preview_url'] = url_for('study_preview', study_id=study['id'], size=PREVIEW_LIST_SIZE)
+        studies.append(study)
+    return jsonify({'studies': studies, 'next_before': next_before_id})
+
+# Collects what zipfile writes so it can be sent to the client chunk by chunk
+class ZipStreamBuffer:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+# Reads a stream of chunks as a file, so tarfile can list a tar while it is being sent
+class ChunkStreamReader:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.chunk = b''
+        self.offset = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.offset == len(self.chunk):
+                self.chunk = next(self.chunks, b'')
+                self.offset = 0
+                if not self.chunk:
+                    break
+            end = len(self.chunk) if size < 0 else min(len(self.chunk), self.offset + size)
+            parts.append(self.chunk[self.offset:end])
+            if size > 0:
+                size -= end - self.offset
+            self.offset = end
+        return b''.join(parts)
+
+# Function to build a zip of (name, file object) members on the fly, yielding it in chunks.
+# Members are stored rather than deflated: DICOM pixel data gains little and the CPU is better spent elsewhere.
+def stream_zip(members):
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as zip_file:
+        for name, f in members:
+            with f, zip_file.open(name, 'w', force_zip64=True) as member:
+                while True:
+                    chunk = f.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    member.write(chunk)
+                    yield buffer.pop()
+    yield buffer.pop()
+
+# Function to list the DICOM files of a study folder as (name, file object) zip members
+def folder_members(folder):
+    for entry in sorted(os.scandir(folder), key=lambda entry: entry.name):
+        if entry.is_file():
+            yield entry.name, open(entry.path, 'rb')
+
+# Function to fetch the folderpath, compression status and codec of a study from the
+# studies table, noting the access for the archiver's tiering policy and the prefetcher
+def fetch_study_for_download(study_id):
+    with db_cursor(commit=True) as cursor:
+        cursor.execute('''
+            UPDATE studies SET last_accessed = LOCALTIMESTAMP WHERE id = %s
+            RETURNING folderpath, compressed, codec, codec_dictionary
+        ''', (study_id,))
+        study_data = cursor.fetchone()
+    if study_data:
+        prefetcher.schedule(study_id)
+    return study_data
+
+# Function to look up the size of a study's tarball once decompressed, which the archiver
+# records when it archives the study. None if it is not known.
+def fetch_tar_size(study_id):
+    with db_cursor() as cursor:
+        cursor.execute("SELECT tar_size FROM studies WHERE id = %s", (study_id,))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+# Function to look up the instances of a study that are kept in the blob store, as (filename, path, codec)
+def fetch_blob_images(study_id):
+    with db_cursor() as cursor:
+        cursor.execute('''
+            SELECT images.filename, blobs.path, blobs.codec
+            FROM images JOIN blobs ON blobs.path = images.filepath
+            WHERE images.study_id = %s
+            ORDER BY images.filename
+        ''', (study_id,))
+        return cursor.fetchall()
+
+# Function to list a study as (name, file object) zip members: the files in its folder,
+# if it still has one, followed by its instances in the blob store, decompressed on the fly
+def study_members(folder, blob_images):
+    if folder is not None and os.path.isdir(folder):
+        yield from folder_members(folder)
+    for filename, path, codec in blob_images:
+        blob_path = resolve_study_path(path)
+        if blob_path is not None:
+            yield filename, open_archive(blob_path, codec)
+
+# Function to list the files of a tar stream as (name, file object) zip members
+def tar_members(f):
+    with tarfile.open(fileobj=f, mode='r|') as tar:
+        for member in tar:
+            if member.isfile():
+                yield os.path.normpath(member.name), tar.extractfile(member)
+
+# Function to list the files inside a tar archive as (name, file object) zip members,
+# decompressing the archive once from start to end
+def archive_members(path, codec, dictionary_path):
+    with open_archive(path, codec, dictionary_path) as f:
+        yield from tar_members(f)
+
+# Function to list the files of a tar that is streamed in chunks as zip members. The stream
+# is read to its end, past the end of archive marker, so the hot cache gets all of it.
+def streamed_archive_members(chunks):
+    try:
+        f = ChunkStreamReader(chunks)
+        yield from tar_members(f)
+        while f.read(DOWNLOAD_CHUNK_SIZE):
+            pass
+    finally:
+        chunks.close()
+
+# Function to list the files of a decompressed tar from the hot cache as zip members
+def cached_archive_members(cached_path):
+    with open(cached_path, 'rb') as f:
+        yield from tar_members(f)
+
+# Function to yield the decompressed contents of an archive in chunks
+def stream_archive(path, codec, dictionary_path):
+    start_time = time.perf_counter()
+    with open_archive(path, codec, dictionary_path) as f:
+        while True:
+            chunk = f.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    # Includes the time the consumer took, as chunks are decompressed as they are read
+    metrics.observe('decompress', time.perf_counter() - start_time)
+
+# Disk cache of decompressed study archives with a byte budget and least recently used
+# eviction. A study is filled by one request at a time: a download of a study that is not
+# cached yet fills the cache with the chunks it sends, and a prefetch leaves a study that is
+# being filled alone. Entries are keyed by the archive's validator, so a study that was
+# re-archived or moved is decompressed again, and the study feed drops entries as soon as
+# the archiver reports a move. Studies the prefetcher fills are counted apart, as used once a request
+# reads them and as wasted if they are evicted first.
+class StudyCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # study id -> (validator, path, size), least recently used first
+        self.entries = OrderedDict()
+        # (study id, validator) -> Event set once the decompression in progress finishes
+        self.filling = {}
+        # Archives that decompress to more than the whole budget are streamed instead
+        self.too_large = set()
+        # Evicted files that could not be deleted yet because they were still being sent
+        self.orphans = []
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.shared_fills = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # Prefetched studies no request has read yet
+        self.prefetched = set()
+        # Fills a request is waiting for, which the prefetcher no longer throttles
+        self.awaited = set()
+        self.prefetches = 0
+        self.prefetch_hits = 0
+        self.prefetch_wasted = 0
+        # The index is kept in memory, so files left by an earlier run are of no use
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+    # Function to get the cached path of a study, filling it from chunks() on a miss.
+    # Returns None when the study cannot be cached, in which case the caller streams it.
+    # A prefetch fills the study only if nobody else is already doing so.
+    def get(self, study_id, validator, chunks, prefetch=False):
+        key = (study_id, validator)
+        counted = False
+        while True:
+            with self.lock:
+                path = self.current(study_id, validator)
+                if not prefetch:
+                    # A request that waited for another fill was counted as a miss already
+                    self.record_lookup(study_id, path, counted)
+                    counted = True
+                if path is not None:
+                    return path
+                if key in self.too_large:
+                    return None
+                done = self.filling.get(key)
+                if done is None:
+                    done = self.filling[key] = threading.Event()
+                    break
+                if prefetch:
+                    return None
+                self.shared_fills += 1
+                self.awaited.add(key)
+            # Another request, or the prefetcher, is already decompressing this study
+            done.wait()
+
+        stream = self.fill(study_id, validator, chunks, done, prefetch)
+        try:
+            for _ in stream:
+                # A study too large to cache is not read any further
+                if key in self.too_large:
+                    break
+        except Exception as error:
+            app.logger.error(f"Error caching study {study_id}: {error}")
+        finally:
+            stream.close()
+        with self.lock:
+            return self.current(study_id, validator)
+
+    # Function to stream a study that is not cached from chunks(), caching it on the way: the
+    # chunks are written into the cache as they are sent, and the study is cached only once
+    # all of them were. A study that is already being filled, or cannot be cached, is only streamed.
+    def stream(self, study_id, validator, chunks):
+        key = (study_id, validator)
+        done = None
+        with self.lock:
+            if self.current(study_id, validator) is None and key not in self.too_large and key not in self.filling:
+                done = self.filling[key] = threading.Event()
+        if done is None:
+            yield from chunks()
+        else:
+            yield from self.fill(study_id, validator, chunks, done)
+
+    # Function to pass the chunks of a study on while writing them into the cache, for the
+    # caller that claimed the fill with done. Chunks keep being passed on when the study turns
+    # out too large or its file cannot be written; errors of chunks() go to the caller.
+    def fill(self, study_id, validator, chunks, done, prefetch=False):
+        key = (study_id, validator)
+        path = None
+        size = 0
+        file_path = os.path.join(self.directory, f"{study_id}-{validator}.tar")
+        temp_path = file_path + '.tmp'
+        f = None
+        try:
+            try:
+                f = open(temp_path, 'wb')
+            except OSError as error:
+                app.logger.error(f"Error caching study {study_id}: {error}")
+            stream = chunks()
+            try:
+                for chunk in stream:
+                    if f is not None:
+                        size += len(chunk)
+                        try:
+                            if size > self.max_bytes:
+                                with self.lock:
+                                    self.too_large.add(key)
+                                f = self.discard(f, temp_path)
+                            else:
+                                f.write(chunk)
+                        except OSError as error:
+                            app.logger.error(f"Error caching study {study_id}: {error}")
+                            f = self.discard(f, temp_path)
+                    yield chunk
+            finally:
+                stream.close()
+            if f is not None:
+                try:
+                    f.close()
+                    os.replace(temp_path, file_path)
+                    path = file_path
+                except OSError as error:
+                    app.logger.error(f"Error caching study {study_id}: {error}")
+        finally:
+            # Nothing is cached from a stream that was cut short
+            if f is not None and path is None:
+                self.discard(f, temp_path)
+            with self.lock:
+                if path is not None:
+                    self.entries[study_id] = (validator, path, size)
+                    self.bytes += size
+                    if prefetch:
+                        self.prefetched.add(study_id)
+                        self.prefetches += 1
+                    self.evict()
+                del self.filling[key]
+                self.awaited.discard(key)
+            done.set()
+
+    # Function to give up on a cache file that is being written. Returns None for the file.
+    def discard(self, f, temp_path):
+        try:
+            f.close()
+        except OSError:
+            pass
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+
+    # Function to get the cached path of a study if it is already cached, without filling it
+    def lookup(self, study_id, validator):
+        with self.lock:
+            path = self.current(study_id, validator)
+            self.record_lookup(study_id, path)
+            return path
+
+    # Function to get the cached path of a study, or None if it is not cached or the archive
+    # changed after it was cached. Must be called with the lock held.
+    def current(self, study_id, validator):
+        entry = self.entries.get(study_id)
+        if entry is None:
+            return None
+        if entry[0] != validator:
+            self.remove(study_id)
+            self.invalidations += 1
+            return None
+        return entry[1]
+
+    # Function to count a request looking a study up as a hit or a miss, unless it was
+    # counted already. A prefetched study a request reads is no longer wasted if evicted.
+    # Must be called with the lock held.
+    def record_lookup(self, study_id, path, counted=False):
+        if path is None:
+            if not counted:
+                self.misses += 1
+            return
+        self.entries.move_to_end(study_id)
+        if not counted:
+            self.hits += 1
+        if study_id in self.prefetched:
+            self.prefetched.discard(study_id)
+            self.prefetch_hits += 1
+            metrics.count('prefetch_hit')
+
+    # Function to drop a study, e.g. once the archiver has moved it to another tier
+    def invalidate(self, study_id):
+        with self.lock:
+            if study_id in self.entries:
+                self.remove(study_id)
+                self.invalidations += 1
+
+    # Function to evict least recently used studies until the cache fits its budget.
+    # Must be called with the lock held.
+    def evict(self):
+        for path in list(self.orphans):
+            self.delete(path)
+        while self.bytes > self.max_bytes and self.entries:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    # Function to forget a study and delete its file. Must be called with the lock held.
+    def remove(self, study_id):
+        validator, path, size = self.entries.pop(study_id)
+        self.bytes -= size
+        if study_id in self.prefetched:
+            self.prefetched.discard(study_id)
+            self.prefetch_wasted += 1
+            metrics.count('prefetch_wasted')
+        self.delete(path)
+
+    def delete(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # Windows refuses to delete a file that is still open for a download
+            if path not in self.orphans:
+                self.orphans.append(path)
+            return
+        if path in self.orphans:
+            self.orphans.remove(path)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'shared_fills': self.shared_fills,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'studies': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'prefetches': self.prefetches,
+                'prefetch_hits': self.prefetch_hits,
+                'prefetch_wasted': self.prefetch_wasted,
+                'prefetch_hit_ratio': self.prefetch_hits / self.prefetches if self.prefetches else 0.0,
+            }
+
+study_cache = StudyCache(HOT_CACHE_DIRECTORY, HOT_CACHE_MAX_BYTES)
+
+# Function to map a study folderpath from the database onto a storage tier, or None if it is in neither
+def resolve_study_path(folderpath):
+    # Determine the full path based on folderpath
+    if 'longterm' in folderpath:
+        folder_path = LONG_TERM_DIRECTORY
+    elif 'shortterm' in folderpath:
+        folder_path = SHORT_TERM_DIRECTORY
+    else:
+        return None
+    return os.path.join(folder_path, folderpath)
+
+# Function to build a validator that changes whenever the stored study changes
+def study_etag(study_id, full_path, representation):
+    stat = os.stat(full_path)
+    modified = stat.st_mtime_ns
+    size = stat.st_size
+    if os.path.isdir(full_path):
+        for entry in os.scandir(full_path):
+            entry_stat = entry.stat()
+            modified = max(modified, entry_stat.st_mtime_ns)
+            size += entry_stat.st_size
+    return f"{study_id}-{modified:x}-{size:x}-{representation}", modified / 1e9
+
+# Prefetches the priors of opened and ingested studies into the hot cache, one study at
+# a time in a background task. Only tarballs are prefetched: every other layout is
+# read instance by instance without decompressing the whole study.
+class PrefetchScheduler:
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=PREFETCH_QUEUE_MAX)
+        # study id -> when its priors were last scheduled, oldest first
+        self.recent = OrderedDict()
+        self.lock = threading.Lock()
+        self.started = False
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        socketio.start_background_task(self.run)
+        # Ingested studies are announced on the study feed
+        study_feed.start()
+
+    # Function to ask for the priors of a study to be prefetched
+    def schedule(self, study_id):
+        if PREFETCH_PRIORS <= 0:
+            return
+        now = time.monotonic()
+        with self.lock:
+            while self.recent and now - next(iter(self.recent.values())) >= PREFETCH_REPEAT_SECONDS:
+                self.recent.popitem(last=False)
+            if study_id in self.recent:
+                return
+            self.recent[study_id] = now
+        self.start()
+        try:
+            self.queue.put_nowait(study_id)
+        except queue.Full:
+            metrics.count('prefetch_dropped')
+
+    # Function run in the background: prefetches the priors of each scheduled study in turn
+    def run(self):
+        while True:
+            # The scheduler runs on the Socket.IO async mode, so it yields with
+            # socketio.sleep while the queue is empty instead of blocking on it
+            try:
+                study_id = self.queue.get_nowait()
+            except queue.Empty:
+                socketio.sleep(PREFETCH_IDLE_POLL_SECONDS)
+                continue
+            try:
+                for prior in self.find_priors(study_id):
+                    self.prefetch(*prior)
+            except Exception as error:
+                app.logger.error(f"Error prefetching the priors of study {study_id}: {error}")
+
+    # Function to look up the archived priors of a study worth prefetching, as
+    # (study_id, folderpath, codec, codec_dictionary) rows
+    def find_priors(self, study_id):
+        study_date = "coalesce({0}.study_date, {0}.timestamp::date)"
+        with db_cursor() as cursor:
+            cursor.execute(f'''
+                SELECT prior.id, prior.folderpath, prior.codec, prior.codec_dictionary
+                FROM studies opened JOIN studies prior ON prior.patient_id = opened.patient_id
+                WHERE opened.id = %s AND prior.id <> opened.id AND prior.compressed
+                  AND prior.study_instance_uid IS DISTINCT FROM opened.study_instance_uid
+                  AND (prior.codec IS NULL OR prior.codec <> ALL(%s))
+                  AND {study_date.format('prior')} <= {study_date.format('opened')}
+                  AND {study_date.format('prior')} >= {study_date.format('opened')} - %s
+                ORDER BY prior.modality IS NOT DISTINCT FROM opened.modality DESC,
+                         {study_date.format('prior')} DESC, prior.id DESC
+                LIMIT %s
+            ''', (study_id, list(DICOM_CODECS + INDEXED_CODECS + (BLOB_STORE_CODEC,)),
+                  PREFETCH_MAX_AGE_DAYS, PREFETCH_PRIORS))
+            return cursor.fetchall()
+
+    def prefetch(self, study_id, folderpath, codec, codec_dictionary):
+        full_path = resolve_study_path(folderpath)
+        if full_path is None or not os.path.exists(full_path):
+            return
+        # Requests decompressing a study go first
+        while study_cache.filling:
+            socketio.sleep(PREFETCH_IDLE_POLL_SECONDS)
+        validator, _ = study_etag(study_id, full_path, 'tar')
+        key = (study_id, validator)
+        study_cache.get(study_id, validator,
+                        lambda: self.archive_chunks(key, full_path, codec, codec_dictionary), prefetch=True)
+
+    # Function to yield the decompressed contents of an archive in chunks no faster than
+    # the prefetch budget allows, or at full speed once a request is waiting for them
+    def archive_chunks(self, key, path, codec, dictionary_path):
+        with open_archive(path, codec, dictionary_path) as f:
+            while True:
+                start_time = time.perf_counter()
+                chunk = f.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+                # Time spent reading, decompressing and writing the chunk
+                busy = time.perf_counter() - start_time
+                if key not in study_cache.awaited:
+                    socketio.sleep(max(busy * (1 / PREFETCH_CPU_SHARE - 1),
+                                       len(chunk) / PREFETCH_MAX_BYTES_PER_SECOND - busy))
+
+prefetcher = PrefetchScheduler()
+
+# Function to check whether the client takes gzip Content-Encoding and decompresses it itself
+def accepts_gzip():
+    return request.accept_encodings.quality('gzip') > 0
+
+# Function to find how the web server should be told to send a file, as (header, value),
+# or None if it is to be sent from the app
+def sendfile_offload(path):
+    path = os.path.abspath(path)
+    if SENDFILE_OFFLOAD == 'x-sendfile':
+        return 'X-Sendfile', path
+    if SENDFILE_OFFLOAD == 'x-accel-redirect':
+        for directory, location in SENDFILE_LOCATIONS.items():
+            directory = os.path.abspath(directory)
+            try:
+                if os.path.commonpath([directory, path]) != directory:
+                    continue
+            except ValueError:
+                # On another drive
+                continue
+            relative = os.path.relpath(path, directory).replace(os.sep, '/')
+            return 'X-Accel-Redirect', location + urllib.parse.quote(relative)
+    return None
+
+# Function to send a file whose bytes are the response body as they are. send_file
+# answers conditional and Range requests and gives the file to the WSGI server's file
+# wrapper, which sends it with os.sendfile where it can; with SENDFILE_OFFLOAD the web
+# server sends it instead and also answers Range requests itself.
+def send_stored_file(path, content_encoding=None, **kwargs):
+    response = send_file(path, conditional=True, **kwargs)
+    if content_encoding is not None:
+        response.content_encoding = content_encoding
+    offload = sendfile_offload(path)
+    # nginx drops the Content-Encoding of the app's response when it sends the file
+    if content_encoding is not None and SENDFILE_OFFLOAD == 'x-accel-redirect':
+        offload = None
+    if offload is None or response.status_code not in (200, 206):
+        return response
+    response.close()
+    response.response = []
+    response.status_code = 200
+    response.headers.pop('Content-Length', None)
+    response.headers.pop('Content-Range', None)
+    response.headers[offload[0]] = offload[1]
+    return response
+
 @app.route('/download/<int:study_id>')
+@metrics.timed_route('download')
 def download_study(study_id):
     # Authentication check
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    # Fetch the study folderpath and compression status from the studies table
-    cursor.execute("SELECT folderpath, compressed FROM studies WHERE id = %s", (study_id,))
-    study_data = cursor.fetchone()
+    # The connection goes back to the pool before the (possibly long) transfer starts
+    study_data = fetch_study_for_download(study_id)
+    if not study_data:
+        return "Study not found"
 
-    if study_data:
-        folderpath = study_data[0]
-        compressed = study_data[1]
-
-        # Determine the full path based on folderpath
-        if 'longterm' in folderpath:
-            folder_path = r'C:\Users\Eiman Zulfiqar\OneDrive\Desktop\Comp-M1 - Copy\longterm'
-        elif 'shortterm' in folderpath:
-            folder_path = r'C:\Users\Eiman Zulfiqar\OneDrive\Desktop\Comp-M1 - Copy\shortterm'
+    folderpath, compressed, codec, codec_dictionary = study_data
+    full_path = resolve_study_path(folderpath)
+    if full_path is None:
+        return "Invalid folderpath"
+    # Studies in the blob store have no folder or archive of their own
+    in_blob_store = compressed and codec == BLOB_STORE_CODEC
+    if not in_blob_store and not os.path.exists(full_path):
+        return "Study files not found", 404
+
+    # Archived tarballs are sent decompressed as a .tar unless a zip is asked for; study
+    # folders (short-term or re-encoded DICOM) are always zipped. The archive itself is
+    # only ever read. Decompressed tarballs are kept in the hot cache so a study opened
+    # again is not decompressed again; a study that is not cached yet is cached while it
+    # is sent, so the first bytes go out without waiting for the whole study.
+    study_name = os.path.basename(full_path.rstrip('/\\'))
+    if compressed and codec in INDEXED_CODECS:
+        # The indexed archive is already a zip of the study and is sent as it is
+        metrics.count('download_indexed_zip')
+        etag, last_modified = study_etag(study_id, full_path, 'zip')
+        response = send_stored_file(full_path, mimetype='application/zip', as_attachment=True,
+                                    download_name=study_name, etag=etag, last_modified=last_modified)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    tar_archive = compressed and codec not in DICOM_CODECS + INDEXED_CODECS and not in_blob_store
+    cached_path = None
+    if tar_archive:
+        study_name = study_name[:-len(ARCHIVE_EXTENSIONS.get(codec, '.tar.gz'))]
+        if request.args.get('format') != 'zip' and codec in GZIP_PASSTHROUGH_CODECS and accepts_gzip():
+            # The archive already is the gzipped tar, so it is sent as it is and the client
+            # decompresses it; nothing is decompressed or cached here
+            metrics.count('download_gzip_passthrough')
+            etag, last_modified = study_etag(study_id, full_path, 'tar-gzip')
+            response = send_stored_file(full_path, content_encoding='gzip', mimetype='application/x-tar',
+                                        as_attachment=True, download_name=f"{study_name}.tar",
+                                        etag=etag, last_modified=last_modified)
+            response.vary.add('Accept-Encoding')
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        # The feed drops cached studies the archiver moves
+        study_feed.start()
+        validator, _ = study_etag(study_id, full_path, 'tar')
+        cached_path = study_cache.lookup(study_id, validator)
+
+    if tar_archive and request.args.get('format') != 'zip':
+        representation = 'tar'
+        etag, last_modified = study_etag(study_id, full_path, representation)
+        if cached_path is not None:
+            # send_file answers Range and conditional requests straight from the cached file
+            metrics.count('download_cached_tar')
+            response = send_stored_file(cached_path, mimetype='application/x-tar', as_attachment=True,
+                                        download_name=f"{study_name}.tar", etag=etag,
+                                        last_modified=last_modified)
+            response.vary.add('Accept-Encoding')
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        body = study_cache.stream(study_id, validator, lambda: stream_archive(full_path, codec, codec_dictionary))
+        mimetype = 'application/x-tar'
+    else:
+        representation = 'zip'
+        if cached_path is not None:
+            members = cached_archive_members(cached_path)
+        elif tar_archive:
+            members = streamed_archive_members(study_cache.stream(
+                study_id, validator, lambda: stream_archive(full_path, codec, codec_dictionary)))
+        elif compressed and codec in DICOM_CODECS:
+            members = folder_members(full_path)
         else:
-            return "Invalid folderpath"
+            # Short-term studies may have instances that were already in the blob store on arrival
+            blob_images = fetch_blob_images(study_id)
+            members = study_members(None if in_blob_store else full_path, blob_images)
+        body = stream_zip(members)
+        mimetype = 'application/zip'
+
+    metrics.count(f"download_{'blobs' if in_blob_store else 'streamed'}_{representation}")
+    if in_blob_store:
+        # Blobs never change once written, so the set of instances identifies the content
+        etag, last_modified = f"{study_id}-blobs-{len(blob_images)}-zip", None
+    else:
+        etag, last_modified = study_etag(study_id, full_path, representation)
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    # make_conditional would otherwise read the whole body to find its Content-Length
+    response.implicit_sequence_conversion = False
+    response.headers['Content-Disposition'] = f'attachment; filename="{study_name}.{representation}"'
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    if representation == 'tar' and codec in GZIP_PASSTHROUGH_CODECS:
+        response.vary.add('Accept-Encoding')
+
+    # Range requests are served on the decompressed tar, whose length the archiver records.
+    # The archive cannot be entered in the middle, so a range that starts at offset N first
+    # decompresses and discards the N bytes before it: resuming late in a large study costs
+    # almost as much as downloading it again. Only the hot cache, answered above, seeks.
+    # A study archived before the length was recorded is sent whole; zips are built on the
+    # fly and always sent whole.
+    if representation == 'tar':
+        complete_length = None
+        if request.range is not None:
+            complete_length = fetch_tar_size(study_id)
+        return response.make_conditional(request, accept_ranges=True, complete_length=complete_length)
+    return response.make_conditional(request, accept_ranges=False)
+    
+# Reads one deflated member of an indexed archive, decompressing it as it is read
+class ArchiveMemberReader:
+    def __init__(self, path, offset, length):
+        self.file = open(path, 'rb')
+        self.file.seek(offset)
+        self.remaining = length
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buffer = bytearray()
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) < size) and self.remaining:
+            chunk = self.file.read(min(DOWNLOAD_CHUNK_SIZE, self.remaining))
+            if not chunk:
+                raise EOFError("Indexed archive is shorter than its index")
+            self.remaining -= len(chunk)
+            self.buffer += self.decompressor.decompress(chunk)
+            if not self.remaining:
+                self.buffer += self.decompressor.flush()
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Function to look up instances of a study, ordered by series and Instance Number, as
+# (filename, filepath, sop_instance_uid, archive_offset, archive_length, blob codec).
+# first and last select a run of Instance Numbers.
+def fetch_instances(study_id, sop_instance_uid=None, series_instance_uid=None, first=None, last=None):
+    instance_number = "(images.tags->'00200013'->'Value'->>0)::int"
+    conditions = ["images.study_id = %s"]
+    params = [study_id]
+    if sop_instance_uid is not None:
+        conditions.append("images.sop_instance_uid = %s")
+        params.append(sop_instance_uid)
+    if series_instance_uid is not None:
+        conditions.append("images.series_instance_uid = %s")
+        params.append(series_instance_uid)
+    if first is not None:
+        conditions.append(f"{instance_number} >= %s")
+        params.append(first)
+    if last is not None:
+        conditions.append(f"{instance_number} <= %s")
+        params.append(last)
+    with db_cursor() as cursor:
+        cursor.execute(f'''
+            SELECT images.filename, images.filepath, images.sop_instance_uid,
+                   images.archive_offset, images.archive_length, blobs.codec
+            FROM images LEFT JOIN blobs ON blobs.path = images.filepath
+            WHERE {' AND '.join(conditions)}
+            ORDER BY images.series_instance_uid, {instance_number}, images.filename
+        ''', params)
+        return cursor.fetchall()
+
+# Function to find the file an instance is kept in on its own, as (path, blob codec).
+# Short-term files and re-encoded DICOM are DICOM files as they are; blobs are the
+# instance compressed with the blob codec. Returns None for instances inside an archive.
+def instance_file(study_data, instance):
+    folderpath, compressed, codec, codec_dictionary = study_data
+    filename, filepath, sop_instance_uid, archive_offset, archive_length, blob_codec = instance
+    if compressed and blob_codec is None and codec not in DICOM_CODECS:
+        return None
+    # Blobs and short-term files are where images.filepath says; re-encoded DICOM is in the study's folder
+    path = resolve_study_path(filepath if blob_codec is not None or not compressed else folderpath)
+    if path is None:
+        raise FileNotFoundError(f"No storage tier holds {filename}")
+    if compressed and blob_codec is None:
+        path = os.path.join(path, filename)
+    return path, blob_codec
+
+# Function to open one instance of a study for reading, wherever the study is stored.
+# Instances in the blob store or an indexed archive are reached with a single seek;
+# only tarballs have to be decompressed up to the instance.
+def open_instance(study_data, instance):
+    folderpath, compressed, codec, codec_dictionary = study_data
+    filename, filepath, sop_instance_uid, archive_offset, archive_length, blob_codec = instance
+    stored = instance_file(study_data, instance)
+    if stored is not None:
+        path, blob_codec = stored
+        return open_archive(path, blob_codec) if blob_codec is not None else open(path, 'rb')
+
+    path = resolve_study_path(folderpath)
+    if path is None:
+        raise FileNotFoundError(f"No storage tier holds {filename}")
+    if codec in INDEXED_CODECS and archive_offset is not None:
+        return ArchiveMemberReader(path, archive_offset, archive_length)
+    for name, member in archive_members(path, codec, codec_dictionary):
+        if os.path.basename(name) == filename:
+            return io.BytesIO(member.read())
+    raise FileNotFoundError(f"{filename} is not in {path}")
+
+# Function to yield the contents of an open file in chunks, closing it at the end
+def stream_file(f):
+    with f:
+        while True:
+            chunk = f.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+# Route to fetch a single instance of a study without reading the rest of the study
+@app.route('/download/<int:study_id>/instances/<sop_instance_uid>')
+@metrics.timed_route('download_instance')
+def download_instance(study_id, sop_instance_uid):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    study_data = fetch_study_for_download(study_id)
+    if not study_data:
+        return "Study not found", 404
+    instances = fetch_instances(study_id, sop_instance_uid=sop_instance_uid)
+    if not instances:
+        return "Instance not found", 404
+    filename = instances[0][0]
+    # An SOP instance never changes once created
+    etag = f"{study_id}-{sop_instance_uid}"
+    try:
+        stored = instance_file(study_data, instances[0])
+        if stored is not None and stored[1] is None:
+            # Already a DICOM file on disk, so it is sent without passing through the app
+            metrics.count('download_instance_file')
+            response = send_stored_file(stored[0], mimetype='application/dicom', as_attachment=True,
+                                        download_name=filename, etag=etag)
+            response.cache_control.private = True
+            return response
+        if stored is not None and stored[1] in GZIP_PASSTHROUGH_CODECS and accepts_gzip():
+            # A gzip blob is sent as it is for the client to decompress
+            metrics.count('download_instance_gzip_passthrough')
+            response = send_stored_file(stored[0], content_encoding='gzip', mimetype='application/dicom',
+                                        as_attachment=True, download_name=filename, etag=f"{etag}-gzip")
+            response.vary.add('Accept-Encoding')
+            response.cache_control.private = True
+            return response
+        f = open_instance(study_data, instances[0])
+    except OSError:
+        return "Instance files not found", 404
+
+    metrics.count('download_instance_streamed')
+    response = Response(stream_with_context(stream_file(f)), mimetype='application/dicom')
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.set_etag(etag)
+    if stored is not None:
+        response.vary.add('Accept-Encoding')
+    response.cache_control.private = True
+    return response.make_conditional(request)
+
+# Route to fetch a run of slices, by Instance Number, as a zip: ?series=<uid>&first=<n>&last=<n>
+@app.route('/download/<int:study_id>/slices')
+@metrics.timed_route('download_slices')
+def download_slices(study_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    study_data = fetch_study_for_download(study_id)
+    if not study_data:
+        return "Study not found", 404
+    instances = fetch_instances(study_id, series_instance_uid=request.args.get('series'),
+                                first=request.args.get('first', type=int), last=request.args.get('last', type=int))
+    if not instances:
+        return "No matching instances", 404
+
+    # The feed drops cached studies the archiver moves
+    study_feed.start()
+
+    # A tarball is read once for all the slices; the study's files are closed when the
+    # download ends, also when the client goes away before it is complete
+    def body():
+        opened = open_study_instances(study_id, study_data, instances)
+        try:
+            yield from stream_zip((instance[0], f) for instance, f in opened)
+        finally:
+            opened.close()
+    response = Response(stream_with_context(body()), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="study-{study_id}-slices.zip"'
+    return response
+
+# Function to look up the previews of a study as (id, series_instance_uid, size, width, height, format, path)
+# rows, one per series and size. With a size, only the smallest preview at least that
+# large (or the largest there is) is returned for each series.
+def fetch_previews(study_id, series_instance_uid=None, size=None):
+    conditions = ["study_id = %s"]
+    params = [study_id]
+    if series_instance_uid is not None:
+        conditions.append("series_instance_uid = %s")
+        params.append(series_instance_uid)
+    query = f'''
+        SELECT id, series_instance_uid, size, width, height, format, path
+        FROM previews
+        WHERE {' AND '.join(conditions)}
+        ORDER BY series_instance_uid, size
+    '''
+    if size is not None:
+        query = f'''
+            SELECT DISTINCT ON (series_instance_uid) id, series_instance_uid, size, width, height, format, path
+            FROM previews
+            WHERE {' AND '.join(conditions)}
+            ORDER BY series_instance_uid, size < %s, abs(size - %s), id
+        '''
+        params += [size, size]
+    with db_cursor() as cursor:
+        cursor.execute(query, params)
+        return cursor.fetchall()
+
+# Function to send a preview image. Previews are written once and never change, so
+# browsers may keep them without asking again.
+def send_preview(preview):
+    preview_id, series_instance_uid, size, width, height, preview_format, path = preview
+    full_path = resolve_study_path(path)
+    if full_path is None or not os.path.exists(full_path):
+        return "Preview files not found", 404
+    response = send_stored_file(full_path, mimetype=PREVIEW_MIMETYPES.get(preview_format, 'application/octet-stream'),
+                                etag=f"preview-{preview_id}", max_age=PREVIEW_MAX_AGE)
+    # send_file marks responses with a max_age public; previews are patient images
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+# Route to fetch the preview of a study (its first series, or ?series=<uid>) at about
+# ?size=<pixels> on its longer side, for browsing without downloading the study
+@app.route('/studies/<int:study_id>/preview')
+@metrics.timed_route('preview')
+def study_preview(study_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    previews = fetch_previews(study_id, request.args.get('series'),
+                              request.args.get('size', PREVIEW_LIST_SIZE, type=int))
+    if not previews:
+        # Previews may still be rendering, so the miss is not cached
+        response = Response("Preview not found", status=404)
+        response.cache_control.no_store = True
+        return response
+    return send_preview(previews[0])
+
+# Route to fetch a single preview by id, as listed by /studies/<id>/previews
+@app.route('/previews/<int:preview_id>')
+def preview_image(preview_id):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    with db_cursor() as cursor:
+        cursor.execute('''
+            SELECT id, series_instance_uid, size, width, height, format, path FROM previews WHERE id = %s
+        ''', (preview_id,))
+        preview = cursor.fetchone()
+    if not preview:
+        return "Preview not found", 404
+    return send_preview(preview)
+
+# Route listing the previews of every series of a study, each size with its URL
+@app.route('/studies/<int:study_id>/previews')
+def list_previews(study_id):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    series = {}
+    for preview_id, series_instance_uid, size, width, height, preview_format, path in fetch_previews(study_id):
+        series.setdefault(series_instance_uid, []).append({
+            'size': size,
+            'width': width,
+            'height': height,
+            'url': url_for('preview_image', preview_id=preview_id),
+        })
+    return jsonify({'series': [{'series_instance_uid': uid, 'previews': previews}
+                               for uid, previews in series.items()]})
+
+# Function to turn a DICOM wildcard match (* and ?) into a LIKE pattern
+def like_pattern(value):
+    escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped.replace('*', '%').replace('?', '_')
+
+# Function to parse a DICOM date or date range (YYYYMMDD, YYYYMMDD-, -YYYYMMDD or
+# YYYYMMDD-YYYYMMDD) into (first, last), either of which may be open; None if it is not one
+def parse_date_range(value):
+    first, dash, last = value.partition('-')
+    try:
+        first = datetime.strptime(first, '%Y%m%d').date() if first else None
+        last = datetime.strptime(last, '%Y%m%d').date() if last else (None if dash else first)
+    except ValueError:
+        return None
+    return first, last
+
+# Function to read a QIDO-RS match key, which may be given by keyword or by tag
+def qido_arg(keyword, tag):
+    return (request.args.get(keyword) or request.args.get(tag) or '').strip()
+
+# Function to read a QIDO-RS UID list match key (UIDs separated by commas or backslashes)
+def qido_uids(keyword, tag):
+    value = qido_arg(keyword, tag)
+    return [uid for uid in re.split(r'[,\\]', value) if uid] if value else None
+
+# Function to read the limit and offset of a QIDO-RS search
+def qido_page():
+    limit = request.args.get('limit', QIDO_DEFAULT_LIMIT, type=int)
+    offset = request.args.get('offset', 0, type=int)
+    return min(max(limit, 1), QIDO_MAX_LIMIT), max(offset, 0)
+
+# Function to build a DICOM JSON attribute, left empty when there is no value
+def dicom_attribute(vr, *values):
+    values = [value for value in values if value is not None]
+    return {'vr': vr, 'Value': values} if values else {'vr': vr}
+
+# Function to send a list of DICOM JSON datasets
+def dicom_json_response(datasets):
+    response = Response(json.dumps(datasets), mimetype='application/dicom+json')
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+# Function to get the SQL for the first value of a tag over the images rows of a group
+def first_tag(tag):
+    return f"(array_agg(images.tags->'{tag}') FILTER (WHERE images.tags ? '{tag}'))[1]"
+
+# Function to search studies by Study Instance UID. Studies the archiver received in
+# several parts are one study here. Supported match keys: StudyInstanceUID, PatientID,
+# StudyDate, StudyDescription and ModalitiesInStudy.
+def search_studies(limit, offset):
+    conditions = ["studies.study_instance_uid IS NOT NULL"]
+    params = []
+    study_uids = qido_uids('StudyInstanceUID', '0020000D')
+    if study_uids:
+        conditions.append("studies.study_instance_uid = ANY(%s)")
+        params.append(study_uids)
+    patient_id = qido_arg('PatientID', '00100020')
+    if patient_id:
+        conditions.append("studies.patient_id LIKE %s")
+        params.append(like_pattern(patient_id))
+    study_date = qido_arg('StudyDate', '00080020')
+    if study_date:
+        date_range = parse_date_range(study_date)
+        if date_range is None:
+            raise ValueError(f"Invalid StudyDate {study_date}")
+        first, last = date_range
+        if first is not None:
+            conditions.append("studies.study_date >= %s")
+            params.append(first)
+        if last is not None:
+            conditions.append("studies.study_date <= %s")
+            params.append(last)
+    description = qido_arg('StudyDescription', '00081030')
+    if description:
+        conditions.append("studies.study_description LIKE %s")
+        params.append(like_pattern(description))
+    modality = qido_arg('ModalitiesInStudy', '00080061')
+    if modality:
+        conditions.append('''(studies.modality = %s OR EXISTS (
+            SELECT 1 FROM images series WHERE series.study_id = studies.id
+            AND series.tags->'00080060'->'Value'->>0 = %s))''')
+        params += [modality, modality]
+
+    with db_cursor() as cursor:
+        cursor.execute(f'''
+            SELECT studies.study_instance_uid, min(studies.patient_id), min(studies.study_date),
+                   min(studies.study_description), {first_tag('00100010')}, {first_tag('00080050')},
+                   array_remove(array_agg(DISTINCT coalesce(images.tags->'00080060'->'Value'->>0,
+                                                            studies.modality)), NULL),
+                   count(DISTINCT images.series_instance_uid), count(DISTINCT images.sop_instance_uid)
+            FROM studies LEFT JOIN images ON images.study_id = studies.id
+            WHERE {' AND '.join(conditions)}
+            GROUP BY studies.study_instance_uid
+            ORDER BY max(studies.id) DESC
+            LIMIT %s OFFSET %s
+        ''', params + [limit, offset])
+        return cursor.fetchall()
+
+# Function to search the series of a study. Supported match keys: SeriesInstanceUID and Modality.
+def search_series(study_instance_uid, limit, offset):
+    conditions = ["studies.study_instance_uid = %s"]
+    params = [study_instance_uid]
+    series_uids = qido_uids('SeriesInstanceUID', '0020000E')
+    if series_uids:
+        conditions.append("images.series_instance_uid = ANY(%s)")
+        params.append(series_uids)
+    modality = qido_arg('Modality', '00080060')
+    if modality:
+        conditions.append("images.tags->'00080060'->'Value'->>0 = %s")
+        params.append(modality)
+
+    with db_cursor() as cursor:
+        cursor.execute(f'''
+            SELECT images.series_instance_uid, {first_tag('00080060')}, {first_tag('00200011')},
+                   {first_tag('0008103E')}, count(DISTINCT images.sop_instance_uid)
+            FROM images JOIN studies ON studies.id = images.study_id
+            WHERE {' AND '.join(conditions)}
+            GROUP BY images.series_instance_uid
+            ORDER BY min((images.tags->'00200011'->'Value'->>0)::int), images.series_instance_uid
+            LIMIT %s OFFSET %s
+        ''', params + [limit, offset])
+        return cursor.fetchall()
+
+# Function to look up the tag stores of the instances of a study, ordered by series and
+# Instance Number, as (series_instance_uid, sop_instance_uid, tags) rows
+def search_instances(study_instance_uid, series_instance_uid=None, sop_instance_uids=None, limit=None, offset=0):
+    instance_number = "(images.tags->'00200013'->'Value'->>0)::int"
+    conditions = ["studies.study_instance_uid = %s"]
+    params = [study_instance_uid]
+    if series_instance_uid is not None:
+        conditions.append("images.series_instance_uid = %s")
+        params.append(series_instance_uid)
+    if sop_instance_uids:
+        conditions.append("images.sop_instance_uid = ANY(%s)")
+        params.append(sop_instance_uids)
+    query = f'''
+        SELECT images.series_instance_uid, images.sop_instance_uid, images.tags
+        FROM images JOIN studies ON studies.id = images.study_id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY images.series_instance_uid, {instance_number}, images.filename
+        OFFSET %s
+    '''
+    params.append(offset)
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+    with db_cursor() as cursor:
+        cursor.execute(query, params)
+        return cursor.fetchall()
 
-        full_path = os.path.join(folder_path, folderpath)
+# Route for QIDO-RS study searches
+@app.route('/dicomweb/studies')
+@metrics.timed_route('qido_studies')
+def qido_studies():
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    try:
+        rows = search_studies(*qido_page())
+    except ValueError as error:
+        return str(error), 400
+    results = []
+    for (study_instance_uid, patient_id, study_date, description, patient_name, accession_number,
+         modalities, series_count, instance_count) in rows:
+        results.append({
+            '00080020': dicom_attribute('DA', study_date.strftime('%Y%m%d') if study_date else None),
+            '00080050': accession_number or dicom_attribute('SH'),
+            '00080061': dicom_attribute('CS', *sorted(modalities)),
+            '00081030': dicom_attribute('LO', description),
+            '00081190': dicom_attribute('UR', url_for('wado_retrieve', study_uid=study_instance_uid, _external=True)),
+            '00100010': patient_name or dicom_attribute('PN'),
+            '00100020': dicom_attribute('LO', patient_id),
+            '0020000D': dicom_attribute('UI', study_instance_uid),
+            '00201206': dicom_attribute('IS', series_count),
+            '00201208': dicom_attribute('IS', instance_count),
+        })
+    return dicom_json_response(results)
 
-        # Check if the study is compressed (.gz)
-        if compressed:
-            # Decompress the study
-            uncompressed_path = full_path[:-3]  # Remove the .gz extension
-            with gzip.open(full_path, 'rb') as f_in:
-                with open(uncompressed_path, 'wb') as f_out:
-                    f_out.write(f_in.read())
-            full_path = uncompressed_path  # Update full path to uncompressed folder
+# Route for QIDO-RS searches of the series of a study
+@app.route('/dicomweb/studies/<study_uid>/series')
+@metrics.timed_route('qido_series')
+def qido_series(study_uid):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
 
-        # Create the "downloaded" folder if it doesn't exist
-        downloaded_folder = r'C:\Users\Eiman Zulfiqar\OneDrive\Desktop\downloaded'
-        if not os.path.exists(downloaded_folder):
-            os.makedirs(downloaded_folder)
+    results = []
+    for series_instance_uid, modality, series_number, description, instance_count in search_series(study_uid, *qido_page()):
+        results.append({
+            '00080060': modality or dicom_attribute('CS'),
+            '0008103E': description or dicom_attribute('LO'),
+            '00081190': dicom_attribute('UR', url_for('wado_retrieve', study_uid=study_uid,
+                                                      series_uid=series_instance_uid, _external=True)),
+            '0020000D': dicom_attribute('UI', study_uid),
+            '0020000E': dicom_attribute('UI', series_instance_uid),
+            '00200011': series_number or dicom_attribute('IS'),
+            '00201209': dicom_attribute('IS', instance_count),
+        })
+    return dicom_json_response(results)
 
-        # Move the folder to the "downloaded" folder
-        downloaded_path = os.path.join(downloaded_folder, os.path.basename(full_path))
+# Route for QIDO-RS searches of the instances of a study or series. Only the attributes
+# that identify an instance are returned unless ?includefield=all is given.
+@app.route('/dicomweb/studies/<study_uid>/instances')
+@app.route('/dicomweb/studies/<study_uid>/series/<series_uid>/instances')
+@metrics.timed_route('qido_instances')
+def qido_instances(study_uid, series_uid=None):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+
+    include_all = 'all' in request.args.getlist('includefield')
+    limit, offset = qido_page()
+    results = []
+    for series_instance_uid, sop_instance_uid, tags in search_instances(
+            study_uid, series_uid, qido_uids('SOPInstanceUID', '00080018'), limit, offset):
+        tags = tags or {}
+        result = dict(tags) if include_all else {tag: tags[tag] for tag in QIDO_INSTANCE_TAGS if tag in tags}
+        result['00081190'] = dicom_attribute('UR', url_for('wado_retrieve', study_uid=study_uid,
+                                                           series_uid=series_instance_uid,
+                                                           sop_uid=sop_instance_uid, _external=True))
+        results.append(result)
+    return dicom_json_response(results)
+
+# Route for WADO-RS metadata: the tag stores of the instances of a study, series or instance
+@app.route('/dicomweb/studies/<study_uid>/metadata')
+@app.route('/dicomweb/studies/<study_uid>/series/<series_uid>/metadata')
+@app.route('/dicomweb/studies/<study_uid>/series/<series_uid>/instances/<sop_uid>/metadata')
+@metrics.timed_route('wado_metadata')
+def wado_metadata(study_uid, series_uid=None, sop_uid=None):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
 
-        # If a file with the same name already exists, rename the new file
-        if os.path.exists(downloaded_path):
-            base_name, extension = os.path.splitext(os.path.basename(full_path))
-            downloaded_path = os.path.join(downloaded_folder, base_name + "_new" + extension)
+    rows = search_instances(study_uid, series_uid, [sop_uid] if sop_uid else None)
+    if not rows:
+        return "Not found", 404
+    return dicom_json_response([tags or {} for series_instance_uid, sop_instance_uid, tags in rows])
 
-        # Move the folder to the "downloaded" folder
-        shutil.move(full_path, downloaded_path)
+# Function to look up the stored parts of a study by Study Instance UID as (study id,
+# study data) pairs, noting the access for the archiver's tiering policy and the
+# prefetcher. The archiver keeps a study received in several parts as one studies row per part.
+def fetch_studies_for_retrieve(study_instance_uid):
+    with db_cursor(commit=True) as cursor:
+        cursor.execute('''
+            UPDATE studies SET last_accessed = LOCALTIMESTAMP WHERE study_instance_uid = %s
+            RETURNING id, folderpath, compressed, codec, codec_dictionary
+        ''', (study_instance_uid,))
+        studies = [(row[0], row[1:]) for row in sorted(cursor.fetchall())]
+    if studies:
+        prefetcher.schedule(studies[0][0])
+    return studies
 
-        # Download the folder from the "downloaded" folder
-        return send_file(downloaded_path, as_attachment=True)
+# Function to open the given instances of a study in turn, yielding (instance, file
+# object); each file must be read before the next one is asked for. A tarball is read
+# once from start to end, from the hot cache if the study is there, rather than once per
+# instance; every other layout opens each instance directly. Instances whose files are
+# missing are logged and skipped, as the response is already under way.
+def open_study_instances(study_id, study_data, instances):
+    folderpath, compressed, codec, codec_dictionary = study_data
+    tar_archive = compressed and codec not in DICOM_CODECS + INDEXED_CODECS + (BLOB_STORE_CODEC,)
+    in_tar = {}
+    for instance in instances:
+        if tar_archive and instance[5] is None:
+            in_tar[instance[0]] = instance
+            continue
+        try:
+            f = open_instance(study_data, instance)
+        except OSError as error:
+            app.logger.error(f"Skipping instance {instance[2]} of study {study_id}: {error}")
+            continue
+        yield instance, f
+    if not in_tar:
+        return
+
+    full_path = resolve_study_path(folderpath)
+    if full_path is None or not os.path.exists(full_path):
+        app.logger.error(f"Skipping {len(in_tar)} instances of study {study_id}: archive not found")
+        return
+    validator, _ = study_etag(study_id, full_path, 'tar')
+    cached_path = study_cache.lookup(study_id, validator)
+    if cached_path is not None:
+        members = cached_archive_members(cached_path)
     else:
-        return "Study not found"
-    
+        members = archive_members(full_path, codec, codec_dictionary)
+    try:
+        for name, member in members:
+            instance = in_tar.pop(os.path.basename(name), None)
+            if instance is not None:
+                yield instance, member
+                if not in_tar:
+                    break
+    finally:
+        members.close()
+    for filename in in_tar:
+        app.logger.error(f"Skipping instance {filename} of study {study_id}: not in its archive")
+
+# Function to stream parts, given as (content type, file object), as a multipart/related
+# body. Each part is sent as it is read, so a viewer can start on the first instance
+# before the rest of the study has been read off disk.
+def stream_multipart(parts, boundary):
+    for content_type, f in parts:
+        yield f"--{boundary}\r\nContent-Type: {content_type}\r\n\r\n".encode()
+        yield from stream_file(f)
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+# Function to send parts as a multipart/related response of the given media type
+def multipart_response(parts, media_type):
+    boundary = uuid.uuid4().hex
+    response = Response(stream_with_context(stream_multipart(parts, boundary)),
+                        content_type=f'multipart/related; type="{media_type}"; boundary={boundary}')
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+# Function to list the media types the request accepts as (media type, transfer syntax)
+# pairs. A multipart/related entry stands for its type parameter; the transfer syntax is
+# None when the entry does not name one.
+def accepted_media_types():
+    accepted = []
+    for entry in (request.headers.get('Accept') or '*/*').split(','):
+        media_type, *params = [part.strip() for part in entry.split(';')]
+        params = dict(param.partition('=')[::2] for param in params)
+        params = {key.strip().lower(): value.strip().strip('"') for key, value in params.items()}
+        if media_type.lower() == 'multipart/related':
+            media_type = params.get('type', '*/*')
+        accepted.append((media_type.lower(), params.get('transfer-syntax')))
+    return accepted
+
+# Function to check whether the request accepts a media type in the given transfer
+# syntax ('*' for whatever syntax the data is stored in)
+def accepts(media_type, transfer_syntax='*'):
+    for accepted_type, accepted_syntax in accepted_media_types():
+        if accepted_syntax is None and accepted_type == 'application/octet-stream':
+            # Bulk data without a transfer syntax is uncompressed
+            accepted_syntax = EXPLICIT_VR_LITTLE_ENDIAN
+        if accepted_type in (media_type, '*/*') and accepted_syntax in (None, '*', transfer_syntax):
+            return True
+    return False
+
+# Route for WADO-RS retrieval of the instances of a study, series or instance, each sent
+# as stored in its own part of a multipart/related body as soon as it has been read
+@app.route('/dicomweb/studies/<study_uid>')
+@app.route('/dicomweb/studies/<study_uid>/series/<series_uid>')
+@app.route('/dicomweb/studies/<study_uid>/series/<series_uid>/instances/<sop_uid>')
+@metrics.timed_route('wado_retrieve')
+def wado_retrieve(study_uid, series_uid=None, sop_uid=None):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    if not accepts('application/dicom'):
+        return "Instances are only available as application/dicom", 406
+
+    # The instances are looked up before the response starts, so a miss is still a 404
+    studies = []
+    for study_id, study_data in fetch_studies_for_retrieve(study_uid):
+        instances = fetch_instances(study_id, sop_instance_uid=sop_uid, series_instance_uid=series_uid)
+        if instances:
+            studies.append((study_id, study_data, instances))
+    if not studies:
+        return "Not found", 404
+    # The feed drops cached studies the archiver moves
+    study_feed.start()
+
+    def parts():
+        for study_id, study_data, instances in studies:
+            for instance, f in open_study_instances(study_id, study_data, instances):
+                yield 'application/dicom', f
+    metrics.count('wado_retrieve')
+    return multipart_response(parts(), 'application/dicom')
+
+# Function to get the requested frames of an instance as (media type, transfer syntax,
+# frames), passing compressed frames through as stored when the request accepts their
+# media type and decoding them otherwise. Returns None if no acceptable form exists.
+def instance_frames(data, frame_numbers):
+    dataset = pydicom.dcmread(io.BytesIO(data))
+    transfer_syntax = dataset.file_meta.TransferSyntaxUID
+    number_of_frames = int(dataset.get('NumberOfFrames') or 1)
+    if any(number > number_of_frames for number in frame_numbers):
+        raise IndexError(f"The instance has {number_of_frames} frames")
+
+    if not transfer_syntax.is_compressed:
+        if not accepts('application/octet-stream', EXPLICIT_VR_LITTLE_ENDIAN):
+            return None
+        frame_length = dataset.Rows * dataset.Columns * dataset.get('SamplesPerPixel', 1) * dataset.BitsAllocated // 8
+        pixel_data = dataset.PixelData
+        frames = [pixel_data[(number - 1) * frame_length:number * frame_length] for number in frame_numbers]
+        return 'application/octet-stream', EXPLICIT_VR_LITTLE_ENDIAN, frames
+
+    media_type = FRAME_MEDIA_TYPES.get(transfer_syntax)
+    for stored_type in (media_type, 'application/octet-stream'):
+        if stored_type is not None and accepts(stored_type, transfer_syntax):
+            stored_frames = list(generate_frames(dataset.PixelData, number_of_frames=number_of_frames))
+            return stored_type, transfer_syntax, [stored_frames[number - 1] for number in frame_numbers]
+    if not accepts('application/octet-stream', EXPLICIT_VR_LITTLE_ENDIAN):
+        return None
+    frames = [pixel_array(io.BytesIO(data), index=number - 1).tobytes() for number in frame_numbers]
+    return 'application/octet-stream', EXPLICIT_VR_LITTLE_ENDIAN, frames
+
+# Route for WADO-RS retrieval of frames of an instance, e.g. .../frames/1,2,3
+@app.route('/dicomweb/studies/<study_uid>/series/<series_uid>/instances/<sop_uid>/frames/<frame_list>')
+@metrics.timed_route('wado_frames')
+def wado_frames(study_uid, series_uid, sop_uid, frame_list):
+    if 'user_id' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    try:
+        frame_numbers = [int(number) for number in frame_list.split(',')]
+    except ValueError:
+        return "Invalid frame list", 400
+    if any(number < 1 for number in frame_numbers):
+        return "Frame numbers start at 1", 400
+
+    for study_id, study_data in fetch_studies_for_retrieve(study_uid):
+        instances = fetch_instances(study_id, sop_instance_uid=sop_uid, series_instance_uid=series_uid)
+        if instances:
+            break
+    else:
+        return "Not found", 404
+    try:
+        with open_instance(study_data, instances[0]) as f:
+            data = f.read()
+    except OSError:
+        return "Instance files not found", 404
+
+    try:
+        frames = instance_frames(data, frame_numbers)
+    except IndexError as error:
+        return str(error), 404
+    except Exception as error:
+        app.logger.error(f"Error reading frames of instance {sop_uid}: {error}")
+        return "The frames could not be decoded", 500
+    if frames is None:
+        return "The frames are not available in an accepted media type", 406
+
+    media_type, transfer_syntax, frames = frames
+    content_type = f"{media_type}; transfer-syntax={transfer_syntax}"
+    metrics.count('wado_frames')
+    return multipart_response(((content_type, io.BytesIO(frame)) for frame in frames), media_type)
+
+# Function to check that the caller may read the monitoring routes: a logged-in user,
+# or a scraper presenting METRICS_TOKEN
+def monitoring_allowed():
+    if 'user_id' in session:
+        return True
+    if METRICS_TOKEN is None:
+        return False
+    return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}')
+
+# Route serving the app's metrics in the Prometheus text format
+@app.route('/metrics')
+def export_metrics():
+    if not monitoring_allowed():
+        return jsonify({'error': 'Not logged in'}), 401
+    if prometheus_client is None:
+        return "prometheus_client is not installed", 501
+    return Response(prometheus_client.generate_latest(), mimetype=prometheus_client.CONTENT_TYPE_LATEST)
+
+# Route reporting how busy the database connection pool is
+@app.route('/pool-stats')
+def pool_stats():
+    if not monitoring_allowed():
+        return jsonify({'error': 'Not logged in'}), 401
+    return jsonify(db_pool.stats())
+
+# Route reporting how well the hot study cache is doing
+@app.route('/cache-stats')
+def cache_stats():
+    if not monitoring_allowed():
+        return jsonify({'error': 'Not logged in'}), 401
+    return jsonify(study_cache.stats())
+
+# Pushes study changes to connected dashboards. The archiver records every change in
+# study_events and announces it with NOTIFY. The feed gathers the notifications that
+# arrive within FEED_THROTTLE_SECONDS into a single query and sends each client only
+# the studies that changed after the last event it has seen, so traffic follows the
+# rate of change rather than the size of the studies table. Studies the archiver moves
+# are also dropped from the hot cache.
+class StudyFeed:
+    def __init__(self):
+        # Socket.IO session id -> id of the last event that client has been sent
+        self.clients = {}
+        self.lock = threading.Lock()
+        # Set when clients may be missing events, cleared by push_changes
+        self.changed = False
+        self.started = False
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        socketio.start_background_task(self.listen)
+        socketio.start_background_task(self.push_changes)
+
+    # Function to get the cursor a freshly rendered page starts from
+    def latest_event_id(self):
+        try:
+            with db_cursor() as cursor:
+                cursor.execute("SELECT COALESCE(MAX(id), 0) FROM study_events")
+                return cursor.fetchone()[0]
+        except psycopg2.Error:
+            # The archiver has not created the events table yet
+            return 0
+
+    def subscribe(self, sid, last_event_id):
+        with self.lock:
+            self.clients[sid] = last_event_id
+        self.changed = True
+
+    def unsubscribe(self, sid):
+        with self.lock:
+            self.clients.pop(sid, None)
+
+    # Function run in the background: polls for NOTIFY on its own connection and flags changes
+    def listen(self):
+        while True:
+            try:
+                connection = psycopg2.connect(dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD,
+                                              host=DB_HOST, port=DB_PORT)
+                connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                with connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {FEED_CHANNEL}")
+                # Catch up on anything that changed while nobody was listening
+                self.changed = True
+                while True:
+                    if select.select([connection], [], [], 0) == ([], [], []):
+                        socketio.sleep(FEED_POLL_SECONDS)
+                        continue
+                    connection.poll()
+                    if connection.notifies:
+                        event_ids = [int(notify.payload) for notify in connection.notifies
+                                     if notify.payload.isdigit()]
+                        connection.notifies.clear()
+                        self.invalidate_moved_studies(event_ids)
+                        self.prefetch_ingested_priors(event_ids)
+                        self.changed = True
+            except psycopg2.Error as error:
+                app.logger.warning(f"Study feed lost its database connection: {error}")
+                socketio.sleep(5)
+
+    # Function to drop studies from the hot cache once the archiver has moved them
+    def invalidate_moved_studies(self, event_ids):
+        if not event_ids or not study_cache.entries:
+            return
+        with db_cursor() as cursor:
+            cursor.execute("SELECT DISTINCT study_id FROM study_events WHERE id = ANY(%s) AND event = 'compressed'",
+                           (event_ids,))
+            for (study_id,) in cursor.fetchall():
+                study_cache.invalidate(study_id)
+
+    # Function to prefetch the priors of newly ingested studies, which will be read soon
+    def prefetch_ingested_priors(self, event_ids):
+        if not event_ids or PREFETCH_PRIORS <= 0:
+            return
+        with db_cursor() as cursor:
+            cursor.execute("SELECT DISTINCT study_id FROM study_events WHERE id = ANY(%s) AND event = 'ingested'",
+                           (event_ids,))
+            for (study_id,) in cursor.fetchall():
+                prefetcher.schedule(study_id)
+
+    # Function run in the background: sends pending changes at most once per throttle period
+    def push_changes(self):
+        while True:
+            if not self.changed:
+                socketio.sleep(FEED_POLL_SECONDS)
+                continue
+            self.changed = False
+            try:
+                self.send_deltas()
+            except Exception as error:
+                app.logger.error(f"Error sending study updates: {error}")
+            socketio.sleep(FEED_THROTTLE_SECONDS)
+
+    def send_deltas(self):
+        with self.lock:
+            clients = dict(self.clients)
+        if not clients:
+            return
+
+        with db_cursor() as cursor:
+            cursor.execute('''
+                SELECT e.id, s.id, s.patient_id, s.modality, s.folderpath, s.timestamp, s.compressed
+                FROM study_events e JOIN studies s ON s.id = e.study_id
+                WHERE e.id > %s
+                ORDER BY e.id
+                LIMIT %s
+            ''', (min(clients.values()), FEED_MAX_EVENTS))
+            events = cursor.fetchall()
+        if not events:
+            return
+
+        for sid, last_event_id in clients.items():
+            # Several events for one study collapse into its current state
+            changed_studies = {}
+            cursor_position = last_event_id
+            for event in events:
+                if event[0] > last_event_id:
+                    changed_studies[event[1]] = event[1:]
+                    cursor_position = event[0]
+            if changed_studies:
+                studies = []
+                # url_for needs a request context outside of a request
+                with app.test_request_context():
+                    for row in changed_studies.values():
+                        study = study_to_json(row)
+                        study['download_url'] = url_for('download_study', study_id=study['id'])
+                        study['preview_url'] = url_for('study_preview', study_id=study['id'],
+                                                       size=PREVIEW_LIST_SIZE)
+                        studies.append(study)
+                socketio.emit('study_delta', {'cursor': cursor_position, 'studies': studies}, to=sid)
+                with self.lock:
+                    if sid in self.clients:
+                        self.clients[sid] = max(self.clients[sid], cursor_position)
+
+        if len(events) == FEED_MAX_EVENTS:
+            # More events are waiting, go round again
+            self.changed = True
+
+study_feed = StudyFeed()
+
+# Dashboard clients subscribe with the cursor their page was rendered at
+@socketio.on('subscribe')
+def subscribe_feed(data):
+    if 'user_id' not in session:
+        return
+    study_feed.start()
+    try:
+        last_event_id = int(data.get('cursor', 0))
+    except (AttributeError, TypeError, ValueError):
+        last_event_id = 0
+    study_feed.subscribe(request.sid, last_event_id)
+
+@socketio.on('disconnect')
+def unsubscribe_feed(*args):
+    study_feed.unsubscribe(request.sid)
+
 # Route for handling refresh button click event
 @socketio.on('refresh')
 def refresh_data():
-    # Fetch the latest data from the database
-    cursor.execute("SELECT id, modality, filename, filepath, timestamp, compressed, patient_id FROM image_metadata")
-    data = cursor.fetchall()
-    # Emit the updated data to the client
-    socketio.emit('update_data', data)
+    # Send pending changes now instead of reloading the whole table
+    study_feed.changed = True
+
+metrics.track('queue_depth', 'db_connections_in_use', lambda: db_pool.stats()['in_use'])
+metrics.track('queue_depth', 'study_cache_fills', lambda: len(study_cache.filling))
+metrics.track('queue_depth', 'feed_clients', lambda: len(study_feed.clients))
+metrics.track('queue_depth', 'prefetch', lambda: prefetcher.queue.qsize())
+for stat in ('hits', 'misses', 'evictions', 'studies', 'bytes', 'prefetches', 'prefetch_hits', 'prefetch_wasted'):
+    metrics.track('cache', stat, functools.partial(lambda stat: study_cache.stats()[stat], stat))
 
 if __name__ == '__main__':
+    # Priors of studies ingested from now on are prefetched even before anyone opens a study
+    if PREFETCH_PRIORS > 0:
+        prefetcher.start()
     socketio.run(app, debug=True)
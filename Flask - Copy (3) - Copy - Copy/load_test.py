@@ -0,0 +1,73 @@
+import sys
+import json
+import time
+import argparse
+import threading
+import urllib.parse
+import urllib.request
+import http.cookiejar
+
+# Function to log in and return an opener that carries the session cookie
+def login(base_url, email, password):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    form = urllib.parse.urlencode({'email': email, 'password': password}).encode()
+    opener.open(base_url + '/login', form)
+    return opener
+
+# Function to fetch the database pool counters from the server
+def fetch_pool_stats(base_url):
+    with urllib.request.urlopen(base_url + '/pool-stats') as response:
+        return json.load(response)
+
+# Function to request url from several threads for a fixed time. Returns (requests, errors, latencies).
+def run_load(opener, url, workers, duration):
+    deadline = time.perf_counter() + duration
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker():
+        while time.perf_counter() < deadline:
+            start_time = time.perf_counter()
+            try:
+                with opener.open(url) as response:
+                    response.read()
+            except Exception:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start_time)
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(latencies), errors[0], sorted(latencies)
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure request throughput against a running app at increasing concurrency.")
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--path', default='/api/studies', help="Path requested by every worker")
+    parser.add_argument('--email', required=True)
+    parser.add_argument('--password', required=True)
+    parser.add_argument('--workers', default='1,2,4,8,16', help="Comma separated worker counts")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds per worker count")
+    args = parser.parse_args()
+
+    opener = login(args.base_url, args.email, args.password)
+    url = args.base_url + args.path
+    print(f"{'workers':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'errors':>8}{'pool waits':>12}{'peak in use':>13}")
+    for workers in [int(count) for count in args.workers.split(',')]:
+        before = fetch_pool_stats(args.base_url)
+        requests, errors, latencies = run_load(opener, url, workers, args.duration)
+        after = fetch_pool_stats(args.base_url)
+        p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+        p95 = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0
+        print(f"{workers:>8}{requests / args.duration:>10.1f}{p50:>10.1f}{p95:>10.1f}{errors:>8}"
+              f"{after['waits'] - before['waits']:>12}{after['peak_in_use']:>13}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+import os
+import sys
+
+import pytest
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+APP_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, APP_DIRECTORY)
+
+
+# Stands in for PostgreSQL in the tests: every query is recorded, and answered with the
+# rows the test's responder returns for it
+class FakeDatabase:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.queries = []
+        self.responder = lambda query, params: []
+
+    def connect(self, *args, **kwargs):
+        return FakeConnection(self)
+
+    # Function to list the recorded queries that contain text
+    def executed(self, text):
+        return [(query, params) for query, params in self.queries if text in query]
+
+
+class FakeCursor:
+    def __init__(self, database):
+        self.database = database
+        self.rows = []
+
+    def execute(self, query, params=None):
+        self.database.queries.append((query, params))
+        self.rows = list(self.database.responder(query, params) or [])
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FakeConnection:
+    class info:
+        transaction_status = TRANSACTION_STATUS_IDLE
+
+    def __init__(self, database):
+        self.database = database
+        self.closed = 0
+        self.autocommit = False
+
+    def cursor(self, *args, **kwargs):
+        return FakeCursor(self.database)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+# The app connects when it is imported, so it is pointed at the fake database first
+database = FakeDatabase()
+psycopg2.connect = database.connect
+
+import app as webapp
+
+
+@pytest.fixture
+def db():
+    database.reset()
+    yield database
+    database.reset()
+
+
+@pytest.fixture
+def client(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(webapp, 'LONG_TERM_DIRECTORY', str(tmp_path / 'long_term'))
+    monkeypatch.setattr(webapp, 'SHORT_TERM_DIRECTORY', str(tmp_path / 'short_term'))
+    os.makedirs(webapp.LONG_TERM_DIRECTORY)
+    os.makedirs(webapp.SHORT_TERM_DIRECTORY)
+    # No background tasks in the tests
+    monkeypatch.setattr(webapp.study_feed, 'started', True)
+    monkeypatch.setattr(webapp, 'PREFETCH_PRIORS', 0)
+    client = webapp.app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+        session['username'] = 'tester'
+    return client
@@ -0,0 +1,155 @@
+import json
+import os
+import sys
+from datetime import date
+
+import pytest
+
+import app as webapp
+
+COMPRESSION_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                     'Comp-M1 - Copy - Copy')
+sys.path.insert(0, COMPRESSION_DIRECTORY)
+
+import compression
+
+STUDY_UID = '1.2.3'
+SERIES_UID = '1.2.3.4'
+
+# Tag store of an instance as the archiver records it
+def instance_tags(number):
+    return {
+        '00080016': {'vr': 'UI', 'Value': ['1.2.840.10008.5.1.4.1.1.2']},
+        '00080018': {'vr': 'UI', 'Value': [f'{SERIES_UID}.{number}']},
+        '00080060': {'vr': 'CS', 'Value': ['CT']},
+        '00100010': {'vr': 'PN', 'Value': [{'Alphabetic': 'DOE^JANE'}]},
+        '0020000D': {'vr': 'UI', 'Value': [STUDY_UID]},
+        '0020000E': {'vr': 'UI', 'Value': [SERIES_UID]},
+        '00200013': {'vr': 'IS', 'Value': [number]},
+    }
+
+
+# Function to split a multipart/related response into the bodies of its parts
+def multipart_parts(response):
+    boundary = response.headers['Content-Type'].split('boundary=')[1]
+    body = response.get_data()
+    assert body.endswith(f'--{boundary}--\r\n'.encode())
+    parts = body.split(f'--{boundary}'.encode())[1:-1]
+    return [part.split(b'\r\n\r\n', 1)[1][:-2] for part in parts]
+
+
+def test_study_search_returns_dicom_json(client, db):
+    db.responder = lambda query, params: [
+        (STUDY_UID, 'P1', date(2024, 3, 5), 'CHEST', {'vr': 'PN', 'Value': [{'Alphabetic': 'DOE^JANE'}]},
+         None, ['MR', 'CT'], 2, 40)]
+    response = client.get('/dicomweb/studies?PatientID=P*&StudyDate=20240301-&limit=5000')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'application/dicom+json'
+    study, = json.loads(response.get_data())
+    assert study['0020000D'] == {'vr': 'UI', 'Value': [STUDY_UID]}
+    assert study['00080020'] == {'vr': 'DA', 'Value': ['20240305']}
+    assert study['00080061'] == {'vr': 'CS', 'Value': ['CT', 'MR']}
+    assert study['00080050'] == {'vr': 'SH'}
+    assert study['00100010'] == {'vr': 'PN', 'Value': [{'Alphabetic': 'DOE^JANE'}]}
+    assert (study['00201206']['Value'], study['00201208']['Value']) == ([2], [40])
+    assert study['00081190']['Value'] == [f'http://localhost/dicomweb/studies/{STUDY_UID}']
+    query, params = db.executed('FROM studies LEFT JOIN images')[0]
+    assert 'studies.patient_id LIKE %s AND studies.study_date >= %s' in query
+    assert params == ['P%', date(2024, 3, 1), webapp.QIDO_MAX_LIMIT, 0]
+
+
+def test_study_search_matches_tags_and_uid_lists(client, db):
+    client.get('/dicomweb/studies?0020000D=1.2.3,1.2.4&00080020=20240305&offset=10&limit=3')
+    query, params = db.executed('FROM studies LEFT JOIN images')[0]
+    assert params == [['1.2.3', '1.2.4'], date(2024, 3, 5), date(2024, 3, 5), 3, 10]
+
+
+def test_invalid_study_date_is_refused(client, db):
+    response = client.get('/dicomweb/studies?StudyDate=March')
+    assert response.status_code == 400
+    assert db.queries == []
+
+
+def test_instance_search_returns_identifying_attributes(client, db):
+    db.responder = lambda query, params: [(SERIES_UID, f'{SERIES_UID}.1', instance_tags(1))]
+    instance, = client.get(f'/dicomweb/studies/{STUDY_UID}/instances').get_json()
+    assert '00100010' not in instance
+    assert instance['00200013'] == {'vr': 'IS', 'Value': [1]}
+    assert instance['00081190']['Value'] == [
+        f'http://localhost/dicomweb/studies/{STUDY_UID}/series/{SERIES_UID}/instances/{SERIES_UID}.1']
+
+    instance, = client.get(f'/dicomweb/studies/{STUDY_UID}/instances?includefield=all').get_json()
+    assert instance['00100010'] == {'vr': 'PN', 'Value': [{'Alphabetic': 'DOE^JANE'}]}
+
+
+def test_metadata_returns_the_tag_stores(client, db):
+    db.responder = lambda query, params: [(SERIES_UID, f'{SERIES_UID}.{number}', instance_tags(number))
+                                          for number in (1, 2)]
+    response = client.get(f'/dicomweb/studies/{STUDY_UID}/series/{SERIES_UID}/metadata')
+    assert json.loads(response.get_data()) == [instance_tags(1), instance_tags(2)]
+    query, params = db.executed('FROM images JOIN studies')[0]
+    assert params == [STUDY_UID, SERIES_UID, 0]
+
+
+def test_metadata_of_an_unknown_study_is_not_found(client, db):
+    assert client.get('/dicomweb/studies/9.9/metadata').status_code == 404
+
+
+# Stores two instances of a study in short-term storage or as a gzipped tarball
+@pytest.fixture(params=['short_term', 'tarball'])
+def stored_study(request, client, db, tmp_path):
+    contents = {f'IM{number}': os.urandom(1000 * number) for number in (1, 2)}
+    folder = tmp_path / 'study_1'
+    os.makedirs(folder)
+    for filename, data in contents.items():
+        with open(folder / filename, 'wb') as f:
+            f.write(data)
+    if request.param == 'short_term':
+        folderpath = 'shortterm/study_1'
+        os.makedirs(os.path.join(webapp.SHORT_TERM_DIRECTORY, 'shortterm'))
+        os.rename(folder, os.path.join(webapp.SHORT_TERM_DIRECTORY, folderpath))
+        study_data = (folderpath, False, None, None)
+    else:
+        folderpath = 'longterm/study_1.tar.gz'
+        os.makedirs(os.path.join(webapp.LONG_TERM_DIRECTORY, 'longterm'))
+        compression.compress_folder(str(folder), [os.path.join(webapp.LONG_TERM_DIRECTORY, 'longterm', 'study_1')])
+        study_data = (folderpath, True, 'gzip', None)
+
+    def respond(query, params):
+        if 'RETURNING id, folderpath' in query:
+            return [(1,) + study_data]
+        if 'FROM images LEFT JOIN blobs' in query:
+            return [(filename, f'shortterm/study_1/{filename}', f'{SERIES_UID}.{filename[2:]}', None, None, None)
+                    for filename in contents if params[1:] in ([], [f'{SERIES_UID}.{filename[2:]}', SERIES_UID])]
+        return []
+    db.responder = respond
+    return contents
+
+
+def test_retrieve_sends_every_instance(client, stored_study):
+    response = client.get(f'/dicomweb/studies/{STUDY_UID}', headers={'Accept': 'multipart/related; type="application/dicom"'})
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('multipart/related; type="application/dicom"')
+    assert multipart_parts(response) == [stored_study['IM1'], stored_study['IM2']]
+
+
+def test_retrieve_sends_one_instance(client, stored_study):
+    response = client.get(f'/dicomweb/studies/{STUDY_UID}/series/{SERIES_UID}/instances/{SERIES_UID}.2')
+    assert multipart_parts(response) == [stored_study['IM2']]
+
+
+def test_retrieve_refuses_other_media_types(client, db):
+    response = client.get(f'/dicomweb/studies/{STUDY_UID}', headers={'Accept': 'image/jpeg'})
+    assert response.status_code == 406
+    assert db.queries == []
+
+
+def test_retrieve_of_an_unknown_study_is_not_found(client, db):
+    assert client.get('/dicomweb/studies/9.9').status_code == 404
+
+
+def test_dicomweb_requires_login(db):
+    client = webapp.app.test_client()
+    for path in ('/dicomweb/studies', f'/dicomweb/studies/{STUDY_UID}/metadata', f'/dicomweb/studies/{STUDY_UID}'):
+        assert client.get(path).status_code == 401
+    assert db.queries == []
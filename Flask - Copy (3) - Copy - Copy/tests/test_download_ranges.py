@@ -0,0 +1,66 @@
+import gzip
+import os
+import sys
+
+import pytest
+
+import app as webapp
+
+COMPRESSION_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                     'Comp-M1 - Copy - Copy')
+sys.path.insert(0, COMPRESSION_DIRECTORY)
+
+import compression
+
+
+# Archives a small study the way the archiver does and answers the download queries for it
+@pytest.fixture
+def archived_study(client, db, tmp_path, monkeypatch):
+    folder = tmp_path / 'study_1'
+    os.makedirs(folder / 'series_1')
+    for number, size in enumerate((700, 70000, 3)):
+        with open(folder / 'series_1' / f'IM{number:04d}', 'wb') as f:
+            f.write(os.urandom(size))
+    os.makedirs(os.path.join(webapp.LONG_TERM_DIRECTORY, 'longterm'))
+    compression.compress_folder(str(folder), [os.path.join(webapp.LONG_TERM_DIRECTORY, 'longterm', 'study_1')])
+    with open(os.path.join(webapp.LONG_TERM_DIRECTORY, 'longterm', 'study_1.tar.gz'), 'rb') as f:
+        tar = gzip.decompress(f.read())
+    tar_size = compression.folder_tar_size(str(folder))
+
+    def respond(query, params):
+        if 'RETURNING folderpath' in query:
+            return [('longterm/study_1.tar.gz', True, 'gzip', None)]
+        if 'SELECT tar_size' in query:
+            return [(tar_size,)]
+        return []
+    db.responder = respond
+    monkeypatch.setattr(webapp, 'study_cache', webapp.StudyCache(str(tmp_path / 'cache'), 1 << 30))
+    return tar
+
+
+def test_whole_tar_is_sent(client, archived_study):
+    response = client.get('/download/1')
+    assert response.status_code == 200
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.get_data() == archived_study
+
+
+def test_range_matches_the_archived_tar(client, archived_study):
+    response = client.get('/download/1', headers={'Range': 'bytes=1000-70999'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 1000-70999/{len(archived_study)}'
+    assert response.headers['Content-Length'] == '70000'
+    assert response.get_data() == archived_study[1000:71000]
+
+
+def test_suffix_range_ends_at_the_end_of_the_tar(client, archived_study):
+    response = client.get('/download/1', headers={'Range': 'bytes=-1024'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == \
+        f'bytes {len(archived_study) - 1024}-{len(archived_study) - 1}/{len(archived_study)}'
+    assert response.get_data() == archived_study[-1024:]
+
+
+def test_range_past_the_end_is_refused(client, archived_study):
+    response = client.get('/download/1', headers={'Range': f'bytes={len(archived_study)}-'})
+    assert response.status_code == 416
@@ -0,0 +1,74 @@
+from datetime import datetime
+
+import app as webapp
+
+
+# Function to build study rows with the given ids, newest first
+def study_rows(*ids):
+    return [(study_id, f'P{study_id}', 'CT', f'longterm/study_{study_id}', datetime(2024, 1, study_id), True)
+            for study_id in ids]
+
+
+def no_filters(**filters):
+    return dict({'patient_id': '', 'modality': '', 'date_from': '', 'date_to': '', 'compressed': ''}, **filters)
+
+
+def test_full_page_points_at_the_next_one(db):
+    db.responder = lambda query, params: study_rows(9, 8, 7)
+    rows, next_before_id = webapp.fetch_studies_page(no_filters(), limit=2)
+    assert [row[0] for row in rows] == [9, 8]
+    assert next_before_id == 8
+    query, params = db.executed('FROM studies')[0]
+    assert query.endswith('ORDER BY id DESC LIMIT %s')
+    assert params == [3]
+
+
+def test_last_page_has_no_next_one(db):
+    db.responder = lambda query, params: study_rows(2, 1)
+    rows, next_before_id = webapp.fetch_studies_page(no_filters(), before_id=3, limit=2)
+    assert [row[0] for row in rows] == [2, 1]
+    assert next_before_id is None
+    query, params = db.executed('FROM studies')[0]
+    assert 'WHERE id < %s ORDER BY' in query
+    assert params == [3, 3]
+
+
+def test_filters_are_passed_as_parameters(db):
+    filters = no_filters(patient_id='50%_a\\', modality='mr', date_from='2024-01-01',
+                         date_to='2024-01-31', compressed='no')
+    webapp.fetch_studies_page(filters, before_id=40, limit=10)
+    query, params = db.executed('FROM studies')[0]
+    assert ("WHERE patient_id LIKE %s AND modality = %s AND timestamp >= %s AND timestamp < %s"
+            " AND compressed = %s AND id < %s") in query
+    assert params == ['50\\%\\_a\\\\%', 'MR', datetime(2024, 1, 1), datetime(2024, 2, 1), False, 40, 11]
+
+
+def test_invalid_filters_are_ignored(db):
+    webapp.fetch_studies_page(no_filters(date_from='yesterday', compressed='maybe'))
+    query, params = db.executed('FROM studies')[0]
+    assert 'WHERE' not in query
+    assert params == [webapp.STUDIES_PAGE_SIZE + 1]
+
+
+def test_api_lists_a_page_of_studies(client, db):
+    db.responder = lambda query, params: study_rows(5, 4, 3) if 'FROM studies' in query else []
+    response = client.get('/api/studies?limit=2&modality=ct')
+    assert response.status_code == 200
+    body = response.get_json()
+    assert [study['id'] for study in body['studies']] == [5, 4]
+    assert body['next_before'] == 4
+    assert body['studies'][0]['download_url'] == '/download/5'
+    query, params = db.executed('FROM studies')[0]
+    assert params == ['CT', 3]
+
+
+def test_api_clamps_the_page_size(client, db):
+    client.get(f'/api/studies?limit={webapp.MAX_STUDIES_PAGE_SIZE * 10}&before=7')
+    query, params = db.executed('FROM studies')[0]
+    assert params == [7, webapp.MAX_STUDIES_PAGE_SIZE + 1]
+
+
+def test_api_requires_login(db):
+    response = webapp.app.test_client().get('/api/studies')
+    assert response.status_code == 401
+    assert db.executed('FROM studies') == []
@@ -0,0 +1,96 @@
+import os
+import threading
+
+import app as webapp
+
+
+# Function to build a chunks() callable that yields size bytes and counts how often it is called
+def study_chunks(size, calls, release=None):
+    def chunks():
+        calls.append(size)
+        if release is not None:
+            release.wait(5)
+        yield b'a' * (size // 2)
+        yield b'b' * (size - size // 2)
+    return chunks
+
+
+def test_concurrent_misses_decompress_once(tmp_path):
+    cache = webapp.StudyCache(str(tmp_path), 1000)
+    calls = []
+    release = threading.Event()
+    paths = []
+
+    def get():
+        paths.append(cache.get(1, 'v1', study_chunks(100, calls, release)))
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    # Let every request reach the cache before the first fill finishes
+    while cache.stats()['shared_fills'] < 7:
+        threading.Event().wait(0.01)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert calls == [100]
+    assert len(set(paths)) == 1 and paths[0] is not None
+    with open(paths[0], 'rb') as f:
+        assert f.read() == b'a' * 50 + b'b' * 50
+    stats = cache.stats()
+    assert (stats['misses'], stats['hits'], stats['studies'], stats['bytes']) == (8, 0, 1, 100)
+    assert cache.filling == {}
+
+
+def test_least_recently_used_study_is_evicted(tmp_path):
+    cache = webapp.StudyCache(str(tmp_path), 250)
+    calls = []
+    first = cache.get(1, 'v1', study_chunks(100, calls))
+    cache.get(2, 'v1', study_chunks(100, calls))
+    # Reading study 1 again makes study 2 the least recently used
+    assert cache.get(1, 'v1', study_chunks(100, calls)) == first
+    cache.get(3, 'v1', study_chunks(100, calls))
+
+    assert list(cache.entries) == [1, 3]
+    assert cache.lookup(2, 'v1') is None
+    assert sorted(os.listdir(tmp_path)) == ['1-v1.tar', '3-v1.tar']
+    stats = cache.stats()
+    assert (stats['evictions'], stats['bytes'], stats['hits']) == (1, 200, 1)
+    assert calls == [100, 100, 100]
+
+
+def test_changed_archive_is_decompressed_again(tmp_path):
+    cache = webapp.StudyCache(str(tmp_path), 1000)
+    calls = []
+    cache.get(1, 'v1', study_chunks(100, calls))
+    path = cache.get(1, 'v2', study_chunks(120, calls))
+
+    assert path.endswith('1-v2.tar')
+    assert os.listdir(tmp_path) == ['1-v2.tar']
+    stats = cache.stats()
+    assert (stats['invalidations'], stats['bytes']) == (1, 120)
+
+
+def test_study_larger_than_the_budget_is_not_cached(tmp_path):
+    cache = webapp.StudyCache(str(tmp_path), 50)
+    calls = []
+    assert cache.get(1, 'v1', study_chunks(100, calls)) is None
+    # Later requests stream it without trying to fill it again
+    assert cache.get(1, 'v1', study_chunks(100, calls)) is None
+    assert calls == [100]
+    assert os.listdir(tmp_path) == []
+
+
+def test_streamed_study_is_cached_once_sent_whole(tmp_path):
+    cache = webapp.StudyCache(str(tmp_path), 1000)
+    calls = []
+    assert b''.join(cache.stream(1, 'v1', study_chunks(100, calls))) == b'a' * 50 + b'b' * 50
+    assert cache.lookup(1, 'v1') is not None
+
+    # A download cut short leaves nothing behind
+    stream = cache.stream(2, 'v1', study_chunks(100, calls))
+    next(stream)
+    stream.close()
+    assert cache.lookup(2, 'v1') is None
+    assert os.listdir(tmp_path) == ['1-v1.tar']
+    assert cache.filling == {}
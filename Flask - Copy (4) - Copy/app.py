@@ -1,4 +1,4 @@
-from flask import Flask, render_template, send_file, request, redirect, url_for, session
+from flask import Flask, render_template, send_file, request, redirect, url_for, session, Response, stream_with_context
 from flask_socketio import SocketIO
 from flask_bcrypt import Bcrypt
 import psycopg2
@@ -29,6 +29,18 @@ conn = psycopg2.connect(
 )
 cursor = conn.cursor()
 
+# Size of the chunks compressed images are decompressed and sent in
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Function to yield the decompressed contents of a .gz file in chunks
+def stream_gzip(path):
+    with gzip.open(path, 'rb') as f:
+        while True:
+            chunk = f.read(DOWNLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
 # Function to validate email format
 def validate_email(email):
     # Simple pattern to validate Gmail addresses
@@ -149,27 +161,20 @@ def download_image(filepath):
         return "Invalid filepath"
     
     full_path = os.path.join(folder_path, filepath)
+    if not os.path.isfile(full_path):
+        return "File not found", 404
     
-    # Check if the file is compressed (.gz)
-    if filepath.endswith('.gz'):
-        # Decompress the file
-        uncompressed_path = full_path[:-3]  # Remove the .gz extension
-        with gzip.open(full_path, 'rb') as f_in:
-            with open(uncompressed_path, 'wb') as f_out:
-                f_out.write(f_in.read())
-        full_path = uncompressed_path  # Update full path to uncompressed file
-    
-    # Create the "downloaded" folder if it doesn't exist
-    downloaded_folder = r'C:\Users\Eiman Zulfiqar\OneDrive\Desktop\downloaded'
-    if not os.path.exists(downloaded_folder):
-        os.makedirs(downloaded_folder)
-    
-    # Move the file to the "downloaded" folder
-    downloaded_path = os.path.join(downloaded_folder, os.path.basename(full_path))
-    os.rename(full_path, downloaded_path)
-    
-    # Download the image from the "downloaded" folder
-    return send_file(downloaded_path, as_attachment=True)
+    # Uncompressed files are sent as they are, with Range and conditional request support
+    if not filepath.endswith('.gz'):
+        return send_file(full_path, as_attachment=True, conditional=True)
+
+    # Decompress the file in chunks straight into the response, leaving the archive in place
+    stat = os.stat(full_path)
+    response = Response(stream_with_context(stream_gzip(full_path)), mimetype='application/dicom')
+    response.headers['Content-Disposition'] = f'attachment; filename="{os.path.basename(full_path)[:-3]}"'
+    response.set_etag(f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+    response.last_modified = stat.st_mtime
+    return response.make_conditional(request)
 
 # Route for handling refresh button click event
 @socketio.on('refresh')